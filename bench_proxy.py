@@ -0,0 +1,654 @@
+#!/usr/bin/env python3
+"""
+Benchmark for fake_news_proxy.py that runs offline.
+
+Starts a local origin serving fixed fixtures and the proxy in front of it,
+then drives the proxy at each concurrency level for a while and reports
+requests per second, latency percentiles and the proxy's CPU time and RSS.
+A few micro benchmarks time read_line, read_http_headers and forward_raw
+on their own. Results are written as JSON; --compare reads an earlier
+result file and reports what got slower.
+
+    python3 bench_proxy.py -c 1,16,64 -t 5 -o before.json
+    python3 bench_proxy.py -c 1,16,64 -t 5 --compare before.json
+    python3 bench_proxy.py --proxy-args="-a -w 2"
+"""
+import socket
+import threading
+import asyncio
+import multiprocessing
+import subprocess
+import getopt
+import shlex
+import sys
+import os
+import json
+import gzip
+import random
+import time
+import platform
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import proxy_pipeline
+from proxy_codings import ChunkedDecoder
+from proxy_http import (SocketReader, parse_http_head, header_dict, response_status,
+                        read_http_headers, forward_raw, copy_forward)
+
+PROXY_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_news_proxy.py")
+
+# Defaults for the command line
+CONCURRENCY = (1, 16, 64)
+DURATION = 5.0          # seconds per fixture and concurrency level
+WARMUP = 1.0            # seconds at the start of each run not counted
+CLIENT_PROCESSES = 1    # load generator processes the connections are spread over
+TOLERANCE = 10.0        # percent a number may get worse before --compare flags it
+
+# Fixture sizes (bytes)
+SMALL_HTML_BYTES = 2 * 1024
+LARGE_HTML_BYTES = 1024 * 1024
+CHUNKED_HTML_BYTES = 256 * 1024
+CHUNK_BYTES = 8 * 1024
+GZIP_HTML_BYTES = 256 * 1024
+IMAGE_BYTES = 1024 * 1024
+
+# Fixture name -> path on the origin (Smiley.jpg never gets there, the
+# proxy answers it from its own copy)
+FIXTURES = {
+    "small": "/small.html",
+    "large": "/large.html",
+    "chunked": "/chunked.html",
+    "gzip": "/gzip.html",
+    "image": "/image.jpg",
+    "smiley": "/Smiley.jpg",
+}
+
+# Micro benchmark sizes
+MICRO_LINES = 200000
+MICRO_HEADER_BLOCKS = 20000
+MICRO_FORWARD_BYTES = 128 * 1024 * 1024
+
+# ***************** ORIGIN *****************
+
+def html_of_size(size):
+    """
+    HTML with words the default rewrite rules replace, about 'size' bytes.
+    """
+    para = (b'<p>Smiley says hello from Stockholm. <img src="./Stockholm-spring.jpg" '
+            b'alt="Stockholm?" width="400" height="300"> Nothing to see here.</p>\n')
+    head, tail = b"<html><body>\n", b"</body></html>\n"
+    count = max(1, (size - len(head) - len(tail)) // len(para))
+    return head + para * count + tail
+
+def fixture_bodies():
+    return {
+        "/small.html": html_of_size(SMALL_HTML_BYTES),
+        "/large.html": html_of_size(LARGE_HTML_BYTES),
+        "/chunked.html": html_of_size(CHUNKED_HTML_BYTES),
+        "/gzip.html": gzip.compress(html_of_size(GZIP_HTML_BYTES), 6),
+        "/image.jpg": random.Random(0).randbytes(IMAGE_BYTES),
+        "/Smiley.jpg": random.Random(1).randbytes(16 * 1024),
+    }
+
+class OriginHandler(BaseHTTPRequestHandler):
+    """
+    Serves the fixtures over keep-alive connections. With 'cacheable' set
+    responses carry Cache-Control: max-age, so the proxy may cache them.
+    """
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True      # head and body go out in separate writes
+    bodies = {}
+    cacheable = False
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path
+        if "://" in path:
+            path = "/" + path.split("://", 1)[1].split("/", 1)[-1]
+        body = self.bodies.get(path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        if path.endswith(".jpg"):
+            self.send_header("Content-Type", "image/jpeg")
+        else:
+            self.send_header("Content-Type", "text/html")
+        if path == "/gzip.html":
+            self.send_header("Content-Encoding", "gzip")
+        if self.cacheable:
+            self.send_header("Cache-Control", "max-age=3600")
+        if path == "/chunked.html":
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(0, len(body), CHUNK_BYTES):
+                chunk = body[i:i + CHUNK_BYTES]
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+            return
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class OriginServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+def run_origin(port, cacheable):
+    OriginHandler.bodies = fixture_bodies()
+    OriginHandler.cacheable = cacheable
+    OriginServer(("127.0.0.1", port), OriginHandler).serve_forever()
+
+def start_origin(cacheable=False):
+    """
+    Run the origin in a process of its own. Returns (process, port).
+    """
+    port = free_port()
+    proc = multiprocessing.Process(target=run_origin, args=(port, cacheable))
+    proc.daemon = True
+    proc.start()
+    wait_listening(port)
+    return proc, port
+
+# ***************** PROXY *****************
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def wait_listening(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1.0).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+def start_proxy(args):
+    """
+    Start fake_news_proxy.py with extra command line 'args'. Returns
+    (process, port).
+    """
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, PROXY_SCRIPT, "-p", str(port)] + args,
+                            cwd=os.path.dirname(PROXY_SCRIPT),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_listening(port)
+    except OSError:
+        proc.kill()
+        raise
+    return proc, port
+
+def stop_proxy(proc):
+    proc.terminate()
+    try:
+        proc.wait(proxy_pipeline.WORKER_DRAIN_TIMEOUT + 5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+def process_tree(pid):
+    """
+    'pid' and its descendants (worker processes), from /proc.
+    """
+    pids = [pid]
+    for p in pids:
+        try:
+            for tid in os.listdir(f"/proc/{p}/task"):
+                with open(f"/proc/{p}/task/{tid}/children") as f:
+                    pids.extend(int(c) for c in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+def cpu_seconds(pids):
+    """
+    User plus system CPU time of the processes, None without /proc.
+    """
+    total = 0
+    try:
+        for pid in pids:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += int(fields[11]) + int(fields[12])    # utime, stime
+    except (OSError, IndexError, ValueError):
+        return None
+    return total / os.sysconf("SC_CLK_TCK")
+
+def rss_kb(pids):
+    total = 0
+    try:
+        for pid in pids:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return total
+
+# ***************** LOAD GENERATOR *****************
+
+async def read_response(reader):
+    """
+    Read one response. Returns (status, body bytes, keep_alive).
+    """
+    head = await reader.readuntil(b"\r\n\r\n")
+    status_line, fields = parse_http_head(head)
+    headers = header_dict(fields)
+    status = response_status(status_line)
+    keep_alive = b"close" not in headers.get(b"connection", b"").lower()
+    if b"chunked" in headers.get(b"transfer-encoding", b"").lower():
+        decoder = ChunkedDecoder()
+        size = 0
+        while not decoder.done:
+            data = await reader.read(65536)
+            if not data:
+                raise asyncio.IncompleteReadError(b"", None)
+            size += len(decoder.feed(data))
+        return status, size, keep_alive
+    if b"content-length" in headers:
+        body = await reader.readexactly(int(headers[b"content-length"]))
+        return status, len(body), keep_alive
+    if status in (204, 304) or 100 <= status < 200:
+        return status, 0, keep_alive
+    size = 0
+    while True:
+        data = await reader.read(65536)
+        if not data:
+            return status, size, False
+        size += len(data)
+
+async def client(port, request, start_at, end_at, latencies, counts):
+    """
+    One connection sending 'request' again and again until end_at;
+    answers that finish before start_at are not counted.
+    """
+    reader = writer = None
+    loop = asyncio.get_running_loop()
+    while loop.time() < end_at:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port, limit=1024 * 1024)
+            started = loop.time()
+            writer.write(request)
+            status, size, keep_alive = await read_response(reader)
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            counts["errors"] += 1
+            if writer is not None:
+                writer.close()
+            writer = None
+            await asyncio.sleep(0.01)
+            continue
+        done = loop.time()
+        if started >= start_at:
+            latencies.append(done - started)
+            counts["bytes"] += size
+            if status >= 400:
+                counts["errors"] += 1
+        if not keep_alive:
+            writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+async def drive(port, request, connections, warmup, duration):
+    loop = asyncio.get_running_loop()
+    start_at = loop.time() + warmup
+    end_at = start_at + duration
+    latencies = []
+    counts = {"errors": 0, "bytes": 0}
+    await asyncio.gather(*(client(port, request, start_at, end_at, latencies, counts)
+                           for _ in range(connections)))
+    return latencies, counts
+
+def load_process(port, request, connections, warmup, duration, results):
+    results.put(asyncio.run(drive(port, request, connections, warmup, duration)))
+
+def build_request(origin_port, path, fixture):
+    request = (f"GET http://127.0.0.1:{origin_port}{path} HTTP/1.1\r\n"
+               f"Host: 127.0.0.1:{origin_port}\r\n")
+    if fixture == "gzip":
+        request += "Accept-Encoding: gzip\r\n"
+    return (request + "\r\n").encode("latin-1")
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+
+def run_level(proxy_port, origin_port, fixture, concurrency, processes, warmup, duration, proxy_pid):
+    """
+    Drive the proxy with 'concurrency' connections for warmup + duration
+    seconds. Returns the result dict.
+    """
+    request = build_request(origin_port, FIXTURES[fixture], fixture)
+    processes = max(1, min(processes, concurrency))
+    results = multiprocessing.Queue()
+    procs = []
+    for i in range(processes):
+        share = concurrency // processes + (1 if i < concurrency % processes else 0)
+        proc = multiprocessing.Process(target=load_process,
+                                       args=(proxy_port, request, share, warmup, duration, results))
+        proc.start()
+        procs.append(proc)
+
+    # proxy CPU is measured over the counted part only
+    time.sleep(warmup)
+    pids = process_tree(proxy_pid) if proxy_pid else []
+    cpu_before = cpu_seconds(pids) if pids else None
+    time.sleep(duration)
+    cpu_after = cpu_seconds(pids) if pids else None
+    rss = rss_kb(process_tree(proxy_pid)) if proxy_pid else None
+
+    latencies = []
+    errors = size = 0
+    for _ in procs:
+        lat, counts = results.get()
+        latencies += lat
+        errors += counts["errors"]
+        size += counts["bytes"]
+    for proc in procs:
+        proc.join()
+    latencies.sort()
+    cpu = None if cpu_before is None or cpu_after is None else cpu_after - cpu_before
+
+    def ms(seconds):
+        return None if seconds is None else round(seconds * 1000, 3)
+
+    return {
+        "fixture": fixture,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / duration, 1),
+        "mb_per_s": round(size / duration / 1e6, 2),
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p90_ms": ms(percentile(latencies, 90)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "max_ms": ms(latencies[-1] if latencies else None),
+        "cpu_seconds": None if cpu is None else round(cpu, 2),
+        "cpu_percent": None if cpu is None else round(cpu / duration * 100, 1),
+        "rss_kb": rss,
+    }
+
+# ***************** MICRO BENCHMARKS *****************
+
+def tcp_pair():
+    """
+    Two connected loopback TCP sockets.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    a = socket.create_connection(listener.getsockname())
+    b, _ = listener.accept()
+    listener.close()
+    return a, b
+
+def bench_read_line(lines=MICRO_LINES):
+    """
+    SocketReader.read_line over header lines already in its buffer.
+    """
+    a, b = socket.socketpair()
+    try:
+        reader = SocketReader(a)
+        reader.buf += b"".join(b"X-Header-%d: %s\r\n" % (i % 50, b"v" * 40) for i in range(lines))
+        started = time.perf_counter()
+        for _ in range(lines):
+            reader.read_line()
+        elapsed = time.perf_counter() - started
+    finally:
+        a.close()
+        b.close()
+    return {"name": "read_line", "ops_per_s": round(lines / elapsed), "seconds": round(elapsed, 3)}
+
+def bench_read_http_headers(blocks=MICRO_HEADER_BLOCKS):
+    """
+    read_http_headers over typical browser request heads, as handle_client
+    reads them.
+    """
+    head = (b"GET http://example.com/news/index.html HTTP/1.1\r\n"
+            b"Host: example.com\r\n"
+            b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0\r\n"
+            b"Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
+            b"Accept-Language: sv-SE,sv;q=0.8,en-US;q=0.5,en;q=0.3\r\n"
+            b"Accept-Encoding: gzip, deflate\r\n"
+            b"Connection: keep-alive\r\n"
+            b"Cookie: session=0123456789abcdef; theme=dark\r\n\r\n")
+    a, b = socket.socketpair()
+    try:
+        reader = SocketReader(a)
+        reader.buf += head * blocks
+        started = time.perf_counter()
+        for _ in range(blocks):
+            read_http_headers(reader)
+        elapsed = time.perf_counter() - started
+    finally:
+        a.close()
+        b.close()
+    return {"name": "read_http_headers", "ops_per_s": round(blocks / elapsed), "seconds": round(elapsed, 3)}
+
+def bench_forward(name, forward, total=MICRO_FORWARD_BYTES):
+    """
+    'forward' (forward_raw or copy_forward) moving 'total' bytes between
+    two loopback connections, with threads feeding and draining them.
+    """
+    src_out, src_in = tcp_pair()
+    dst_in, dst_out = tcp_pair()
+
+    def feed():
+        block = b"x" * (256 * 1024)
+        left = total
+        while left > 0:
+            n = min(left, len(block))
+            src_out.sendall(block[:n])
+            left -= n
+
+    def drain():
+        buf = bytearray(1024 * 1024)
+        left = total
+        while left > 0:
+            n = dst_out.recv_into(buf)
+            if not n:
+                break
+            left -= n
+
+    feeder = threading.Thread(target=feed)
+    drainer = threading.Thread(target=drain)
+    try:
+        started = time.perf_counter()
+        feeder.start()
+        drainer.start()
+        moved = forward(src_in, dst_in, total)
+        drainer.join()
+        elapsed = time.perf_counter() - started
+        feeder.join()
+    finally:
+        for sock in (src_out, src_in, dst_in, dst_out):
+            sock.close()
+    return {"name": name, "mb_per_s": round(moved / elapsed / 1e6, 1), "seconds": round(elapsed, 3)}
+
+def run_micro():
+    return [bench_read_line(), bench_read_http_headers(),
+            bench_forward("forward_raw", forward_raw), bench_forward("copy_forward", copy_forward)]
+
+# ***************** RESULTS *****************
+
+def git_revision():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(PROXY_SCRIPT),
+                             capture_output=True, text=True, timeout=10)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def print_result(r):
+    cpu = "-" if r["cpu_percent"] is None else f'{r["cpu_percent"]}%'
+    rss = "-" if r["rss_kb"] is None else f'{r["rss_kb"] // 1024} MB'
+    print(f'{r["fixture"]:<8} c={r["concurrency"]:<4} {r["rps"]:>9} req/s  p50 {r["p50_ms"]} ms'
+          f'  p99 {r["p99_ms"]} ms  errors {r["errors"]}  cpu {cpu}  rss {rss}')
+
+def compare(old, new, tolerance):
+    """
+    Print how 'new' does against 'old' and return the regressions, as
+    lines: lower req/s or MB/s, or higher p99, by more than 'tolerance'
+    percent.
+    """
+    regressions = []
+
+    def check(label, before, after, higher_is_better):
+        if not before or after is None:
+            return
+        change = (after - before) / before * 100
+        worse = -change if higher_is_better else change
+        mark = "  REGRESSION" if worse > tolerance else ""
+        line = f"{label:<36} {before:>12} -> {after:<12} {change:+.1f}%{mark}"
+        print(line)
+        if mark:
+            regressions.append(line)
+
+    old_runs = {(r["fixture"], r["concurrency"]): r for r in old.get("results", [])}
+    for r in new.get("results", []):
+        o = old_runs.get((r["fixture"], r["concurrency"]))
+        if o is None:
+            continue
+        label = f'{r["fixture"]} c={r["concurrency"]}'
+        check(label + " req/s", o["rps"], r["rps"], True)
+        check(label + " p99 ms", o["p99_ms"], r["p99_ms"], False)
+    old_micro = {m["name"]: m for m in old.get("micro", [])}
+    for m in new.get("micro", []):
+        o = old_micro.get(m["name"])
+        if o is None:
+            continue
+        for key in ("ops_per_s", "mb_per_s"):
+            if key in m and key in o:
+                check(f'{m["name"]} {key}', o[key], m[key], True)
+    return regressions
+
+def main(argv=()):
+    global DURATION, WARMUP
+    inputInfo = ('bench_proxy.py -c <CONCURRENCY LIST, e.g. 1,16,64> -t <SECONDS PER LEVEL> -w <WARMUP SECONDS>\n'
+                 '  -f <FIXTURES, any of ' + ",".join(FIXTURES) + '> -P <CLIENT PROCESSES> -o <RESULT FILE>\n'
+                 '  --proxy-args="<ARGS FOR fake_news_proxy.py>" --port=<USE A RUNNING PROXY>'
+                 ' --cacheable --no-micro --micro-only\n'
+                 '  --compare=<EARLIER RESULT FILE> --tolerance=<PERCENT>\n')
+    concurrency = CONCURRENCY
+    fixtures = list(FIXTURES)
+    processes = CLIENT_PROCESSES
+    out_path = None
+    proxy_args = []
+    external_port = None
+    cacheable = False
+    micro = True
+    load = True
+    compare_path = None
+    tolerance = TOLERANCE
+    try:
+        opts, args = getopt.getopt(argv, "c:t:w:f:P:o:", ["proxy-args=", "port=", "cacheable", "no-micro",
+                                                          "micro-only", "compare=", "tolerance="])
+        for opt, arg in opts:
+            if opt == "-c":
+                concurrency = [int(c) for c in arg.split(",")]
+            elif opt == "-t":
+                DURATION = float(arg)
+            elif opt == "-w":
+                WARMUP = float(arg)
+            elif opt == "-f":
+                fixtures = arg.split(",")
+                for name in fixtures:
+                    if name not in FIXTURES:
+                        raise ValueError(name)
+            elif opt == "-P":
+                processes = int(arg)
+            elif opt == "-o":
+                out_path = arg
+            elif opt == "--proxy-args":
+                proxy_args = shlex.split(arg)
+            elif opt == "--port":
+                external_port = int(arg)
+            elif opt == "--cacheable":
+                cacheable = True
+            elif opt == "--no-micro":
+                micro = False
+            elif opt == "--micro-only":
+                load = False
+            elif opt == "--compare":
+                compare_path = arg
+            elif opt == "--tolerance":
+                tolerance = float(arg)
+    except (getopt.GetoptError, ValueError):
+        print(inputInfo)
+        sys.exit(2)
+
+    old = None
+    if compare_path:
+        try:
+            with open(compare_path) as f:
+                old = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Could not read {compare_path}: {e}")
+            sys.exit(2)
+
+    report = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "proxy_args": proxy_args,
+        "duration": DURATION,
+        "warmup": WARMUP,
+        "client_processes": processes,
+        "cacheable": cacheable,
+        "results": [],
+        "micro": [],
+    }
+
+    if micro:
+        for m in run_micro():
+            rate = f'{m["ops_per_s"]} ops/s' if "ops_per_s" in m else f'{m["mb_per_s"]} MB/s'
+            print(f'{m["name"]:<20} {rate}')
+            report["micro"].append(m)
+
+    if load:
+        origin, origin_port = start_origin(cacheable)
+        proxy = None
+        try:
+            if external_port is None:
+                proxy, proxy_port = start_proxy(proxy_args)
+            else:
+                proxy_port = external_port
+            for fixture in fixtures:
+                for level in concurrency:
+                    r = run_level(proxy_port, origin_port, fixture, level, processes, WARMUP, DURATION,
+                                  proxy.pid if proxy else None)
+                    print_result(r)
+                    report["results"].append(r)
+        finally:
+            if proxy is not None:
+                stop_proxy(proxy)
+            origin.terminate()
+
+    if out_path is None:
+        out_path = time.strftime("bench-%Y%m%d-%H%M%S.json")
+    with open(out_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {out_path}")
+
+    if old is not None:
+        print(f"\nCompared with {compare_path} (revision {old.get('revision')}):")
+        if compare(old, report, tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
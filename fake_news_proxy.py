@@ -1,367 +1,722 @@
 #!/usr/bin/env python3
 import socket
 import threading
+import asyncio
+import getopt
 import sys
+import json
+import collections
+import time
+import os
+import select
+import signal
+import traceback
+
+import proxy_async
+import proxy_cache
+import proxy_codings
+import proxy_logging
+import proxy_pipeline
+import proxy_rewrite
+import proxy_tunnel
+import proxy_upstream
+from proxy_async import AsyncProxyServer
+from proxy_cache import (CACHE_MAX_BYTES, CACHE_MAX_ENTRY_BYTES, SINGLE_FLIGHT_TIMEOUT,
+                         ResponseCache, SINGLE_FLIGHT)
+from proxy_codings import response_body, send_body, record_forwarded
+from proxy_http import SocketReader, HeaderTooLarge, read_http_headers, forward_raw
+from proxy_logging import (LOG_LEVEL, LOG_LEVELS, LOG, begin_access, end_access, start_logging,
+                           restart_logging, flush_logs, logs_dropped, CONNECTION_IDS, note_upstream,
+                           start_capture)
+from proxy_metrics import (Recorder, merge_metrics, METRICS, answer_admin, admin_socket,
+                           start_admin_server, Stats, STATS, aggregate_stats, format_stats)
+from proxy_pipeline import (CLIENT_IDLE_TIMEOUT, MAX_REQUESTS_PER_CONNECTION, CLIENT_WRITE_TIMEOUT,
+                            DRAINING, WORKER_DRAIN_TIMEOUT, listen_socket, parse_request,
+                            cached_response, join_flight, shared_response, land_flight,
+                            upstream_request, plan_response, finish_response, send_http_error,
+                            discard_body, serve_local_image)
+from proxy_rewrite import REWRITE_RULES_PATH, load_rules, RewriteMemo
+from proxy_tunnel import handle_connect
+from proxy_upstream import DnsCache, UpstreamConnector, UPSTREAM_POOL
+
 #code made by melgu374 and antfo614
-# TROLL_IMAGE_PATH: local file we serve when "Smiley.jpg" is requested
-TROLL_IMAGE_PATH = "trolly.jpg"
 
 # The port on which our proxy will listen
 PROXY_PORT = 8001
 
-def read_http_headers(sock):
-    """
-    Reads HTTP headers from 'sock', stopping at the first blank line.
-    Returns a list of decoded lines (header lines).
-    Returns an empty list if socket closes before any headers are read.
-    """
-    headers = []
-    while True:
-        line = read_line(sock)
-        if not line:
-            break
-        stripped = line.strip('\r\n')
-        if stripped == "":
-            break
-        headers.append(stripped)
-    return headers
-
-def read_line(sock):
-    """
-    Read one line (until '\n') from the socket or return None if EOF.
-    """
-    data = bytearray()
-    while True:
-        chunk = sock.recv(1)
-        if not chunk:
-            if len(data) == 0:
-                return None
-            break
-        data += chunk
-        if data.endswith(b'\n'):
-            break
-    return data.decode('utf-8', errors='replace')
-
-def forward_raw(sock_in, sock_out, length=None):
+# Admission control. The threaded engine serves at most MAX_CONNECTIONS
+# clients at once (one thread each); up to ADMISSION_QUEUE more wait for a
+# slot, for ADMISSION_QUEUE_TIMEOUT seconds at most, and anything beyond
+# that gets a 503 straight away.
+MAX_CONNECTIONS = 1024
+ADMISSION_QUEUE = 256
+
+# Worker processes (-w <N>, 0 for one per CPU): the delay before starting
+# again a worker that died right after starting, and how often workers
+# send their counters to the supervisor.
+WORKER_RESTART_DELAY = 1.0
+STATS_INTERVAL = 1.0
+
+def handle_client(client_conn, client_addr):
     """
-    Forward raw bytes from sock_in to sock_out.
-    If length is specified, read exactly that many bytes.
-    Otherwise, read until EOF from sock_in.
+    Serve requests on one client connection until the client closes it,
+    it has been idle for CLIENT_IDLE_TIMEOUT seconds or it has made
+    MAX_REQUESTS_PER_CONNECTION requests. Pipelined requests are read from
+    the buffered reader and answered in order.
     """
-    BUFSIZE = 4096
-    if length is not None:
-        remaining = length
-        while remaining > 0:
-            chunk = sock_in.recv(min(BUFSIZE, remaining))
-            if not chunk:
+    LOG.debug("[%s] Handling new connection.", client_addr)
+    # heads and bodies go out in separate sends; with Nagle on, a small body
+    # waits for the client's delayed ACK of the head (~40 ms). asyncio
+    # transports already set this.
+    client_conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    client_reader = SocketReader(client_conn)
+    connection = next(CONNECTION_IDS)
+    served = 0
+    STATS.incr("connections")
+    STATS.incr("active_connections")
+    try:
+        while served < MAX_REQUESTS_PER_CONNECTION and not DRAINING.is_set():
+            # 1) Wait for the next request, then read its headers from the
+            # client against a deadline
+            client_conn.settimeout(CLIENT_IDLE_TIMEOUT)
+            try:
+                if not client_reader.buf and not client_reader.fill():
+                    break
+            except socket.timeout:
+                LOG.debug("[%s] Idle timeout.", client_addr)
                 break
-            sock_out.sendall(chunk)
-            remaining -= len(chunk)
-    else:
-        while True:
-            chunk = sock_in.recv(BUFSIZE)
-            if not chunk:
+            started = time.monotonic()
+            client_reader.deadline = started + proxy_pipeline.HEADER_READ_TIMEOUT
+            try:
+                request_line, request_fields = read_http_headers(client_reader)
+            except socket.timeout:
+                client_conn.settimeout(CLIENT_WRITE_TIMEOUT)
+                send_http_error(client_conn, 408, "Request Timeout")
+                LOG.info("[%s] Request headers too slow.", client_addr)
                 break
-            sock_out.sendall(chunk)
-
-def handle_client(client_conn, client_addr):
-    print(f"[{client_addr}] Handling new connection.")
-
-    # 1) Read request headers from the client
-    request_headers = read_http_headers(client_conn)
-    if not request_headers:
+            except HeaderTooLarge:
+                client_conn.settimeout(CLIENT_WRITE_TIMEOUT)
+                send_http_error(client_conn, 431, "Request Header Fields Too Large")
+                LOG.info("[%s] Request headers too large.", client_addr)
+                break
+            finally:
+                client_reader.deadline = None
+            if request_line is None:
+                break
+            client_conn.settimeout(CLIENT_WRITE_TIMEOUT)
+            served += 1
+            STATS.incr("requests")
+            parsed = time.monotonic()
+            METRICS.observe("headers", parsed - started)
+            last = served >= MAX_REQUESTS_PER_CONNECTION or DRAINING.is_set()
+            access = begin_access(client_addr, connection, request_line, request_fields, started)
+            try:
+                keep_alive = handle_request(client_conn, client_reader, client_addr,
+                                            request_line, request_fields, last)
+            finally:
+                end_access(access)
+            METRICS.observe("total", time.monotonic() - parsed)
+            if not keep_alive:
+                break
+    except OSError as e:
+        LOG.info("[%s] Connection error: %s", client_addr, e)
+    finally:
         client_conn.close()
-        print(f"[{client_addr}] No request received. Connection closed.")
-        return
+        STATS.incr("active_connections", -1)
+        METRICS.release()
+    LOG.debug("[%s] Done after %d request(s). Connection closed.", client_addr, served)
 
-    # 2) Parse the first request line
-    request_line = request_headers[0]
-    method, url_or_path, http_version = parse_request_line(request_line)
-    if method is None:
-        send_http_error(client_conn, 400, "Bad Request")
-        client_conn.close()
-        print(f"[{client_addr}] Malformed request line. Connection closed.")
-        return
+def serve_threaded(port, reuse_port=False):
+    """
+    Accept loop of the threaded engine: one thread per client connection.
+    Returns once SIGTERM has been received and open connections are done.
+    """
+    proxy_socket = listen_socket(port, reuse_port)
+    LOG.info("[MAIN] Proxy listening on port %d...", port)
+    signal.signal(signal.SIGTERM, lambda signum, frame: DRAINING.set())
+
+    # wake up now and then to notice DRAINING
+    proxy_socket.settimeout(1.0)
+    admission = Admission(MAX_CONNECTIONS, ADMISSION_QUEUE, proxy_pipeline.ADMISSION_QUEUE_TIMEOUT)
+    while not DRAINING.is_set():
+        try:
+            client_conn, client_addr = proxy_socket.accept()
+        except socket.timeout:
+            continue
+        if not admission.enter():
+            shed_connection(client_conn, client_addr)
+            continue
+        t = threading.Thread(target=admitted_client, args=(admission, client_conn, client_addr))
+        t.daemon = True
+        t.start()
+    proxy_socket.close()
+    wait_drained()
 
-    # 3) Convert remaining headers into a dict (lowercase keys)
-    header_dict = {}
-    for h in request_headers[1:]:
-        parts = h.split(":", 1)
-        if len(parts) == 2:
-            k, v = parts[0].strip(), parts[1].strip()
-            header_dict[k.lower()] = v
-
-    # 4) Extract the host, port, and the actual path (stripping "http://...")
-    remote_host, remote_port, path = extract_host_port_path(url_or_path, header_dict)
-    print(f"[DEBUG] remote_host={remote_host}, remote_port={remote_port}, path={path}")
-
-    # 5) Only handle GET
-    if method.upper() != "GET":
-        send_http_error(client_conn, 501, "Not Implemented")
-        client_conn.close()
-        print(f"[{client_addr}] Method {method} not supported.")
+class Admission(object):
+    """
+    At most max_active connections are served at once; up to max_queued
+    more wait (in their own thread) for a slot, others are turned away.
+    """
+
+    def __init__(self, max_active, max_queued, timeout):
+        self.slots = threading.Semaphore(max_active)
+        self.limit = max_active + max_queued
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.admitted = 0   # served or waiting
+
+    def enter(self):
+        with self.lock:
+            if self.admitted >= self.limit:
+                return False
+            self.admitted += 1
+            return True
+
+    def wait(self):
+        """
+        Wait for a slot; False if none came free in time (and the
+        connection has left).
+        """
+        if self.slots.acquire(timeout=self.timeout):
+            return True
+        self.leave(False)
+        return False
+
+    def leave(self, served=True):
+        if served:
+            self.slots.release()
+        with self.lock:
+            self.admitted -= 1
+
+def admitted_client(admission, client_conn, client_addr):
+    if not admission.wait():
+        shed_connection(client_conn, client_addr)
         return
+    try:
+        handle_client(client_conn, client_addr)
+    finally:
+        admission.leave()
 
-    # 6) Special case: If path ends with "Smiley.jpg", serve local troll image
-    if path.lower().endswith("smiley.jpg"):
-        serve_local_image(client_conn, http_version, TROLL_IMAGE_PATH)
+def shed_connection(client_conn, client_addr):
+    """
+    Turn a connection away with a 503 when we are full.
+    """
+    STATS.incr("shed")
+    LOG.warning("[%s] Overloaded, sending 503.", client_addr)
+    try:
+        client_conn.settimeout(1.0)
+        send_http_error(client_conn, 503, "Service Unavailable")
+        # take in what the client already sent, or closing resets the
+        # connection and the 503 may never be read
+        client_conn.recv(65536, socket.MSG_DONTWAIT)
+    except OSError:
+        pass
+    finally:
         client_conn.close()
-        print(f"[{client_addr}] Served troll image for Smiley.jpg request.")
-        return
 
-    # 7) Build a new request to send to the remote server (FORCE CONNECTION: CLOSE)
-    out_headers = []
-    out_headers.append(f"{method} {path} HTTP/1.1")
-    out_headers.append(f"Host: {remote_host}")
-    out_headers.append("Connection: close")
+def handle_request(client_conn, client_reader, client_addr, request_line, request_fields, last=False):
+    """
+    Answer one request. Returns True if the client connection can be used
+    for another request. The decisions are taken by the helpers shared
+    with the asyncio engine (parse_request, cached_response, join_flight,
+    plan_response, finish_response); only the I/O is done here.
+    """
+    # 2-5) Parse the request line and headers
+    request, error = parse_request(request_line, request_fields, client_addr, last)
+    if error is not None:
+        send_http_error(client_conn, *error)
+        return False
 
-    for line in request_headers[1:]:
-        lower = line.lower()
-        if lower.startswith("host:"):
-            continue
-        elif lower.startswith("proxy-connection"):
-            continue
-        elif lower.startswith("connection"):
-            continue
-        else:
-            out_headers.append(line)
+    # 2b) CONNECT turns the connection into a tunnel
+    if request.method == "CONNECT":
+        handle_connect(client_conn, client_reader, client_addr, request.target, request.http_version)
+        return False
 
-    out_req = "\r\n".join(out_headers) + "\r\n\r\n"
+    # 6) Special case: If path ends with "Smiley.jpg", serve local troll image
+    if request.local_image is not None:
+        discard_body(client_reader, request.body_length)
+        serve_local_image(client_conn, request.http_version, request.local_image, request.keep_alive)
+        LOG.debug("[%s] Served troll image for Smiley.jpg request.", client_addr)
+        return request.keep_alive
+
+    # 6b) Answer from the cache if we have a fresh copy
+    response = cached_response(request)
+    if response is not None:
+        client_conn.sendall(response)
+        LOG.debug("[%s] Cache hit for %s.", client_addr, request.path)
+        return request.keep_alive
+
+    # 6c) Identical GETs that are already being fetched wait for that fetch
+    flight = join_flight(request, SINGLE_FLIGHT)
+    if flight is not None:
+        response = shared_response(request, flight.wait(SINGLE_FLIGHT_TIMEOUT))
+        if response is not None:
+            client_conn.sendall(response)
+            LOG.debug("[%s] Shared in-flight response for %s.", client_addr, request.path)
+            return request.keep_alive
 
-    # 8) Connect to remote server
     try:
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.connect((remote_host, remote_port))
-    except Exception as e:
-        print(f"[{client_addr}] Could not connect to {remote_host}:{remote_port} - {e}")
-        send_http_error(client_conn, 502, "Bad Gateway")
-        client_conn.close()
-        return
-
-    print("[DEBUG] Outgoing request to server:\n" + out_req)
-    server_socket.sendall(out_req.encode('utf-8'))
-
-    # 9) Read the response headers from the server
-    response_headers = read_http_headers(server_socket)
-    if not response_headers:
-        server_socket.close()
-        client_conn.close()
-        print(f"[{client_addr}] Server closed without sending headers.")
-        return
+        # 7-9) Send the request on a pooled connection and read the response headers
+        out_req = upstream_request(request)
+        LOG.debug("Outgoing request to server:\n%s", out_req)
+        try:
+            upstream = open_upstream(request.host, request.port, out_req, client_reader,
+                                     request.body_length, client_addr)
+        except socket.timeout:
+            LOG.warning("[%s] Timed out waiting for %s:%s.", client_addr, request.host, request.port)
+            send_http_error(client_conn, 504, "Gateway Timeout")
+            return False
+        if upstream is None:
+            send_http_error(client_conn, 502, "Bad Gateway")
+            return False
+        server_reader, resp_status_line, response_fields = upstream
+        note_upstream(resp_status_line, response_fields)
+        reusable = False
 
-    resp_status_line = response_headers[0]
-    resp_header_dict = {}
-    for h in response_headers[1:]:
-        parts = h.split(":", 1)
-        if len(parts) == 2:
-            k = parts[0].strip().lower()
-            v = parts[1].strip()
-            resp_header_dict[k] = v
-
-    # 10) Check for content-length, chunked, etc.
-    content_length = None
-    is_chunked = False
-    content_encoding = resp_header_dict.get("content-encoding", "").lower()
-    content_type = resp_header_dict.get("content-type", "").lower()
-
-    if "content-length" in resp_header_dict:
         try:
-            content_length = int(resp_header_dict["content-length"])
-        except:
-            content_length = None
+            # 10) Decide on framing, rewriting and caching, send the head
+            plan = plan_response(request, resp_status_line, response_fields)
+            client_conn.sendall(plan.head)
+
+            # 11) Either do text replacements while streaming, or forward raw
+            decoder = None
+            if plan.raw:
+                moved = forward_raw(server_reader, client_conn, plan.content_length)
+                record_forwarded(moved, plan.content_length)
+            elif plan.has_body:
+                chunks, decoder = response_body(server_reader, plan.content_length, plan.is_chunked)
+                send_body(chunks, client_conn, plan.mode == "chunked", plan.stages, decoder)
+            reusable = finish_response(request, plan, decoder)
+            if proxy_cache.RESPONSE_CACHE is not None:
+                proxy_cache.RESPONSE_CACHE.write_spills()
+            return request.keep_alive
+        finally:
+            # 12) Hand the server connection back to the pool (or close it)
+            UPSTREAM_POOL.release(request.host, request.port, server_reader, reusable)
+    finally:
+        land_flight(request)
+
+def open_upstream(remote_host, remote_port, out_req, client_reader, request_body_length, client_addr):
+    """
+    Send 'out_req' on a pooled connection and read the response headers.
+    If a pooled connection turns out to be stale (the server closed it while
+    it sat idle) the GET is retried once on a fresh connection, unless it
+    had a request body we cannot send again.
+    Returns (server_reader, resp_status_line, response_fields) or None;
+    raises socket.timeout if the server is too slow to connect or answer.
+    """
+    for attempt in range(2):
+        try:
+            server_reader, reused = UPSTREAM_POOL.checkout(remote_host, remote_port)
+        except socket.timeout:
+            raise
+        except OSError as e:
+            LOG.warning("[%s] Could not connect to %s:%s - %s", client_addr, remote_host, remote_port, e)
+            return None
+        try:
+            started = time.monotonic()
+            server_reader.sock.sendall(out_req)
+            if request_body_length:
+                forward_raw(client_reader, server_reader.sock, request_body_length)
+            resp_status_line, response_fields = read_http_headers(server_reader)
+            METRICS.observe("first_byte", time.monotonic() - started)
+        except socket.timeout:
+            UPSTREAM_POOL.release(remote_host, remote_port, server_reader, False)
+            raise
+        except OSError:
+            resp_status_line, response_fields = None, []
+        if resp_status_line is not None:
+            return server_reader, resp_status_line, response_fields
+        UPSTREAM_POOL.release(remote_host, remote_port, server_reader, False)
+        if not reused or request_body_length:
+            LOG.warning("[%s] Server closed without sending headers.", client_addr)
+            return None
+        LOG.debug("[%s] Pooled connection to %s:%s was stale, retrying.", client_addr, remote_host, remote_port)
+    return None
+
+# ***************** WORKER PROCESSES *****************
+# With -w the proxy runs as a supervisor forking N workers; each binds
+# PROXY_PORT itself with SO_REUSEPORT, so the kernel spreads connections
+# over them and each has its own interpreter (and GIL). A worker that
+# dies is started again. SIGTERM makes every process stop accepting and
+# finish the requests it has before exiting. Workers write their counters
+# to a pipe every STATS_INTERVAL seconds; SIGUSR1 makes the supervisor
+# print the sum.
+
+def stats_snapshot(flights=None):
+    """
+    STATS plus the counters the caches, the connector and the log writers
+    keep themselves.
+    """
+    counts = STATS.snapshot()
+    if proxy_cache.RESPONSE_CACHE is not None:
+        counts["cache_hits"] = proxy_cache.RESPONSE_CACHE.hits
+        counts["cache_misses"] = proxy_cache.RESPONSE_CACHE.misses
+    if proxy_rewrite.REWRITE_MEMO is not None:
+        counts["rewrite_memo_hits"] = proxy_rewrite.REWRITE_MEMO.hits
+        counts["rewrite_memo_misses"] = proxy_rewrite.REWRITE_MEMO.misses
+    counts["dns_cache_hits"] = proxy_upstream.UPSTREAM_CONNECTOR.dns.hits
+    counts["dns_cache_misses"] = proxy_upstream.UPSTREAM_CONNECTOR.dns.misses
+    counts["coalesced"] = (flights or SINGLE_FLIGHT).coalesced
+    counts["log_lines_dropped"] = logs_dropped()
+    return counts
+
+def write_stats(fd, flights=None):
+    """
+    Send this worker's counters and metrics to the supervisor as one JSON
+    line.
+    """
+    line = {"stats": stats_snapshot(flights), "metrics": METRICS.snapshot()}
+    os.write(fd, json.dumps(line).encode('utf-8') + b"\n")
 
-    if ("transfer-encoding" in resp_header_dict and
-        "chunked" in resp_header_dict["transfer-encoding"].lower()):
-        is_chunked = True
+def start_stats_reporter(fd, flights=None):
+    """
+    Report every STATS_INTERVAL seconds until the supervisor goes away.
+    """
+    def report():
+        while True:
+            try:
+                write_stats(fd, flights)
+            except OSError:
+                return
+            time.sleep(STATS_INTERVAL)
+    t = threading.Thread(target=report)
+    t.daemon = True
+    t.start()
+
+def wait_drained(timeout=WORKER_DRAIN_TIMEOUT):
+    """
+    After the listening socket is closed: wait for open client connections
+    to finish (idle keep-alive ones end at CLIENT_IDLE_TIMEOUT at the latest).
+    """
+    deadline = time.time() + timeout
+    while STATS.counts["active_connections"] > 0 and time.time() < deadline:
+        time.sleep(0.1)
 
-    # 11) Reconstruct response headers (FORCE CONNECTION: CLOSE in response)
-    out_resp_headers = []
-    out_resp_headers.append(resp_status_line)
+def run_worker(index, use_async, stats_fd, cache_bytes, spill_dir):
+    """
+    Body of a forked worker process. Returns its exit status.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)    # the supervisor sends SIGTERM
+    signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+    restart_logging()
+    if cache_bytes > 0:
+        proxy_cache.RESPONSE_CACHE = ResponseCache(
+            cache_bytes, min(CACHE_MAX_ENTRY_BYTES, cache_bytes),
+            os.path.join(spill_dir, f"worker-{index}") if spill_dir else None)
+    server = None
+    if use_async:
+        server = AsyncProxyServer(PROXY_PORT, max_active=proxy_async.ASYNC_MAX_ACTIVE, reuse_port=True)
+    start_stats_reporter(stats_fd, server.flights if server else None)
+    try:
+        if server:
+            asyncio.run(server.serve())
+        else:
+            serve_threaded(PROXY_PORT, reuse_port=True)
+    except OSError as e:
+        LOG.error("[WORKER %d] %s", index, e)
+        return 1
+    try:
+        write_stats(stats_fd, server.flights if server else None)
+    except OSError:
+        pass
+    return 0
 
-    skip_headers = {"transfer-encoding", "connection"}
-    for k, v in resp_header_dict.items():
-        if k in skip_headers:
-            continue
-        if k == "content-length":
-           
-            continue
-        out_resp_headers.append(f"{k}: {v}")
+class Supervisor(object):
+    """
+    Forks the worker processes, starts again the ones that die and adds
+    up their counters.
+    """
 
-    out_resp_headers.append("Connection: close")
+    def __init__(self, workers, use_async, cache_bytes, spill_dir, admin=None):
+        self.workers = workers
+        self.admin = admin      # listening socket for /metrics, or None
+        self.use_async = use_async
+        self.cache_bytes = cache_bytes
+        self.spill_dir = spill_dir
+        self.procs = {}         # pid -> [index, start time, stats pipe, unread bytes]
+        self.snapshots = {}     # index -> last stats and metrics of the live worker
+        self.retired = collections.Counter()
+        self.retired_metrics = Recorder().snapshot()
+        self.restarts = []      # (when, index)
+        self.restarted = 0
+        self.stopping = False
+        self.kill_at = None
+
+    def spawn(self, index):
+        rfd, wfd = os.pipe()
+        # nothing half written for the child to write again
+        flush_logs()
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                os.close(rfd)
+                for proc in self.procs.values():
+                    os.close(proc[2])
+                if self.admin is not None:
+                    self.admin.close()
+                status = run_worker(index, self.use_async, wfd, self.cache_bytes, self.spill_dir)
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                flush_logs()
+                sys.stdout.flush()
+                os._exit(status)
+        os.close(wfd)
+        self.procs[pid] = [index, time.time(), rfd, b""]
+        LOG.info("[SUPERVISOR] Started worker %d (pid %d).", index, pid)
+
+    def stats(self):
+        stats = aggregate_stats([s["stats"] for s in self.snapshots.values()], self.retired)
+        stats["workers"] = len(self.procs)
+        stats["worker_restarts"] = self.restarted
+        return stats
+
+    def metrics(self):
+        return merge_metrics([self.retired_metrics] + [s["metrics"] for s in self.snapshots.values()])
+
+    def read_stats(self, proc):
+        """
+        Read from a worker's stats pipe, keeping its latest full line.
+        Returns False at EOF.
+        """
+        data = os.read(proc[2], 65536)
+        if not data:
+            return False
+        proc[3] += data
+        *lines, proc[3] = proc[3].split(b"\n")
+        if lines:
+            try:
+                self.snapshots[proc[0]] = json.loads(lines[-1])
+            except ValueError:
+                pass
+        return True
 
-    # 12) Either do text replacements or forward raw
-    body_data = b""
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            proc = self.procs.pop(pid)
+            index, started, rfd, _ = proc
+            # pick up the last line it wrote before exiting
+            while select.select([rfd], [], [], 0)[0] and self.read_stats(proc):
+                pass
+            os.close(rfd)
+            last = self.snapshots.pop(index, None)
+            if last:
+                self.retired.update({k: v for k, v in last["stats"].items() if k not in Stats.GAUGES})
+                self.retired_metrics = merge_metrics([self.retired_metrics, last["metrics"]])
+            if self.stopping:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            LOG.warning("[SUPERVISOR] Worker %d (pid %d) exited with status %d, restarting.", index, pid, code)
+            self.restarted += 1
+            # a worker that dies right after starting is not restarted in a tight loop
+            delay = WORKER_RESTART_DELAY if time.time() - started < WORKER_RESTART_DELAY else 0
+            self.restarts.append((time.time() + delay, index))
+
+    def stop(self, signum=None, frame=None):
+        if not self.stopping:
+            LOG.info("[SUPERVISOR] Draining workers...")
+            self.stopping = True
+            self.restarts = []
+            self.kill_at = time.time() + WORKER_DRAIN_TIMEOUT + 5
+            for pid in self.procs:
+                os.kill(pid, signal.SIGTERM)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGUSR1, lambda signum, frame: LOG.info("[SUPERVISOR] %s", format_stats(self.stats())))
+        for index in range(self.workers):
+            self.spawn(index)
+        while self.procs or not self.stopping:
+            pipes = {proc[2]: proc for proc in self.procs.values()}
+            admin = [self.admin] if self.admin is not None else []
+            for fd in select.select(list(pipes) + admin, [], [], 0.5)[0]:
+                if fd is self.admin:
+                    conn, _ = self.admin.accept()
+                    answer_admin(conn, lambda: (self.stats(), self.metrics()))
+                else:
+                    self.read_stats(pipes[fd])
+            self.reap()
+            now = time.time()
+            if self.stopping and now > self.kill_at:
+                for pid in self.procs:
+                    os.kill(pid, signal.SIGKILL)
+            for when, index in [r for r in self.restarts if r[0] <= now]:
+                self.restarts.remove((when, index))
+                self.spawn(index)
+        LOG.info("[SUPERVISOR] Stopped. %s", format_stats(self.stats()))
+
+def main(argv=()):
+    global PROXY_PORT, MAX_CONNECTIONS
+    inputInfo = ('fake_news_proxy.py -p <PORT (int)> -r <RULES FILE> -c <CACHE MB (int)>'
+                 ' -d <CACHE SPILL DIR> -z <GZIP LEVEL 1-9> -w <WORKERS (int, 0 = per CPU)>'
+                 ' -m <METRICS PORT (int)> -l <LOG LEVEL debug|info|warning|error> [-a]\n'
+                 '  --backlog=<int> --max-connections=<int> --queue-timeout=<s> --header-timeout=<s>'
+                 ' --connect-timeout=<s> --read-timeout=<s> --dns-ttl=<s> --negative-ttl=<s>\n'
+                 '  --log-file=<path> --access-log=<path> --access-sample=<0-1> --capture=<path>\n'
+                 '  --connect-ports=<port,...> --tunnel-timeout=<s> --rewrite-memo=<MB (int)>\n')
+    rules_path = REWRITE_RULES_PATH
+    cache_bytes = CACHE_MAX_BYTES
+    spill_dir = None
+    log_level = LOG_LEVEL
+    log_path = None
+    access_path = None
+    capture_path = None
+    try:
+        opts, args = getopt.getopt(argv, "ap:r:c:d:z:w:m:l:", ["async", "port=", "rules=", "cache=", "cache-dir=",
+                                                        "gzip-level=", "workers=", "metrics-port=", "backlog=",
+                                                      "max-connections=", "queue-timeout=",
+                                                      "header-timeout=", "connect-timeout=",
+                                                      "read-timeout=", "log-level=", "log-file=",
+                                                      "access-log=", "access-sample=", "capture=",
+                                                      "connect-ports=", "tunnel-timeout=", "rewrite-memo=",
+                                                      "dns-ttl=", "negative-ttl="])
+    except getopt.GetoptError:
+        print(inputInfo)
+        sys.exit(2)
+    use_async = False
+    workers = None
+    admin_port = None
+    try:
+        for opt, arg in opts:
+            if opt in ("-a", "--async"):
+                use_async = True
+            elif opt in ("-p", "--port"):
+                PROXY_PORT = int(arg)
+            elif opt in ("-r", "--rules"):
+                rules_path = arg
+            elif opt in ("-c", "--cache"):
+                cache_bytes = int(arg) * 1024 * 1024
+            elif opt in ("-d", "--cache-dir"):
+                spill_dir = arg
+            elif opt in ("-z", "--gzip-level"):
+                proxy_codings.COMPRESS_LEVEL = int(arg)
+                if not 1 <= proxy_codings.COMPRESS_LEVEL <= 9:
+                    raise ValueError(arg)
+            elif opt in ("-w", "--workers"):
+                workers = int(arg)
+                if workers < 0:
+                    raise ValueError(arg)
+            elif opt in ("-m", "--metrics-port"):
+                admin_port = int(arg)
+            elif opt == "--backlog":
+                proxy_pipeline.LISTEN_BACKLOG = int(arg)
+            elif opt == "--max-connections":
+                # active requests for the asyncio engine, connections for the threaded one
+                MAX_CONNECTIONS = proxy_async.ASYNC_MAX_ACTIVE = int(arg)
+            elif opt == "--queue-timeout":
+                proxy_pipeline.ADMISSION_QUEUE_TIMEOUT = float(arg)
+            elif opt == "--header-timeout":
+                proxy_pipeline.HEADER_READ_TIMEOUT = float(arg)
+            elif opt == "--connect-timeout":
+                proxy_upstream.UPSTREAM_CONNECT_TIMEOUT = float(arg)
+            elif opt == "--read-timeout":
+                proxy_upstream.UPSTREAM_READ_TIMEOUT = float(arg)
+            elif opt == "--dns-ttl":
+                proxy_upstream.DNS_CACHE_TTL = float(arg)
+            elif opt == "--negative-ttl":
+                proxy_upstream.NEGATIVE_CACHE_TTL = float(arg)
+            elif opt in ("-l", "--log-level"):
+                log_level = arg.lower()
+                if log_level not in LOG_LEVELS:
+                    raise ValueError(arg)
+            elif opt == "--log-file":
+                log_path = arg
+            elif opt == "--access-log":
+                access_path = arg
+            elif opt == "--capture":
+                capture_path = arg
+            elif opt == "--connect-ports":
+                proxy_tunnel.CONNECT_PORTS = {int(port) for port in arg.split(",") if port.strip()}
+            elif opt == "--tunnel-timeout":
+                proxy_tunnel.TUNNEL_IDLE_TIMEOUT = float(arg)
+            elif opt == "--rewrite-memo":
+                memo_bytes = int(arg) * 1024 * 1024
+                proxy_rewrite.REWRITE_MEMO = RewriteMemo(memo_bytes) if memo_bytes > 0 else None
+            elif opt == "--access-sample":
+                proxy_logging.ACCESS_LOG_SAMPLE = float(arg)
+                if not 0 <= proxy_logging.ACCESS_LOG_SAMPLE <= 1:
+                    raise ValueError(arg)
+    except ValueError:
+        print(inputInfo)
+        sys.exit(2)
+    dns_ttl, negative_ttl = proxy_upstream.DNS_CACHE_TTL, proxy_upstream.NEGATIVE_CACHE_TTL
+    proxy_upstream.UPSTREAM_CONNECTOR = UpstreamConnector(DnsCache(dns_ttl, negative_ttl), negative_ttl)
 
-    # -- only replacements if not chunked, no encoding, and "text" in content_type
-    if (not is_chunked) and (content_encoding == "") and ("text" in content_type):
-        if content_length is not None:
-            body_data = read_exact(server_socket, content_length)
-        else:
-            body_data = read_until_eof(server_socket)
+    try:
+        start_logging(LOG_LEVELS[log_level], log_path, access_path)
+        if capture_path:
+            start_capture(capture_path)
+    except OSError as e:
+        print(f"Could not open the log file: {e}")
+        sys.exit(1)
 
+    try:
+        proxy_rewrite.RULES = load_rules(rules_path)
+    except (ValueError, KeyError, TypeError) as e:
+        LOG.error("Bad rewrite rules in %s: %s", rules_path, e)
+        sys.exit(2)
+    LOG.info("[MAIN] Loaded %d rewrite rules (version %s).", len(proxy_rewrite.RULES.patterns),
+             proxy_rewrite.RULES.version)
+
+    if workers is not None:
+        if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+            LOG.error("Worker processes need fork() and SO_REUSEPORT.")
+            sys.exit(2)
+        # fail here rather than in every worker when the port is taken
         try:
-            text_str = body_data.decode('utf-8', errors='replace')
-
-            #special case, so that the spring picture in test 5 works, update: it does not still :(
-            special_img = '<img src="./Stockholm-spring.jpg" alt="Stockholm?" width="400" height="300">'
-            placeholder = "___MY_SPECIAL_IMG___"
-            #maybe do something  path.lower().endswith(".png") or path.lower().endswith(".jpg"): like this instead in the chunked part and foward raw if if it matches?
-            
-            text_str = text_str.replace(special_img, placeholder)
+            listen_socket(PROXY_PORT, reuse_port=True, listen=False).close()
+        except OSError as e:
+            LOG.error("Could not bind on port %d: %s", PROXY_PORT, e)
+            sys.exit(1)
+        admin = None
+        if admin_port:
+            try:
+                admin = admin_socket(admin_port)
+            except OSError as e:
+                LOG.error("Could not bind the metrics port %d: %s", admin_port, e)
+                sys.exit(1)
+            LOG.info("[SUPERVISOR] Metrics at http://127.0.0.1:%d/metrics", admin_port)
+        Supervisor(workers or os.cpu_count() or 1, use_async, cache_bytes, spill_dir, admin).run()
+        return
 
-            # replace
-            text_str = text_str.replace("Smiley", "Trolly")
-            text_str = text_str.replace("Stockholm", "Linköping")
+    if cache_bytes > 0:
+        proxy_cache.RESPONSE_CACHE = ResponseCache(cache_bytes, min(CACHE_MAX_ENTRY_BYTES, cache_bytes),
+                                                   spill_dir)
 
-            # back with original pic
-            text_str = text_str.replace(placeholder, special_img)
+    server = AsyncProxyServer(PROXY_PORT, max_active=proxy_async.ASYNC_MAX_ACTIVE) if use_async else None
+    if admin_port:
+        flights = server.flights if server else None
+        try:
+            start_admin_server(admin_port, lambda: (stats_snapshot(flights), METRICS.snapshot()))
+        except OSError as e:
+            LOG.error("Could not bind the metrics port %d: %s", admin_port, e)
+            sys.exit(1)
 
-            body_data = text_str.encode('utf-8')
-        except Exception:
+    if use_async:
+        try:
+            asyncio.run(server.serve())
+        except OSError as e:
+            LOG.error("Could not bind on port %d: %s", PROXY_PORT, e)
+            sys.exit(1)
+        except KeyboardInterrupt:
             pass
-
-        new_len = len(body_data)
-        out_resp_headers.append(f"Content-Length: {new_len}")
-    else:
-        # Forward raw
-        if is_chunked:
-            out_resp_headers.append("Transfer-Encoding: chunked")
-        elif content_length is not None:
-            out_resp_headers.append(f"Content-Length: {content_length}")
-
-    out_resp_headers.append("")
-    out_resp_headers_raw = "\r\n".join(out_resp_headers).encode('utf-8')
-    client_conn.sendall(out_resp_headers_raw)
-
-    if (not is_chunked) and (content_encoding == "") and ("text" in content_type):
-        client_conn.sendall(body_data)
-    else:
-        if content_length is not None:
-            forward_raw(server_socket, client_conn, content_length)
-        else:
-            forward_raw(server_socket, client_conn, None)
-
-    # 20) Close both sockets
-    server_socket.close()
-    client_conn.close()
-    print(f"[{client_addr}] Done. Connection closed.")
-
-def parse_request_line(line):
-    parts = line.split()
-    if len(parts) != 3:
-        return None, None, None
-    return parts[0], parts[1], parts[2]
-
-def extract_host_port_path(url_or_path, header_dict):
-    default_port = 80
-    if url_or_path.lower().startswith("http://"):
-        tmp = url_or_path[7:]
-        slash_pos = tmp.find('/')
-        if slash_pos == -1:
-            host_part = tmp
-            path_part = "/"
-        else:
-            host_part = tmp[:slash_pos]
-            path_part = tmp[slash_pos:]
-        if ':' in host_part:
-            host, port_str = host_part.split(':', 1)
-            try:
-                port = int(port_str)
-            except:
-                port = default_port
-        else:
-            host = host_part
-            port = default_port
-        return host, port, path_part
-    else:
-        host_header = header_dict.get("host", "")
-        host = host_header
-        port = default_port
-        if ':' in host_header:
-            h, p_str = host_header.split(':', 1)
-            host = h
-            try:
-                port = int(p_str)
-            except:
-                port = default_port
-        path_part = url_or_path
-        if not path_part.startswith("/"):
-            path_part = "/" + path_part
-        return host, port, path_part
-
-def send_http_error(sock, code, message):
-    body = f"<html><body><h2>{code} {message}</h2></body></html>"
-    resp = (
-        f"HTTP/1.1 {code} {message}\r\n"
-        "Content-Type: text/html\r\n"
-        f"Content-Length: {len(body)}\r\n"
-        "Connection: close\r\n\r\n"
-        f"{body}"
-    )
-    sock.sendall(resp.encode('utf-8'))
-
-def read_exact(sock, length):
-    data = b""
-    remaining = length
-    while remaining > 0:
-        chunk = sock.recv(remaining)
-        if not chunk:
-            break
-        data += chunk
-        remaining -= len(chunk)
-    return data
-
-def read_until_eof(sock):
-    data = b""
-    while True:
-        chunk = sock.recv(4096)
-        if not chunk:
-            break
-        data += chunk
-    return data
-
-def serve_local_image(client_sock, http_version, filepath):
-    try:
-        with open(filepath, "rb") as f:
-            img_data = f.read()
-        resp_headers = (
-            f"{http_version} 200 OK\r\n"
-            "Content-Type: image/jpeg\r\n"
-            f"Content-Length: {len(img_data)}\r\n"
-            "Connection: close\r\n"
-            "\r\n"
-        )
-        client_sock.sendall(resp_headers.encode('utf-8'))
-        client_sock.sendall(img_data)
-    except FileNotFoundError:
-        body = "<html><body><h2>404 Not Found</h2></body></html>"
-        resp = (
-            f"{http_version} 404 Not Found\r\n"
-            "Content-Type: text/html\r\n"
-            f"Content-Length: {len(body)}\r\n"
-            "Connection: close\r\n\r\n"
-            f"{body}"
-        )
-        client_sock.sendall(resp.encode('utf-8'))
-
-def main():
-    proxy_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    proxy_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        return
 
     try:
-        proxy_socket.bind(("0.0.0.0", PROXY_PORT))
-    except Exception as e:
-        print(f"Could not bind on port {PROXY_PORT}: {e}")
+        serve_threaded(PROXY_PORT)
+    except OSError as e:
+        LOG.error("Could not bind on port %d: %s", PROXY_PORT, e)
         sys.exit(1)
 
-    proxy_socket.listen(5)
-    print(f"[MAIN] Proxy listening on port {PROXY_PORT}...")
-
-    while True:
-        client_conn, client_addr = proxy_socket.accept()
-        t = threading.Thread(target=handle_client, args=(client_conn, client_addr))
-        t.daemon = True
-        t.start()
-
 if __name__ == "__main__":
-    main()
+    main(sys.argv[1:])
@@ -1,6 +1,5 @@
 #!/usr/bin/env python
-import tkinter as tk
-import tkinter.scrolledtext
+tk = None       # tkinter, imported when the first window is opened
 
 class GuiTextArea(object):
     myGUI = None
@@ -8,6 +7,11 @@ class GuiTextArea(object):
 
     # --------------------
     def __init__(self, title):
+        global tk
+        if tk is None:
+            import tkinter
+            import tkinter.scrolledtext
+            tk = tkinter
 
         # Create and set up the window
         self.myGUI = tk.Tk()
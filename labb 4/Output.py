@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+
+# ******************************************************************
+# Headless output sinks, used instead of a GuiTextArea window when the
+# simulator runs with -o null, stdout or file. They have the same
+# print/println methods, so routers do not need to know which they got.
+# ******************************************************************
+
+class NullOutput(object):
+    # --------------------
+    def print(self, s):
+        pass
+
+    def println(self, s=""):
+        pass
+
+
+class StreamOutput(object):
+    # Writes whole lines to a text stream, each one prefixed with 'prefix'
+    # so the output of every router can go to the same stream. A line made
+    # of several print calls is held back until its newline.
+
+    # --------------------
+    def __init__(self, stream, prefix=""):
+        self.stream = stream
+        self.prefix = prefix
+        self.partial = []
+
+    # --------------------
+    def print(self, s):
+        self.partial.append(s)
+        if "\n" not in s:
+            return
+        lines = "".join(self.partial).split("\n")
+        rest = lines.pop()
+        self.stream.write("".join(self.prefix + line + "\n" for line in lines))
+        self.partial = [rest] if rest else []
+
+    def println(self, s=""):
+        self.print(s + "\n")
@@ -1,27 +1,39 @@
 #!/usr/bin/env python
 # code by melgu374 and antfo614
-import GuiTextArea, RouterPacket, F
-from copy import deepcopy
+import RouterPacket, F
+from array import array
 from F import F
+try:
+    import numpy
+except ImportError:     # numpy behövs bara för -v
+    numpy = None
 
 class RouterNode():
     def __init__(self, ID, sim, costs):
         self.myID = ID
         self.sim = sim
-        self.myGUI = GuiTextArea.GuiTextArea(f"Output window for Router #{ID}")
+        self.myGUI = sim.newOutput(f"Output window for Router #{ID}", f"router {ID}")
 
-        self.costs = deepcopy(costs)
+        # cost vectors are array('i'); vectors received in packets are kept
+        # as they are (shared with the packet, never changed)
+        self.costs = array('i', costs)
        # Tidigare: self.neighbors = [i for i in range(len(costs)) if costs[i] != sim.INFINITY and costs[i] != 0]
         self.neighbors = [i for i in range(len(costs)) if i != self.myID and costs[i] != sim.INFINITY]
 
         self.linkcosts = {n: costs[n] for n in self.neighbors}
-        self.ncosts = {n: [sim.INFINITY]*sim.NUM_NODES for n in self.neighbors}
+        self.ncosts = {n: array('i', [sim.INFINITY])*sim.NUM_NODES for n in self.neighbors}
 
-        self.distanceTable = [[sim.INFINITY]*sim.NUM_NODES for _ in range(sim.NUM_NODES)]
-        self.distanceVector = deepcopy(costs)
+        # rows only for ourselves and our neighbors, the only ones we know;
+        # our own row is our distance vector
+        self.distanceVector = array('i', costs)
+        self.distanceTable = {n: array('i', [sim.INFINITY])*sim.NUM_NODES for n in self.neighbors}
+        self.distanceTable[self.myID] = self.distanceVector
         self.nextHops = [None if costs[i] == sim.INFINITY else i for i in range(sim.NUM_NODES)]
 
         self.initRouteTable()
+        self.ncostMatrix = None
+        if sim.VECTORIZE:
+            self.initMatrix()
         self.propagate()
 
 
@@ -47,16 +59,35 @@ class RouterNode():
 
 
 
+    def initMatrix(self):
+        # NumPy-versionen (-v): grannarnas vektorer som rader i en matris
+        # (i samma ordning som self.neighbors) och länkkostnaderna som en
+        # kolumn, så calcMincost blir en addition och en argmin
+        n = self.sim.NUM_NODES
+        self.row = {neighbor: r for r, neighbor in enumerate(self.neighbors)}
+        self.neighborIds = numpy.array(self.neighbors, dtype=numpy.int64)
+        self.ncostMatrix = numpy.empty((len(self.neighbors), n), dtype=numpy.int64)
+        for neighbor, r in self.row.items():
+            self.ncostMatrix[r] = numpy.frombuffer(self.ncosts[neighbor], dtype=numpy.intc)
+        self.linkVector = numpy.array([self.linkcosts[neighbor] for neighbor in self.neighbors],
+                                      dtype=numpy.int64).reshape(-1, 1)
+        # vyer över våra array('i'), inga kopior
+        self.costsView = numpy.frombuffer(self.costs, dtype=numpy.intc)
+        self.vectorView = numpy.frombuffer(self.distanceVector, dtype=numpy.intc)
+        self.hopVector = numpy.array([-1 if hop is None else hop for hop in self.nextHops], dtype=numpy.int64)
+        self.direct = numpy.arange(n, dtype=numpy.int64)
+
     def recvUpdate(self, pkt):
         source = pkt.sourceid
         updated = False
 
         # Uppdatera mottagen distansvektor från grannen
-        self.ncosts[source] = deepcopy(pkt.mincost)
+        self.ncosts[source] = pkt.mincost
+        if self.ncostMatrix is not None:
+            self.ncostMatrix[self.row[source]] = numpy.frombuffer(pkt.mincost, dtype=numpy.intc)
 
         # Uppdatera även distanceTable med mottagen information
-        for dest in range(self.sim.NUM_NODES):
-            self.distanceTable[source][dest] = pkt.mincost[dest]
+        self.distanceTable[source] = pkt.mincost
 
         # Beräkna om vår egen distansvektor behöver uppdateras
         updated = self.calcMincost()
@@ -68,6 +99,8 @@ class RouterNode():
 
 
     def calcMincost(self):
+        if self.ncostMatrix is not None:
+            return self.calcMincostVectorized()
         updated = False
 
         for dst in range(self.sim.NUM_NODES):
@@ -84,30 +117,64 @@ class RouterNode():
                         new_cost = potential_cost
                         next_hop = neighbor
 
+            # vår egen rad i distanceTable är distanceVector
             if new_cost != self.distanceVector[dst] or next_hop != self.nextHops[dst]:
                 updated = True
                 self.distanceVector[dst] = new_cost
                 self.nextHops[dst] = next_hop
 
-            # Uppdatera alltid vår egen rad i distanceTable med aktuell bästa kostnad
-            self.distanceTable[self.myID][dst] = new_cost
-
         return updated
 
 
 
 
+    def calcMincostVectorized(self):
+        # Samma resultat som calcMincost: direktlänken vinner lika kostnad,
+        # annars den första grannen (argmin tar första minimum), None/-1
+        # som nästa hopp när allt är INFINITY
+        INFINITY = self.sim.INFINITY
+        costs = self.costsView.astype(numpy.int64)
+        newCost = costs
+        nextHop = numpy.where(costs == INFINITY, -1, self.direct)
+        if len(self.neighbors):
+            potential = self.ncostMatrix + self.linkVector
+            best = potential.argmin(axis=0)
+            bestCost = potential[best, self.direct]
+            viaNeighbor = bestCost < costs
+            newCost = numpy.where(viaNeighbor, bestCost, costs)
+            nextHop = numpy.where(viaNeighbor, self.neighborIds[best], nextHop)
+        newCost[self.myID] = 0
+        nextHop[self.myID] = -1
+
+        changed = numpy.flatnonzero((newCost != self.vectorView) | (nextHop != self.hopVector))
+        if not len(changed):
+            return False
+        self.vectorView[changed] = newCost[changed]
+        self.hopVector[changed] = nextHop[changed]
+        for dst in changed.tolist():
+            hop = int(nextHop[dst])
+            self.nextHops[dst] = None if hop < 0 else hop
+        return True
+
     def propagate(self):
-        for neighbor in self.neighbors:
-            sendVector = deepcopy(self.distanceVector)
+        # En kopia av distansvektorn, delad av alla paket som inte förgiftas
+        sendVector = array('i', self.distanceVector)
+
+        # Poison Reverse (från andra versionen): destinationerna vi når via varje granne
+        via = {}
+        if self.sim.POISONREVERSE:
+            for i, hop in enumerate(self.nextHops):
+                if hop is not None:
+                    via.setdefault(hop, []).append(i)
 
-            # Poison Reverse (från andra versionen)
-            if self.sim.POISONREVERSE:
-                for i in range(self.sim.NUM_NODES):
-                    if self.nextHops[i] == neighbor:
-                        sendVector[i] = self.sim.INFINITY
+        for neighbor in self.neighbors:
+            vector = sendVector
+            if neighbor in via:
+                vector = array('i', sendVector)
+                for i in via[neighbor]:
+                    vector[i] = self.sim.INFINITY
 
-            packet = RouterPacket.RouterPacket(self.myID, neighbor, sendVector)
+            packet = RouterPacket.RouterPacket(self.myID, neighbor, vector)
             self.sendUpdate(packet)
 
     def sendUpdate(self, pkt):
@@ -120,6 +187,8 @@ class RouterNode():
         self.costs[dest] = newcost
         if dest in self.linkcosts:
             self.linkcosts[dest] = newcost
+            if self.ncostMatrix is not None:
+                self.linkVector[self.row[dest]] = newcost
 
         updated = False
         updated = self.calcMincost()
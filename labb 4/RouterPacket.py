@@ -1,18 +1,23 @@
 #!/usr/bin/env python
 
-from copy import deepcopy
+from array import array
 
 class RouterPacket(object):
-    sourceid = None         #  id of sending router sending this pkt
-    destid   = None         #  id of router to which pkt being sent
-                            #  (must be an immediate neighbor)
-    mincost  = None         #  min cost to node 0 ... 3
+    # sourceid: id of sending router sending this pkt
+    # destid:   id of router to which pkt being sent
+    #           (must be an immediate neighbor)
+    # mincost:  min cost to node 0 ... N-1, an array('i')
+    __slots__ = ("sourceid", "destid", "mincost")
 
     def __init__(self, sourceID, destID, mincosts):
-        super(RouterPacket, self).__init__()
         self.sourceid = sourceID
         self.destid = destID
-        self.mincost = deepcopy(mincosts)
+        # a list is copied; an array is taken as it is and may be shared
+        # by several packets, so it must not be changed after sending
+        if isinstance(mincosts, array):
+            self.mincost = mincosts
+        else:
+            self.mincost = array('i', mincosts)
 
     def clone(self):
-        return RouterPacket(self.sourceid, self.destid, deepcopy(self.mincost))
+        return RouterPacket(self.sourceid, self.destid, self.mincost)
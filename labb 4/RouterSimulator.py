@@ -7,10 +7,19 @@
 # with the following command line arguments:
 #
 # -c --changelinks      True/False          To activate changing link costs
+#                                           (built-in topologies only)
+# -f --file             (path)              Output file for -o file
+# -g --topology         (path or spec)      Topology file or generator instead
+#                                           of -n, see Topology.py
 # -n --nodes            3, 4, 5             Number of nodes to simulate
+# -o --output           gui/stdout/file/null  Where the output goes
 # -p --poisonreverse    True/False          To activate poison reverse
 # -s --seed             (integer)           Random seed
 # -t --trace            1, 2, 3, 4          Debugging levels
+# -v --vectorize        True/False          NumPy version of calcMincost
+#
+# NumPy is optional and only needed for -v (pip install numpy). Without it,
+# or without -v, the plain Python calcMincost is used.
 #
 # This is a Python version by C M Bruhner 2021 of code originally by Kurose
 # and Ross, with output GUI orignally added to Java version by Ch. Schuba 2007.
@@ -23,12 +32,19 @@ class RouterSimulator():
     POISONREVERSE = True    # Default value
     SEED = 1234             # Default value
     TRACE = 3               # Default value
+    OUTPUT = "gui"          # Default value
+    OUTPUT_FILE = "simulation.log"  # Default value
+    OUTPUTS = ("gui", "stdout", "file", "null")
+    TOPOLOGY = None         # Default value
+    VECTORIZE = False       # Default value
 
     INFINITY = 999
     myGUI = None
     nodes = []
     GUI = None
     connectcosts = None
+    links = None            # per node: {neighbor: link cost}
+    outputFile = None
 
 # ***************** NETWORK EMULATION CODE STARTS BELOW ***********
 # The code below emulates the layer 2 and below network environment:
@@ -44,7 +60,9 @@ class RouterSimulator():
 # should not have to, and you defeinitely should not have to modify
 # *****************************************************************
 
-    evlist = None   # the event list
+    evlist = None       # the event list: a heap of (evtime, -seq, event)
+    evseq = 0           # events inserted so far, the seq above
+    lastArrival = None  # dest -> time of the latest FROM_LAYER2 event inserted for it
 
     # possible events:
     FROM_LAYER2 = 2
@@ -54,9 +72,9 @@ class RouterSimulator():
 
     @classmethod
     def main(cls, argv):
-        inputInfo = 'RouterSimulator.py -c <LINKCHANGE (bool)> -n <NODES (int)> -p <POISONREVERSE (bool)> -s <SEED (int)> -t <TRACE (int)>\n'
+        inputInfo = 'RouterSimulator.py -c <LINKCHANGE (bool)> -n <NODES (int)> -p <POISONREVERSE (bool)> -s <SEED (int)> -t <TRACE (int)> -o <OUTPUT gui|stdout|file|null> -f <OUTPUT FILE> -g <TOPOLOGY FILE or ring:N, grid:N, er:N:P, geo:N:RADIUS, ba:N:M> -v <VECTORIZE (bool)>\n'
         try:
-            opts, args = getopt.getopt(argv,"c:n:p:s:t:",["changelinks=","nodes=","poison=","seed=","trace="])
+            opts, args = getopt.getopt(argv,"c:n:p:s:t:o:f:g:v:",["changelinks=","nodes=","poison=","seed=","trace=","output=","file=","topology=","vectorize="])
         except getopt.GetoptError:
             print(inputInfo)
             sys.exit(2)
@@ -78,17 +96,39 @@ class RouterSimulator():
                     cls.SEED = int(arg)
                 elif opt in ("-t", "--trace"):
                     cls.TRACE = int(arg)
+                elif opt in ("-o", "--output"):
+                    if arg.lower() not in cls.OUTPUTS:
+                        raise ValueError(arg)
+                    cls.OUTPUT = arg.lower()
+                elif opt in ("-f", "--file"):
+                    cls.OUTPUT_FILE = arg
+                elif opt in ("-g", "--topology"):
+                    cls.TOPOLOGY = arg
+                elif opt in ("-v", "--vectorize"):
+                    if arg.lower() in ("true", "1", "y", "yes", "t"):
+                        cls.VECTORIZE = True
+                    elif arg.lower() in ("false", "0", "n", "no", "f"):
+                        cls.VECTORIZE = False
         except ValueError:
             print(inputInfo)
             sys.exit(2)
 
+        if cls.VECTORIZE and RouterNode.numpy is None:
+            sys.exit('NumPy is not installed, run without -v.')
+
         sim = RouterSimulator()
         sim.runSimulation()
 
     def __init__(self):             # initialize the simulator
-        self.connectcosts = [ [0]*self.NUM_NODES for i in range(self.NUM_NODES) ]
+        if self.TOPOLOGY is None:
+            self.connectcosts = [ [0]*self.NUM_NODES for i in range(self.NUM_NODES) ]
         evptr = None
-        self.myGUI = GuiTextArea.GuiTextArea("  Output window for Router Simulator  ")
+        self.evlist = []
+        self.evseq = 0
+        self.lastArrival = {}
+        if self.OUTPUT == "file":
+            self.outputFile = open(self.OUTPUT_FILE, "w", buffering=1024*1024)
+        self.myGUI = self.newOutput("  Output window for Router Simulator  ", "sim")
 
 
         random.seed(self.SEED)
@@ -96,7 +136,9 @@ class RouterSimulator():
 
         #  set initial costs
         #  non-defined connections (n-n) defaulted to 0
-        if self.NUM_NODES == 3:
+        if self.TOPOLOGY is not None:
+            self.loadTopology()
+        elif self.NUM_NODES == 3:
             self.connectcosts[0][1] = 4
             self.connectcosts[0][2] = 1
             self.connectcosts[1][0] = 4
@@ -139,14 +181,17 @@ class RouterSimulator():
             self.connectcosts[4][3] = self.INFINITY
         else:
             sys.exit('Unsupported number of nodes.')
+        if self.TOPOLOGY is None:
+            self.links = [{j: cost for j, cost in enumerate(row) if j != i and cost != self.INFINITY}
+                          for i, row in enumerate(self.connectcosts)]
 
         self.nodes = [None]*self.NUM_NODES
 
         for i in range(self.NUM_NODES):
-            self.nodes[i] = RouterNode.RouterNode(i, self, self.connectcosts[i])
+            self.nodes[i] = RouterNode.RouterNode(i, self, self.costRow(i))
 
         #  initialize future link changes
-        if self.LINKCHANGES:
+        if self.LINKCHANGES and self.TOPOLOGY is None:
 
             if self.NUM_NODES == 3:
                 evptr = Event()
@@ -183,14 +228,10 @@ class RouterSimulator():
     def runSimulation(self):
         eventptr = None
 
-        while True:
+        while self.evlist:
 
-            eventptr = self.evlist          # get next event to simulate
-            if eventptr == None:
-                break
-            self.evlist = self.evlist.next  # remove this event from event list
-            if self.evlist != None:
-                self.evlist.prev = None
+            # get next event to simulate and remove it from the event list
+            eventptr = heapq.heappop(self.evlist)[2]
             if self.TRACE > 1:
                 self.myGUI.println("MAIN: rcv event, t=" +
                                    str(eventptr.evtime) + " at " +
@@ -224,56 +265,76 @@ class RouterSimulator():
         self.myGUI.println("\nSimulator terminated at t=" + str(self.clocktime) +
                            ", no packets in medium\n")
 
-        self.myGUI.myGUI.mainloop()
+        if self.OUTPUT == "gui":
+            self.myGUI.myGUI.mainloop()
+        elif self.outputFile is not None:
+            self.outputFile.close()
+        else:
+            sys.stdout.flush()
 
     def getClocktime(self):
         return self.clocktime
 
+    def loadTopology(self):
+        # -g: read or generate the links, with a random generator of their
+        # own so the seed gives the same simulation as before
+        try:
+            topology = Topology.Topology.fromSpec(self.TOPOLOGY, random.Random(self.SEED))
+        except (OSError, ValueError) as e:
+            sys.exit('Bad topology ' + self.TOPOLOGY + ': ' + str(e))
+        if topology.numNodes < 2:
+            sys.exit('Unsupported number of nodes.')
+        self.NUM_NODES = topology.numNodes
+        self.links = topology.links
+        # no route may cost INFINITY or more
+        self.INFINITY = max(self.INFINITY, topology.maxDistance() + 1)
+        self.myGUI.println("Topology " + self.TOPOLOGY + ": " + str(self.NUM_NODES) +
+                           " nodes, " + str(topology.numLinks()) + " links")
+
+    def costRow(self, node):
+        # the link costs of one node to every node, as RouterNode takes them
+        row = [self.INFINITY] * self.NUM_NODES
+        row[node] = 0
+        for neighbor, cost in self.links[node].items():
+            row[neighbor] = cost
+        return row
+
+    def newOutput(self, title, name):
+        # An output window with this title, or without a GUI, a sink that
+        # writes (or drops) lines tagged with the short name
+        if self.OUTPUT == "gui":
+            return GuiTextArea.GuiTextArea(title)
+        if self.OUTPUT == "null":
+            return Output.NullOutput()
+        stream = self.outputFile if self.OUTPUT == "file" else sys.stdout
+        return Output.StreamOutput(stream, "[" + name + "] ")
+
   #  ********************* EVENT HANDLINE ROUTINES *******
   #   The next set of routines handle the event list     *
   #  *****************************************************
 
     def insertevent(self, p):
-        q = None
-        qold = None
         if self.TRACE > 3:
             self.myGUI.println("            INSERTEVENT: time is " +
                                str(self.clocktime))
             self.myGUI.println("            INSERTEVENT: future time will be " +
                                str(p.evtime))
-        q = self.evlist             # q points to header of list in which p struct inserted
-        if q == None:               # list is empty
-            self.evlist = p
-            p.next = None
-            p.prev = None
-        else:
-            qold = q
-            while (q != None and p.evtime > q.evtime):
-                qold = q
-                q = q.next
-            if q == None:           # end of list
-                qold.next = p
-                p.prev = qold
-                p.next = None
-            elif q == self.evlist:  # front of list
-                p.next = self.evlist
-                p.prev = None
-                p.next.prev = p
-                self.evlist = p
-            else:                   # middle of list
-                p.next = q
-                p.prev = q.prev
-                q.prev.next = p
-                q.prev = p
+        # O(log n) heap push. Of events with the same time the one inserted
+        # last comes out first, as it did from the sorted linked list
+        # this replaces, so a seed still gives the same run.
+        self.evseq += 1
+        heapq.heappush(self.evlist, (p.evtime, -self.evseq, p))
+        if p.evtype == self.FROM_LAYER2:
+            last = self.lastArrival.get(p.eventity)
+            if last is None or p.evtime > last:
+                self.lastArrival[p.eventity] = p.evtime
 
     def printevlist(self):
-        q = self.evlist
         self.myGUI.println("--------------\nEvent List Follows:")
-        while q != None:
+        for evtime, seq, q in sorted(self.evlist):
             self.myGUI.println("Event time: " + str(q.evtime) +
                                ", type: " + str(q.evtype) +
                                " entity: " + str(q.eventity))
-            q = q.next
         self.myGUI.println("--------------")
 
 # ************************** TOLAYER2 ***************
@@ -288,12 +349,13 @@ class RouterSimulator():
         if packet.sourceid == packet.destid:
             self.myGUI.println("WARNING: source and destination id's the same, ignoring packet!")
             return
-        if self.connectcosts[packet.sourceid][packet.destid] == self.INFINITY:
+        if packet.destid not in self.links[packet.sourceid]:
             self.myGUI.println("WARNING: source and destination not connected, ignoring packet!")
             return
 
         # make a copy of the packet student just gave me since may
-        # be modified after we return back
+        # be modified after we return back (the cost vector is shared:
+        # packets never change theirs)
         mypktptr = packet.clone()
 
         if (self.TRACE>2):
@@ -313,13 +375,9 @@ class RouterSimulator():
         # finally, compute the arrival time of packet at the other end.
         # medium can not reorder, so make sure packet arrives between 1
         # and 10 time units after the latest arrival time of packets
-        # currently in the medium on their way to the destination
-        lastime = self.clocktime
-        q = self.evlist
-        while (q != None):
-            if (q.evtype == self.FROM_LAYER2 and q.eventity == evptr.eventity):
-                lastime = q.evtime
-            q = q.next
+        # currently in the medium on their way to the destination; an
+        # arrival earlier than now has already been delivered
+        lastime = max(self.clocktime, self.lastArrival.get(evptr.eventity, self.clocktime))
         evptr.evtime = lastime + 9 * random.random() + 1
 
         if self.TRACE > 2:
@@ -329,14 +387,20 @@ class RouterSimulator():
 
 
 class Event(object):
-    evtime   = None     # event time
-    evtype   = None     # event type code
-    eventity = None     # entity where event occurs
-    rtpktptr = None     # ptr to packet (if any) assoc w/ this event
-    dest     = None     # for link cost change
-    cost     = None     # for link cost change
-    prev     = None     # previous event
-    next     = None     # next event
+    __slots__ = ("evtime",      # event time
+                 "evtype",      # event type code
+                 "eventity",    # entity where event occurs
+                 "rtpktptr",    # ptr to packet (if any) assoc w/ this event
+                 "dest",        # for link cost change
+                 "cost")        # for link cost change
+
+    def __init__(self):
+        self.evtime = None
+        self.evtype = None
+        self.eventity = None
+        self.rtpktptr = None
+        self.dest = None
+        self.cost = None
 
     def __eq__(self, other):
         if not isinstance(other, Event):
@@ -348,6 +412,6 @@ class Event(object):
 
 
 if __name__ == '__main__':
-    import sys, getopt, random
-    import GuiTextArea, RouterNode, RouterPacket
+    import sys, getopt, random, heapq
+    import GuiTextArea, Output, RouterNode, RouterPacket, Topology
     RouterSimulator.main(sys.argv[1:])
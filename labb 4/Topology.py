@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+import math
+
+# ******************************************************************
+# Network topologies for the simulator beyond the built-in 3, 4 and 5
+# node ones, read from a file or generated. Links are kept sparse, one
+# dict {neighbor: link cost} per node, so memory grows with the number of
+# links and not with N*N.
+#
+# File format, one entry per line ('#' starts a comment):
+#   u v [cost]              edge list: a link between u and v
+#   u: v[=cost] v[=cost]    adjacency: links from u to each v
+#   nodes N                 optional, for nodes without any link
+# Nodes are numbered 0 .. N-1. Links go both ways, cost defaults to 1.
+#
+# Generators, given to -g as name:args (link costs 1 .. MAXCOST):
+#   ring:N          a cycle
+#   grid:N          a square-ish grid, ceil(sqrt(N)) nodes wide
+#   er:N:P          Erdos-Renyi, each pair linked with probability P
+#   geo:N:RADIUS    random geometric, nodes in the unit square linked
+#                   when closer than RADIUS
+#   ba:N:M          scale-free (Barabasi-Albert), each new node linked
+#                   to M nodes picked by degree
+# ******************************************************************
+
+class Topology(object):
+    MAXCOST = 10        # highest generated link cost
+
+    numNodes = None
+    links = None        # per node: {neighbor: link cost}
+
+    def __init__(self, numNodes):
+        self.numNodes = numNodes
+        self.links = [{} for i in range(numNodes)]
+
+    def addLink(self, u, v, cost):
+        if u == v:
+            raise ValueError(f"link from node {u} to itself")
+        if cost <= 0:
+            raise ValueError(f"link {u}-{v} has cost {cost}")
+        self.links[u][v] = cost
+        self.links[v][u] = cost
+
+    def numLinks(self):
+        return sum(len(l) for l in self.links) // 2
+
+    def maxDistance(self):
+        # no shortest path costs more: N-1 links, all of them the dearest
+        highest = max((max(l.values()) for l in self.links if l), default=0)
+        return (self.numNodes - 1) * highest
+
+    # --------------------------------------------------
+    @classmethod
+    def fromSpec(cls, spec, rng):
+        # a generator spec like "er:1000:0.01", or else a file name
+        name, _, args = spec.partition(":")
+        args = args.split(":") if args else []
+        if name == "ring" and len(args) == 1:
+            return cls.ring(int(args[0]), rng)
+        if name == "grid" and len(args) == 1:
+            return cls.grid(int(args[0]), rng)
+        if name == "er" and len(args) == 2:
+            return cls.erdosRenyi(int(args[0]), float(args[1]), rng)
+        if name == "geo" and len(args) == 2:
+            return cls.randomGeometric(int(args[0]), float(args[1]), rng)
+        if name == "ba" and len(args) == 2:
+            return cls.scaleFree(int(args[0]), int(args[1]), rng)
+        return cls.load(spec)
+
+    @classmethod
+    def load(cls, path):
+        edges = []
+        numNodes = 0
+        with open(path) as f:
+            for lineno, line in enumerate(f, 1):
+                fields = line.split("#", 1)[0].split()
+                if not fields:
+                    continue
+                try:
+                    if fields[0] == "nodes" and len(fields) == 2:
+                        numNodes = max(numNodes, int(fields[1]))
+                    elif fields[0].endswith(":"):
+                        u = int(fields[0][:-1])
+                        for item in fields[1:]:
+                            v, _, cost = item.partition("=")
+                            edges.append((u, int(v), int(cost) if cost else 1))
+                    elif len(fields) in (2, 3):
+                        cost = int(fields[2]) if len(fields) == 3 else 1
+                        edges.append((int(fields[0]), int(fields[1]), cost))
+                    else:
+                        raise ValueError(line)
+                except ValueError:
+                    raise ValueError(f"{path}:{lineno}: cannot read {line.strip()!r}")
+        for u, v, cost in edges:
+            if u < 0 or v < 0:
+                raise ValueError(f"{path}: negative node id in link {u}-{v}")
+            numNodes = max(numNodes, u + 1, v + 1)
+        topology = cls(numNodes)
+        for u, v, cost in edges:
+            topology.addLink(u, v, cost)
+        return topology
+
+    # --------------------------------------------------
+    @classmethod
+    def randomCost(cls, rng):
+        return rng.randint(1, cls.MAXCOST)
+
+    @classmethod
+    def ring(cls, n, rng):
+        if n < 2:
+            raise ValueError("a ring needs 2 nodes or more")
+        topology = cls(n)
+        for i in range(n):
+            topology.addLink(i, (i + 1) % n, cls.randomCost(rng))
+        return topology
+
+    @classmethod
+    def grid(cls, n, rng):
+        topology = cls(n)
+        width = math.ceil(math.sqrt(n))
+        for i in range(n):
+            if (i + 1) % width and i + 1 < n:
+                topology.addLink(i, i + 1, cls.randomCost(rng))
+            if i + width < n:
+                topology.addLink(i, i + width, cls.randomCost(rng))
+        return topology
+
+    @classmethod
+    def erdosRenyi(cls, n, p, rng):
+        # G(n, p) in O(n + links): jump over the pairs that are not linked
+        # with geometric skips (Batagelj and Brandes 2005) instead of
+        # drawing for every one of the n*(n-1)/2 pairs
+        if not 0 < p <= 1:
+            raise ValueError("the link probability must be in (0, 1]")
+        topology = cls(n)
+        logq = math.log(1 - p) if p < 1 else None
+        v, w = 1, -1
+        while v < n:
+            if logq is None:
+                w += 1
+            else:
+                w += 1 + int(math.log(1 - rng.random()) / logq)
+            while w >= v and v < n:
+                w -= v
+                v += 1
+            if v < n:
+                topology.addLink(v, w, cls.randomCost(rng))
+        return topology
+
+    @classmethod
+    def randomGeometric(cls, n, radius, rng):
+        # only points in the same or a neighboring cell of a radius-sized
+        # grid can be closer than radius
+        if radius <= 0:
+            raise ValueError("the radius must be positive")
+        topology = cls(n)
+        points = [(rng.random(), rng.random()) for i in range(n)]
+        cells = {}
+        for i, (x, y) in enumerate(points):
+            cells.setdefault((int(x / radius), int(y / radius)), []).append(i)
+        r2 = radius * radius
+        for (cx, cy), members in cells.items():
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    for j in cells.get((cx + dx, cy + dy), ()):
+                        xj, yj = points[j]
+                        for i in members:
+                            if i < j and (points[i][0] - xj) ** 2 + (points[i][1] - yj) ** 2 < r2:
+                                topology.addLink(i, j, cls.randomCost(rng))
+        return topology
+
+    @classmethod
+    def scaleFree(cls, n, m, rng):
+        # preferential attachment: a node is picked from 'repeated', where
+        # every node appears once per link it has
+        if not 1 <= m < n:
+            raise ValueError("need 1 <= M < N")
+        topology = cls(n)
+        targets = list(range(m))
+        repeated = []
+        for source in range(m, n):
+            for t in targets:
+                topology.addLink(source, t, cls.randomCost(rng))
+            repeated.extend(targets)
+            repeated.extend([source] * m)
+            chosen = set()
+            while len(chosen) < m:
+                chosen.add(rng.choice(repeated))
+            targets = sorted(chosen)
+        return topology
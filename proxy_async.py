@@ -0,0 +1,597 @@
+import socket
+import asyncio
+import time
+import signal
+
+import proxy_cache
+import proxy_pipeline
+import proxy_tunnel
+import proxy_upstream
+from proxy_cache import SINGLE_FLIGHT_TIMEOUT, SingleFlight
+from proxy_codings import (encode_chunk, last_chunk, ChunkedDecoder, PlainBody, run_stages,
+                           record_forwarded, record_body)
+from proxy_http import (MAX_HEADER_BYTES, BUFSIZE, FORWARD_MAX_BUFSIZE, HeaderTooLarge,
+                        parse_http_head)
+from proxy_logging import LOG, begin_access, end_access, CONNECTION_IDS, note_upstream
+from proxy_metrics import METRICS, STATS
+from proxy_pipeline import (CLIENT_IDLE_TIMEOUT, MAX_REQUESTS_PER_CONNECTION, CLIENT_WRITE_TIMEOUT,
+                            DRAINING, WORKER_DRAIN_TIMEOUT, parse_request, cached_response,
+                            join_flight, shared_response, land_flight, upstream_request,
+                            plan_response, finish_response, http_error_response,
+                            local_image_response)
+from proxy_tunnel import (connect_target, connect_refused, connect_established, record_tunnel,
+                          relay_tunnel_async)
+from proxy_upstream import UPSTREAM_MAX_PER_HOST, UPSTREAM_IDLE_TIMEOUT, UPSTREAM_CHECKOUT_TIMEOUT
+
+# ***************** ASYNCIO ENGINE *****************
+# Same pipeline as the threaded engine's handle_client, but on one event
+# loop with non-blocking client and upstream streams.
+
+# asyncio engine (-a): one event loop instead of one thread per connection.
+# ASYNC_MAX_CONNECTIONS caps open client sockets, anything above gets a 503.
+# ASYNC_MAX_ACTIVE caps how many requests are worked on at the same time,
+# idle connections waiting for their request line do not count; a request
+# waiting longer than ADMISSION_QUEUE_TIMEOUT for its turn gets a 503.
+ASYNC_MAX_CONNECTIONS = 16384
+ASYNC_MAX_ACTIVE = 512
+
+# Buffer size of the asyncio streams, per direction and connection; a
+# reader stops reading from its socket when this much is waiting, a writer
+# makes us wait when this much is not yet sent.
+STREAM_BUFFER_LIMIT = 256 * 1024
+
+async def read_http_headers_async(reader, first_line=b""):
+    """
+    Async version of read_http_headers, reading from an asyncio.StreamReader
+    (which buffers on its own). 'first_line' is a line already read.
+    Returns (start_line, fields) or (None, []).
+    """
+    block = bytearray()
+    line = first_line
+    while True:
+        if not line:
+            try:
+                line = await reader.readline()
+            except ConnectionError:
+                break
+            except (asyncio.LimitOverrunError, ValueError):
+                raise HeaderTooLarge("line too long")
+            if not line:
+                break
+        if line in (b"\r\n", b"\n"):
+            line = b""
+            if block:
+                break
+            continue    # skip empty lines before the start line
+        block += line
+        line = b""
+        if len(block) > MAX_HEADER_BYTES:
+            raise HeaderTooLarge("header block too large")
+    if not block:
+        return None, []
+    return parse_http_head(bytes(block))
+
+async def forward_raw_async(reader, writer, length=None):
+    """
+    Async version of forward_raw (without splice: the bytes pass through
+    the streams anyway, so only the growing read size applies).
+    """
+    size = BUFSIZE
+    remaining = length
+    sent = 0
+    while remaining is None or remaining > 0:
+        chunk = await read_timed(reader, size if remaining is None else min(size, remaining))
+        if not chunk:
+            break
+        writer.write(chunk)
+        await drain(writer)
+        sent += len(chunk)
+        if remaining is not None:
+            remaining -= len(chunk)
+        if len(chunk) == size and size < FORWARD_MAX_BUFSIZE:
+            size *= 2
+    return sent
+
+async def body_chunks_async(reader, length=None, body=None):
+    """
+    Async version of body_chunks.
+    """
+    remaining = length
+    while remaining is None or remaining > 0:
+        chunk = await read_timed(reader, 65536 if remaining is None else min(65536, remaining))
+        if not chunk:
+            if remaining is not None:
+                raise ConnectionError(f"server closed {remaining} bytes short of the body")
+            break
+        if remaining is not None:
+            remaining -= len(chunk)
+        yield chunk
+    if body is not None:
+        body.done = True
+
+async def chunked_body_chunks_async(reader, decoder):
+    """
+    Async version of chunked_body_chunks. Bytes read past the end of the
+    body stay in decoder.unused (a StreamReader cannot take them back).
+    """
+    while not decoder.done:
+        data = await read_timed(reader, 65536)
+        if not data:
+            raise ConnectionError("server closed inside a chunked body")
+        out = decoder.feed(data)
+        if out:
+            yield out
+
+def response_body_async(reader, content_length, is_chunked):
+    """
+    Async version of response_body.
+    """
+    if is_chunked:
+        decoder = ChunkedDecoder()
+        return chunked_body_chunks_async(reader, decoder), decoder
+    decoder = PlainBody()
+    return body_chunks_async(reader, content_length, decoder), decoder
+
+async def send_body_async(chunks, writer, chunked=True, stages=(), decoder=None):
+    """
+    Async version of send_body, 'chunks' is an async iterator.
+    """
+    spent = 0.0
+    read = sent = 0
+    async for chunk in chunks:
+        read += len(chunk)
+        t = time.perf_counter()
+        out = run_stages(stages, chunk)
+        spent += time.perf_counter() - t
+        if out:
+            sent += len(out)
+            writer.write(encode_chunk(out) if chunked else out)
+            await drain(writer)
+    t = time.perf_counter()
+    out = run_stages(stages, b"", final=True)
+    spent += time.perf_counter() - t
+    sent += len(out)
+    if chunked:
+        end = last_chunk(decoder.trailers if decoder is not None else ())
+        writer.write((encode_chunk(out) if out else b"") + end)
+    elif out:
+        writer.write(out)
+    await drain(writer)
+    record_body(stages, spent, read, sent)
+
+async def read_timed(reader, n, timeout=None):
+    """
+    reader.read(n), giving up with asyncio.TimeoutError after 'timeout'
+    (UPSTREAM_READ_TIMEOUT by default).
+    """
+    if timeout is None:
+        timeout = proxy_upstream.UPSTREAM_READ_TIMEOUT
+    return await asyncio.wait_for(reader.read(n), timeout)
+
+async def drain(writer, timeout=None):
+    """
+    writer.drain(), giving up with asyncio.TimeoutError when the peer has
+    not taken our data for 'timeout' (CLIENT_WRITE_TIMEOUT) seconds.
+    """
+    await asyncio.wait_for(writer.drain(), CLIENT_WRITE_TIMEOUT if timeout is None else timeout)
+
+def stream_buffered(reader):
+    """
+    Whether an asyncio.StreamReader has bytes read from the socket but not
+    yet taken (it has no public way to tell; unknown counts as yes).
+    """
+    return len(getattr(reader, "_buffer", b"?")) > 0
+
+class AsyncUpstreamPool(object):
+    """
+    Async version of UpstreamPool; connections are (reader, writer) pairs.
+    """
+
+    def __init__(self, max_per_host=UPSTREAM_MAX_PER_HOST, idle_timeout=UPSTREAM_IDLE_TIMEOUT,
+                 checkout_timeout=UPSTREAM_CHECKOUT_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.cond = asyncio.Condition()
+        self.idle = {}
+        self.open = {}
+        self.last_sweep = 0.0
+
+    async def connect(self, host, port):
+        started = time.monotonic()
+        sock = await proxy_upstream.UPSTREAM_CONNECTOR.connect_async(host, port,
+                                                                     proxy_upstream.UPSTREAM_CONNECT_TIMEOUT)
+        reader, writer = await asyncio.open_connection(sock=sock, limit=STREAM_BUFFER_LIMIT)
+        writer.transport.set_write_buffer_limits(high=STREAM_BUFFER_LIMIT)
+        METRICS.observe("connect", time.monotonic() - started)
+        return reader, writer
+
+    async def checkout(self, host, port):
+        key = (host, port)
+        deadline = time.monotonic() + self.checkout_timeout
+        async with self.cond:
+            self.sweep()
+            while True:
+                idle = self.idle.get(key)
+                while idle:
+                    conn, _ = idle.pop()
+                    if not conn[0].at_eof() and not conn[1].is_closing():
+                        return conn, True
+                    self.drop(key, conn)
+                if self.open.get(key, 0) < self.max_per_host:
+                    self.open[key] = self.open.get(key, 0) + 1
+                    break
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining <= 0:
+                        raise asyncio.TimeoutError()
+                    await asyncio.wait_for(self.cond.wait(), remaining)
+                except asyncio.TimeoutError:
+                    raise socket.timeout(f"no free connection to {host}:{port}")
+
+        try:
+            return await self.connect(host, port), False
+        except (OSError, asyncio.TimeoutError):
+            async with self.cond:
+                self.drop(key, None)
+            raise
+
+    async def release(self, host, port, conn, reusable):
+        """
+        Like UpstreamPool.release: the connection is kept only if
+        'reusable' and its StreamReader holds no unread bytes, which the
+        next request on it would take for the start of its response.
+        """
+        key = (host, port)
+        async with self.cond:
+            if reusable and not stream_buffered(conn[0]):
+                self.idle.setdefault(key, []).append((conn, time.monotonic()))
+                self.cond.notify()
+            else:
+                self.drop(key, conn)
+
+    def drop(self, key, conn):
+        # called with the condition's lock held
+        if conn is not None:
+            conn[1].close()
+        self.open[key] -= 1
+        if self.open[key] <= 0:
+            del self.open[key]
+        self.cond.notify()
+
+    def sweep(self):
+        now = time.monotonic()
+        if now - self.last_sweep < 1.0:
+            return
+        self.last_sweep = now
+        for key in list(self.idle):
+            fresh = []
+            for conn, last_used in self.idle[key]:
+                if now - last_used > self.idle_timeout:
+                    self.drop(key, conn)
+                else:
+                    fresh.append((conn, last_used))
+            if fresh:
+                self.idle[key] = fresh
+            else:
+                del self.idle[key]
+
+class AsyncFlight(object):
+    """
+    Async version of Flight.
+    """
+
+    def __init__(self):
+        self.done = asyncio.Event()
+        self.result = None
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self.done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.result
+
+class AsyncSingleFlight(SingleFlight):
+    """
+    SingleFlight for the event loop, the waiters are coroutines.
+    """
+
+    def join(self, key):
+        return self.join_locked(key, AsyncFlight)
+
+    def finish(self, key, flight, result, storable=True):
+        self.finish_locked(key, flight, storable)
+        flight.result = result
+        flight.done.set()
+
+class AsyncProxyServer(object):
+    """
+    asyncio serving mode. Connections above max_connections are answered
+    with 503, requests above max_active wait on a semaphore.
+    """
+
+    def __init__(self, port, max_connections=ASYNC_MAX_CONNECTIONS,
+                 max_active=ASYNC_MAX_ACTIVE, reuse_port=False):
+        self.port = port
+        self.reuse_port = reuse_port
+        self.max_connections = max_connections
+        self.max_active = max_active
+        self.connections = 0
+        self.active = None
+        self.pool = None
+        self.flights = AsyncSingleFlight()
+
+    async def handle_client(self, client_reader, client_writer):
+        client_addr = client_writer.get_extra_info("peername")
+        if self.connections >= self.max_connections:
+            client_writer.write(http_error_response(503, "Service Unavailable"))
+            await close_writer(client_writer)
+            return
+
+        self.connections += 1
+        served = 0
+        connection = next(CONNECTION_IDS)
+        STATS.incr("connections")
+        STATS.incr("active_connections")
+        client_writer.transport.set_write_buffer_limits(high=STREAM_BUFFER_LIMIT)
+        try:
+            while served < MAX_REQUESTS_PER_CONNECTION and not DRAINING.is_set():
+                # 1) Wait for the next request, then read its headers against
+                # a deadline; idle clients do not hold an active slot
+                try:
+                    first_line = await asyncio.wait_for(client_reader.readline(), CLIENT_IDLE_TIMEOUT)
+                    if not first_line:
+                        break
+                except asyncio.TimeoutError:
+                    break
+                except (asyncio.LimitOverrunError, ValueError):
+                    client_writer.write(http_error_response(431, "Request Header Fields Too Large"))
+                    break
+                started = time.monotonic()
+                try:
+                    request_line, request_fields = await asyncio.wait_for(
+                        read_http_headers_async(client_reader, first_line), proxy_pipeline.HEADER_READ_TIMEOUT)
+                except asyncio.TimeoutError:
+                    client_writer.write(http_error_response(408, "Request Timeout"))
+                    break
+                except HeaderTooLarge:
+                    client_writer.write(http_error_response(431, "Request Header Fields Too Large"))
+                    break
+                if request_line is None:
+                    break
+                served += 1
+                STATS.incr("requests")
+                parsed = time.monotonic()
+                METRICS.observe("headers", parsed - started)
+                last = served >= MAX_REQUESTS_PER_CONNECTION or DRAINING.is_set()
+                access = begin_access(client_addr, connection, request_line, request_fields, started)
+                try:
+                    # a tunnel is idle most of its life, it does not hold an
+                    # active slot; like in the threaded engine it is over
+                    # when the tunnel closes, and counts in "total"
+                    if request_line.partition(" ")[0].upper() == "CONNECT":
+                        await self.tunnel(client_reader, client_writer, client_addr, request_line)
+                        keep_alive = False
+                    else:
+                        # wait for an active slot, or give up with a 503
+                        try:
+                            await asyncio.wait_for(self.active.acquire(), proxy_pipeline.ADMISSION_QUEUE_TIMEOUT)
+                        except asyncio.TimeoutError:
+                            STATS.incr("shed")
+                            client_writer.write(http_error_response(503, "Service Unavailable"))
+                            break
+                        try:
+                            keep_alive = await self.handle_request(client_reader, client_writer, client_addr,
+                                                                   request_line, request_fields, last)
+                        finally:
+                            self.active.release()
+                finally:
+                    end_access(access)
+                METRICS.observe("total", time.monotonic() - parsed)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            LOG.info("[%s] Connection error: %r", client_addr, e)
+        finally:
+            self.connections -= 1
+            STATS.incr("active_connections", -1)
+            await close_writer(client_writer)
+
+    async def handle_request(self, client_reader, client_writer, client_addr,
+                             request_line, request_fields, last=False):
+        """
+        Async version of handle_request. Returns True if the client
+        connection can be used for another request.
+        """
+        # 2-5) Parse the request line and headers
+        request, error = parse_request(request_line, request_fields, client_addr, last)
+        if error is not None:
+            client_writer.write(http_error_response(*error))
+            return False
+
+        # 6) Special case: If path ends with "Smiley.jpg", serve local troll image
+        if request.local_image is not None:
+            if request.body_length:
+                await client_reader.readexactly(request.body_length)
+            head, body = local_image_response(request.http_version, request.local_image, request.keep_alive)
+            client_writer.write(head)
+            client_writer.write(body)
+            await drain(client_writer)
+            return request.keep_alive
+
+        # 6b) Answer from the cache, or revalidate a stale entry. A copy
+        # spilled to disk is read back in an executor thread.
+        if request.use_cache and proxy_cache.RESPONSE_CACHE.on_disk(request.cache_key):
+            response = await asyncio.to_thread(cached_response, request)
+        else:
+            response = cached_response(request, load=False)
+        if response is not None:
+            client_writer.write(response)
+            await drain(client_writer)
+            return request.keep_alive
+
+        # 6c) Share an identical GET that is already in flight
+        flight = join_flight(request, self.flights)
+        if flight is not None:
+            response = shared_response(request, await flight.wait(SINGLE_FLIGHT_TIMEOUT))
+            if response is not None:
+                client_writer.write(response)
+                await drain(client_writer)
+                return request.keep_alive
+
+        try:
+            # 7-9) Send the request on a pooled connection, read the response headers
+            try:
+                upstream = await self.open_upstream(request.host, request.port, upstream_request(request),
+                                                    client_reader, request.body_length, client_addr)
+            except (socket.timeout, asyncio.TimeoutError):
+                LOG.warning("[%s] Timed out waiting for %s:%s.", client_addr, request.host, request.port)
+                client_writer.write(http_error_response(504, "Gateway Timeout"))
+                return False
+            if upstream is None:
+                client_writer.write(http_error_response(502, "Bad Gateway"))
+                return False
+            server_conn, resp_status_line, response_fields = upstream
+            note_upstream(resp_status_line, response_fields)
+            server_reader = server_conn[0]
+            reusable = False
+
+            try:
+                # 10-11) Send the head, then the body rewritten or raw
+                plan = plan_response(request, resp_status_line, response_fields)
+                client_writer.write(plan.head)
+                decoder = None
+                if plan.raw:
+                    moved = await forward_raw_async(server_reader, client_writer, plan.content_length)
+                    record_forwarded(moved, plan.content_length)
+                elif plan.has_body:
+                    chunks, decoder = response_body_async(server_reader, plan.content_length, plan.is_chunked)
+                    await send_body_async(chunks, client_writer, plan.mode == "chunked", plan.stages, decoder)
+                reusable = finish_response(request, plan, decoder)
+                cache = proxy_cache.RESPONSE_CACHE
+                if cache is not None and cache.spills_pending():
+                    await asyncio.get_running_loop().run_in_executor(None, cache.write_spills)
+                await drain(client_writer)
+                return request.keep_alive
+            finally:
+                await self.pool.release(request.host, request.port, server_conn, reusable)
+        finally:
+            land_flight(request)
+
+    async def open_upstream(self, remote_host, remote_port, out_req, client_reader,
+                            request_body_length, client_addr):
+        """
+        Async version of open_upstream.
+        """
+        for attempt in range(2):
+            try:
+                server_conn, reused = await self.pool.checkout(remote_host, remote_port)
+            except (socket.timeout, asyncio.TimeoutError):
+                raise
+            except OSError as e:
+                LOG.warning("[%s] Could not connect to %s:%s - %s", client_addr, remote_host, remote_port, e)
+                return None
+            server_reader, server_writer = server_conn
+            try:
+                started = time.monotonic()
+                server_writer.write(out_req)
+                if request_body_length:
+                    await forward_raw_async(client_reader, server_writer, request_body_length)
+                await drain(server_writer, proxy_upstream.UPSTREAM_READ_TIMEOUT)
+                resp_status_line, response_fields = await asyncio.wait_for(
+                    read_http_headers_async(server_reader), proxy_upstream.UPSTREAM_READ_TIMEOUT)
+                METRICS.observe("first_byte", time.monotonic() - started)
+            except (socket.timeout, asyncio.TimeoutError):
+                await self.pool.release(remote_host, remote_port, server_conn, False)
+                raise
+            except OSError:
+                resp_status_line, response_fields = None, []
+            if resp_status_line is not None:
+                return server_conn, resp_status_line, response_fields
+            await self.pool.release(remote_host, remote_port, server_conn, False)
+            if not reused or request_body_length:
+                LOG.warning("[%s] Server closed without sending headers.", client_addr)
+                return None
+            LOG.debug("[%s] Pooled connection to %s:%s was stale, retrying.", client_addr, remote_host, remote_port)
+        return None
+
+    async def tunnel(self, client_reader, client_writer, client_addr, request_line):
+        """
+        Async version of handle_connect.
+        """
+        request, error = parse_request(request_line, [], client_addr)
+        if error is not None:
+            client_writer.write(http_error_response(*error))
+            return
+        authority, http_version = request.target, request.http_version
+        refused = connect_refused(authority, client_addr)
+        if refused is not None:
+            client_writer.write(http_error_response(*refused))
+            return
+        host, port = connect_target(authority)
+        try:
+            sock = await proxy_upstream.UPSTREAM_CONNECTOR.connect_async(
+                host, port, proxy_upstream.UPSTREAM_CONNECT_TIMEOUT)
+            server_reader, server_writer = await asyncio.open_connection(sock=sock, limit=STREAM_BUFFER_LIMIT)
+        except asyncio.TimeoutError:
+            client_writer.write(http_error_response(504, "Gateway Timeout"))
+            LOG.warning("[%s] Timed out connecting to %s.", client_addr, authority)
+            return
+        except OSError as e:
+            client_writer.write(http_error_response(502, "Bad Gateway"))
+            LOG.warning("[%s] Could not connect to %s - %s", client_addr, authority, e)
+            return
+        STATS.incr("tunnels")
+        STATS.incr("active_tunnels")
+        started = time.monotonic()
+        try:
+            server_writer.transport.set_write_buffer_limits(high=STREAM_BUFFER_LIMIT)
+            client_writer.write(connect_established(http_version))
+            up, down, reason = await relay_tunnel_async(client_reader, client_writer,
+                                                        server_reader, server_writer,
+                                                        proxy_tunnel.TUNNEL_IDLE_TIMEOUT)
+            record_tunnel(client_addr, authority, up, down, time.monotonic() - started, reason)
+        finally:
+            await close_writer(server_writer)
+            STATS.incr("active_tunnels", -1)
+
+    async def serve(self):
+        self.active = asyncio.Semaphore(self.max_active)
+        self.pool = AsyncUpstreamPool()
+        raise_fd_limit()
+        server = await asyncio.start_server(self.handle_client, "0.0.0.0", self.port,
+                                            backlog=proxy_pipeline.LISTEN_BACKLOG, reuse_address=True,
+                                            limit=STREAM_BUFFER_LIMIT, reuse_port=self.reuse_port or None)
+        LOG.info("[MAIN] Proxy (asyncio) listening on port %d...", self.port)
+        # SIGTERM: stop accepting, let open connections finish, return
+        drain = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, drain.set)
+        async with server:
+            await drain.wait()
+            DRAINING.set()
+            server.close()
+            deadline = loop.time() + WORKER_DRAIN_TIMEOUT
+            while self.connections and loop.time() < deadline:
+                await asyncio.sleep(0.1)
+
+async def close_writer(writer):
+    try:
+        writer.close()
+        await writer.wait_closed()
+    except Exception:
+        pass
+
+def raise_fd_limit():
+    """
+    Lift the soft open-files limit to the hard limit, so one process
+    can hold tens of thousands of idle sockets.
+    """
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or hard > soft:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
@@ -0,0 +1,537 @@
+import threading
+import collections
+import time
+import os
+import email.utils
+import struct
+import itertools
+
+from proxy_codings import GZIP_HEADERS, GZIP_MIN_BYTES, client_accepts_gzip, Compressor
+from proxy_http import parse_http_head, header_dict, RESPONSE_SKIP_HEADERS, build_response_head
+from proxy_logging import join_head
+
+# ***************** RESPONSE CACHE *****************
+# Responses are stored after the rewrite, so a hit is sent as it is,
+# without opening an upstream socket.
+
+# Response cache (-c <MB> sets the memory budget, 0 turns it off; -d <dir>
+# adds a disk tier that entries evicted from memory spill to; each process
+# uses its own file names, and removes those left by earlier runs when it
+# starts)
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+CACHE_MAX_ENTRY_BYTES = 8 * 1024 * 1024
+CACHE_SPILL_MAX_BYTES = 512 * 1024 * 1024
+
+# How long a request waits for an identical one already in flight. A URL
+# whose last response could not be shared (not storable) is fetched
+# without coalescing for SINGLE_FLIGHT_NEGATIVE_TTL seconds; at most
+# SINGLE_FLIGHT_NEGATIVE_MAX such URLs are remembered.
+SINGLE_FLIGHT_TIMEOUT = 30.0
+SINGLE_FLIGHT_NEGATIVE_TTL = 10.0
+SINGLE_FLIGHT_NEGATIVE_MAX = 10000
+
+# Statuses a shared cache may store (with explicit freshness or validators)
+CACHEABLE_STATUS = {200, 203, 300, 301, 404, 410}
+
+def parse_cache_control(value):
+    """
+    Parse a Cache-Control header into {directive: argument or None}.
+    """
+    directives = {}
+    for part in value.lower().split(b","):
+        name, _, arg = part.strip().partition(b"=")
+        if name:
+            directives[name] = arg.strip(b'"') if arg else None
+    return directives
+
+def parse_http_date(value):
+    """
+    Parse an HTTP date into a timestamp, or None.
+    """
+    try:
+        return email.utils.parsedate_to_datetime(value.decode('latin-1')).timestamp()
+    except (TypeError, ValueError, IndexError, AttributeError):
+        return None
+
+def freshness_lifetime(resp_header_dict, cc):
+    """
+    How long (seconds) a response is fresh: s-maxage, max-age, Expires,
+    or 10% of its age since Last-Modified (at most an hour).
+    """
+    if b"no-cache" in cc:
+        return 0
+    for directive in (b"s-maxage", b"max-age"):
+        if directive in cc:
+            try:
+                return max(0, int(cc[directive]))
+            except (TypeError, ValueError):
+                return 0
+    date = parse_http_date(resp_header_dict.get(b"date", b"")) or time.time()
+    if b"expires" in resp_header_dict:
+        expires = parse_http_date(resp_header_dict[b"expires"])
+        return max(0, expires - date) if expires is not None else 0
+    last_modified = parse_http_date(resp_header_dict.get(b"last-modified", b""))
+    if last_modified is not None:
+        return min(3600, max(0, (date - last_modified) / 10))
+    return 0
+
+def request_cacheable(req_header_dict, request_body_length):
+    """
+    Whether the cache may answer (and store the answer to) a GET.
+    """
+    if request_body_length or b"authorization" in req_header_dict:
+        return False
+    return b"no-store" not in parse_cache_control(req_header_dict.get(b"cache-control", b""))
+
+def request_wants_revalidation(req_header_dict):
+    cc = parse_cache_control(req_header_dict.get(b"cache-control", b""))
+    return (b"no-cache" in cc or cc.get(b"max-age", b"") == b"0" or
+            b"no-cache" in req_header_dict.get(b"pragma", b"").lower())
+
+def response_storable(status, resp_header_dict):
+    if status not in CACHEABLE_STATUS:
+        return False
+    cc = parse_cache_control(resp_header_dict.get(b"cache-control", b""))
+    if b"no-store" in cc or b"private" in cc:
+        return False
+    if b"set-cookie" in resp_header_dict or resp_header_dict.get(b"vary", b"").strip() == b"*":
+        return False
+    return (freshness_lifetime(resp_header_dict, cc) > 0 or
+            b"etag" in resp_header_dict or b"last-modified" in resp_header_dict)
+
+class CacheEntry(object):
+    """
+    One stored response: status line, end-to-end header fields (raw lines
+    as bytes), the rewritten identity body and its freshness.
+    """
+
+    def __init__(self, status_line, response_fields, body, req_header_dict):
+        self.status_line = status_line
+        self.fields = [(name, value, bytes(raw)) for name, value, raw in response_fields
+                       if name not in RESPONSE_SKIP_HEADERS and name != b"age"]
+        self.body = body
+        # text we would gzip on the way out is kept gzipped as well
+        self.gzip_body = None
+        resp_header_dict = header_dict(self.fields)
+        if (len(body) >= GZIP_MIN_BYTES and b"text" in resp_header_dict.get(b"content-type", b"").lower()
+                and b"content-encoding" not in resp_header_dict):
+            compressor = Compressor()
+            self.gzip_body = compressor.feed(body) + compressor.flush()
+        # fixed while the entry is in the cache, so the byte count stays right
+        self.size = (len(body) + len(self.gzip_body or b"") +
+                     sum(len(raw) for _, _, raw in self.fields) + 256)
+        self.update_freshness(response_fields)
+        self.vary = {}
+        for name in header_dict(self.fields).get(b"vary", b"").lower().split(b","):
+            name = name.strip()
+            if name:
+                self.vary[name] = req_header_dict.get(name)
+
+    def update_freshness(self, response_fields):
+        resp_header_dict = header_dict(response_fields)
+        cc = parse_cache_control(resp_header_dict.get(b"cache-control", b""))
+        try:
+            age = int(resp_header_dict.get(b"age", b"0"))
+        except ValueError:
+            age = 0
+        self.stored_at = time.time() - age
+        self.expires_at = self.stored_at + freshness_lifetime(resp_header_dict, cc)
+        self.must_revalidate = b"no-cache" in cc
+
+    def header(self, name):
+        return header_dict(self.fields).get(name)
+
+    def is_fresh(self):
+        return not self.must_revalidate and time.time() < self.expires_at
+
+    def matches(self, req_header_dict):
+        return all(req_header_dict.get(name) == value for name, value in self.vary.items())
+
+    def validators(self):
+        """
+        Conditional header lines to revalidate this entry upstream.
+        """
+        lines = []
+        etag = self.header(b"etag")
+        if etag:
+            lines.append(b"If-None-Match: " + etag)
+        last_modified = self.header(b"last-modified")
+        if last_modified:
+            lines.append(b"If-Modified-Since: " + last_modified)
+        return lines
+
+    def refresh(self, response_fields):
+        """
+        The server answered 304 to our revalidation: take its new headers.
+        """
+        fresh = {name: (name, value, bytes(raw)) for name, value, raw in response_fields
+                 if name not in RESPONSE_SKIP_HEADERS and name != b"age"}
+        self.fields = [fresh.pop(name, (name, value, raw)) for name, value, raw in self.fields]
+        self.fields.extend(fresh.values())
+        self.update_freshness(response_fields)
+
+    def not_modified_for(self, req_header_dict):
+        """
+        Whether the client's own conditional headers let us answer 304.
+        """
+        if_none_match = req_header_dict.get(b"if-none-match")
+        if if_none_match is not None:
+            etag = self.header(b"etag")
+            if etag is None:
+                return False
+            tags = [t.strip() for t in if_none_match.split(b",")]
+            return b"*" in tags or strip_weak(etag) in [strip_weak(t) for t in tags]
+        if_modified_since = parse_http_date(req_header_dict.get(b"if-modified-since", b""))
+        last_modified = parse_http_date(self.header(b"last-modified") or b"")
+        return (if_modified_since is not None and last_modified is not None and
+                last_modified <= if_modified_since)
+
+    def response(self, http_version, req_header_dict, keep_alive):
+        """
+        The full response (head and body) to send for this entry.
+        """
+        age = b"Age: %d" % max(0, time.time() - self.stored_at)
+        if self.not_modified_for(req_header_dict):
+            fields = [f for f in self.fields if f[0] in NOT_MODIFIED_HEADERS]
+            return build_response_head(f"{http_version} 304 Not Modified", fields,
+                                       keep_alive=keep_alive, extra=[age])
+        if self.gzip_body is not None and client_accepts_gzip(req_header_dict):
+            return build_response_head(self.status_line, self.fields, content_length=len(self.gzip_body),
+                                       keep_alive=keep_alive, extra=[age, *GZIP_HEADERS]) + self.gzip_body
+        return build_response_head(self.status_line, self.fields, content_length=len(self.body),
+                                   keep_alive=keep_alive, extra=[age]) + self.body
+
+    def spill_data(self):
+        """
+        The entry as a spill file: SPILL_HEADER, then the head, the Vary
+        request headers ("name: value", or just "name" if the request had
+        none), the body and the gzipped body.
+        """
+        head = join_head(self.status_line, self.fields)
+        vary = b"\r\n".join(name if value is None else name + b": " + value
+                             for name, value in self.vary.items())
+        gzip_body = self.gzip_body if self.gzip_body is not None else b""
+        header = SPILL_HEADER.pack(SPILL_MAGIC, self.stored_at, self.expires_at, self.must_revalidate,
+                                   self.size, len(head), len(vary), len(self.body),
+                                   -1 if self.gzip_body is None else len(gzip_body))
+        return header + head + vary + self.body + gzip_body
+
+    @classmethod
+    def from_spill(cls, data):
+        """
+        The entry back from spill_data(). Raises ValueError if 'data' is not one.
+        """
+        try:
+            (magic, stored_at, expires_at, must_revalidate, size, head_length, vary_length,
+             body_length, gzip_length) = SPILL_HEADER.unpack_from(data)
+        except struct.error:
+            raise ValueError("spill file too short")
+        if magic != SPILL_MAGIC:
+            raise ValueError("not a spill file")
+        pos = SPILL_HEADER.size
+        if len(data) != pos + head_length + vary_length + body_length + max(gzip_length, 0):
+            raise ValueError("spill file has the wrong length")
+        entry = cls.__new__(cls)
+        entry.status_line, fields = parse_http_head(data[pos:pos + head_length])
+        entry.fields = [(name, value, bytes(raw)) for name, value, raw in fields]
+        pos += head_length
+        entry.vary = {}
+        for line in data[pos:pos + vary_length].split(b"\r\n"):
+            if line:
+                name, colon, value = line.partition(b":")
+                entry.vary[name] = value.strip() if colon else None
+        pos += vary_length
+        entry.body = data[pos:pos + body_length]
+        pos += body_length
+        entry.gzip_body = data[pos:] if gzip_length >= 0 else None
+        entry.stored_at, entry.expires_at = stored_at, expires_at
+        entry.must_revalidate = bool(must_revalidate)
+        entry.size = size
+        return entry
+
+# Spill file header: magic, stored_at, expires_at, must_revalidate, size,
+# then the lengths of the head, the Vary block, the body and the gzipped
+# body (-1 for none)
+SPILL_MAGIC = b"FNPSPILL1"
+SPILL_HEADER = struct.Struct("<9sdd?IIIIi")
+
+# Headers sent along with a 304 made from a cache entry
+NOT_MODIFIED_HEADERS = {b"cache-control", b"content-location", b"date", b"etag",
+                        b"expires", b"last-modified", b"vary"}
+
+def strip_weak(etag):
+    return etag[2:] if etag.startswith(b"W/") else etag
+
+class ResponseCache(object):
+    """
+    Shared in-memory response cache with a byte budget and LRU eviction.
+    With a spill directory, entries evicted from memory are written there
+    (with their own byte budget, also LRU) and moved back on a hit. The
+    lock only guards the bookkeeping: spill files are written by
+    write_spills() and read back by lookup() with it released, and the
+    asyncio engine calls both from an executor thread.
+    """
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, max_entry_bytes=CACHE_MAX_ENTRY_BYTES,
+                 spill_dir=None, spill_max_bytes=CACHE_SPILL_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()    # key -> CacheEntry, oldest first
+        self.bytes = 0
+        self.spilled = collections.OrderedDict()    # key -> (file name, size)
+        self.spilled_bytes = 0
+        self.pending = []       # (key, entry) evicted, to be written by write_spills()
+        self.stale = []         # spill files to be removed by write_spills()
+        self.file_ids = itertools.count(1)
+        self.hits = 0
+        self.misses = 0
+        if spill_dir:
+            self.clear_spill_dir()
+
+    def clear_spill_dir(self):
+        # Spill files are named <pid>-<n>.cache. Those of processes that
+        # are gone (earlier runs) are removed; we only ever read our own.
+        os.makedirs(self.spill_dir, mode=0o700, exist_ok=True)
+        for name in os.listdir(self.spill_dir):
+            pid, dash, rest = name.partition("-")
+            if not (dash and pid.isdigit() and rest.endswith(".cache")):
+                continue
+            if int(pid) != os.getpid():
+                try:
+                    os.kill(int(pid), 0)
+                    continue
+                except ProcessLookupError:
+                    pass
+                except OSError:
+                    continue
+            try:
+                os.remove(os.path.join(self.spill_dir, name))
+            except OSError:
+                pass
+
+    def on_disk(self, key):
+        return key in self.spilled
+
+    def spills_pending(self):
+        return bool(self.pending or self.stale)
+
+    def lookup(self, key, req_header_dict, load=True):
+        """
+        Returns the entry for 'key' if it was stored for a matching request.
+        A spilled entry is read back from disk, or is a miss with load=False.
+        """
+        with self.lock:
+            spilled = None
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            elif load and key in self.spilled:
+                spilled, size = self.spilled.pop(key)
+                self.spilled_bytes -= size
+            if spilled is None:
+                return self.count(entry, req_header_dict)
+        entry = self.unspill(key, spilled)
+        with self.lock:
+            return self.count(entry, req_header_dict)
+
+    def count(self, entry, req_header_dict):
+        # called with the lock held
+        if entry is None or not entry.matches(req_header_dict):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def store(self, key, entry):
+        if entry.size > self.max_entry_bytes:
+            return
+        with self.lock:
+            self.remove(key)
+            self.insert(key, entry)
+
+    def insert(self, key, entry):
+        # called with the lock held; what it evicts waits in self.pending
+        self.entries[key] = entry
+        self.bytes += entry.size
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            old_key, old_entry = self.entries.popitem(last=False)
+            self.bytes -= old_entry.size
+            if self.spill_dir and old_entry.size <= self.spill_max_bytes:
+                self.pending.append((old_key, old_entry))
+
+    def remove(self, key):
+        # called with the lock held
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+        if key in self.spilled:
+            self.drop_spilled(key)
+
+    def drop_spilled(self, key):
+        # called with the lock held
+        path, size = self.spilled.pop(key)
+        self.spilled_bytes -= size
+        self.stale.append(path)
+
+    def unspill(self, key, path):
+        """
+        Read a spilled entry back and move it into memory. Returns it, or
+        None if its file is gone or damaged.
+        """
+        try:
+            with open(path, "rb") as f:
+                entry = CacheEntry.from_spill(f.read())
+        except (OSError, ValueError):
+            entry = None
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        if entry is None:
+            return None
+        with self.lock:
+            if key in self.entries:
+                # stored again while we were reading
+                return self.entries[key]
+            self.insert(key, entry)
+        self.write_spills()
+        return entry
+
+    def write_spills(self):
+        """
+        Write the entries evicted from memory to the spill directory and
+        remove the spill files no longer needed.
+        """
+        while True:
+            with self.lock:
+                if not self.pending and not self.stale:
+                    return
+                pending, self.pending = self.pending, []
+                stale, self.stale = self.stale, []
+            for path in stale:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            for key, entry in pending:
+                path = os.path.join(self.spill_dir, "%d-%d.cache" % (os.getpid(), next(self.file_ids)))
+                try:
+                    with open(path, "wb") as f:
+                        f.write(entry.spill_data())
+                except OSError:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                    continue
+                with self.lock:
+                    if key in self.entries:
+                        # stored again while we were writing
+                        self.stale.append(path)
+                        continue
+                    if key in self.spilled:
+                        self.drop_spilled(key)
+                    self.spilled[key] = (path, entry.size)
+                    self.spilled_bytes += entry.size
+                    while self.spilled_bytes > self.spill_max_bytes:
+                        self.drop_spilled(next(iter(self.spilled)))
+
+class BodyCapture(object):
+    """
+    Pipeline stage that copies the body it passes on, for the cache.
+    Gives up (data becomes None) once the body is bigger than max_bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.data = bytearray()
+
+    def feed(self, data):
+        if self.data is not None:
+            if len(self.data) + len(data) > self.max_bytes:
+                self.data = None
+            else:
+                self.data += data
+        return data
+
+    def flush(self):
+        return b""
+
+RESPONSE_CACHE = None   # a ResponseCache, set up by main()
+
+class Flight(object):
+    """
+    One upstream fetch that other identical requests wait for.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+    def wait(self, timeout):
+        self.done.wait(timeout)
+        return self.result
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent identical cacheable GETs, keyed on
+    (method, host, port, path): the first one (the leader) goes upstream,
+    the rest wait and get the leader's CacheEntry. If the leader has
+    nothing to share (an error, or a response that may not be shared) they
+    fetch on their own; the leader lets them go as soon as it has the
+    response head. Keys whose last response was not storable are not
+    coalesced for a while (the negative memo), their followers would
+    only wait for nothing.
+    """
+
+    def __init__(self, negative_ttl=SINGLE_FLIGHT_NEGATIVE_TTL, negative_max=SINGLE_FLIGHT_NEGATIVE_MAX):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.coalesced = 0
+        self.negative_ttl = negative_ttl
+        self.negative_max = negative_max
+        self.unstorable = collections.OrderedDict()     # key -> until
+
+    def join(self, key):
+        """
+        Returns (flight, leader); flight is None for a key in the negative memo.
+        """
+        with self.lock:
+            return self.join_locked(key, Flight)
+
+    def join_locked(self, key, new_flight):
+        until = self.unstorable.get(key)
+        if until is not None:
+            if until > time.monotonic():
+                return None, True
+            del self.unstorable[key]
+        flight = self.flights.get(key)
+        if flight is not None:
+            self.coalesced += 1
+            return flight, False
+        flight = self.flights[key] = new_flight()
+        return flight, True
+
+    def finish(self, key, flight, result, storable=True):
+        """
+        Hand 'result' to the flight's followers. With storable=False the
+        key goes into the negative memo.
+        """
+        with self.lock:
+            self.finish_locked(key, flight, storable)
+        flight.result = result
+        flight.done.set()
+
+    def finish_locked(self, key, flight, storable):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+        if not storable:
+            self.unstorable[key] = time.monotonic() + self.negative_ttl
+            self.unstorable.move_to_end(key)
+            while len(self.unstorable) > self.negative_max:
+                self.unstorable.popitem(last=False)
+
+SINGLE_FLIGHT = SingleFlight()
@@ -0,0 +1,365 @@
+import re
+import time
+import zlib
+
+from proxy_http import header_dict
+from proxy_logging import note_access
+from proxy_metrics import METRICS
+
+# ***************** BODIES *****************
+# Reading bodies (Content-Length, chunked or until EOF) in pieces, sending
+# them on through the body stages, and the content codings we can undo
+# and apply on the way.
+
+# zlib level (1-9) for text bodies we gzip for clients that accept it (-z)
+COMPRESS_LEVEL = 6
+
+def encode_chunk(data):
+    """
+    Frame 'data' as one chunk of a chunked transfer-encoded body.
+    """
+    return b"%x\r\n" % len(data) + data + b"\r\n"
+
+LAST_CHUNK = b"0\r\n\r\n"
+
+# Trailer fields that would be wrong after a rewrite, or are not allowed there
+TRAILER_SKIP_HEADERS = {b"content-length", b"transfer-encoding", b"content-md5",
+                        b"digest", b"connection", b"content-encoding"}
+
+def last_chunk(trailers=()):
+    """
+    The zero-size chunk ending a chunked body, with any trailer lines.
+    """
+    lines = [t for t in trailers
+             if t.split(b":", 1)[0].strip().lower() not in TRAILER_SKIP_HEADERS]
+    if not lines:
+        return LAST_CHUNK
+    return b"0\r\n" + b"\r\n".join(lines) + b"\r\n\r\n"
+
+class ChunkedDecoder(object):
+    """
+    Incremental decoder for a chunked transfer-encoded body. feed() takes
+    raw bytes as they arrive and returns the body bytes decoded so far.
+    When the last chunk and the trailers have been read 'done' is set,
+    'trailers' holds the trailer lines and 'unused' whatever came after.
+    """
+
+    MAX_LINE = 8192
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.state = "size"
+        self.remaining = 0
+        self.trailers = []
+        self.done = False
+        self.unused = b""
+
+    def feed(self, data):
+        if self.done:
+            self.unused += data
+            return b""
+        # while inside a chunk and with nothing buffered, slice 'data' directly
+        out = []
+        if self.state == "data" and not self.buf:
+            n = min(self.remaining, len(data))
+            out.append(data[:n])
+            self.remaining -= n
+            data = data[n:]
+            if self.remaining == 0:
+                self.state = "crlf"
+        buf = self.buf
+        buf += data
+        pos = 0
+        while pos < len(buf):
+            if self.state == "data":
+                n = min(self.remaining, len(buf) - pos)
+                out.append(bytes(buf[pos:pos + n]))
+                pos += n
+                self.remaining -= n
+                if self.remaining:
+                    break
+                self.state = "crlf"
+                continue
+            nl = buf.find(b"\n", pos)
+            if nl == -1:
+                if len(buf) - pos > self.MAX_LINE:
+                    raise ConnectionError("chunked body line too long")
+                break
+            line = bytes(buf[pos:nl])
+            pos = nl + 1
+            if self.state == "crlf":
+                if line not in (b"", b"\r"):
+                    raise ConnectionError("chunk not followed by CRLF")
+                self.state = "size"
+            elif self.state == "size":
+                size = parse_chunk_size(line)
+                if size == 0:
+                    self.state = "trailer"
+                else:
+                    self.remaining = size
+                    self.state = "data"
+            elif self.state == "trailer":
+                line = line.rstrip(b"\r")
+                if not line:
+                    self.done = True
+                    self.unused = bytes(buf[pos:])
+                    pos = len(buf)
+                    break
+                self.trailers.append(line)
+        del buf[:pos]
+        return b"".join(out)
+
+# Hex digits only: int(x, 16) alone would also take a sign, "0x" and "_"
+CHUNK_SIZE = re.compile(rb"[0-9A-Fa-f]{1,16}")
+
+def parse_chunk_size(line):
+    size = line.split(b";", 1)[0].strip(b" \t\r")
+    if not CHUNK_SIZE.fullmatch(size):
+        raise ConnectionError(f"bad chunk size line {line[:40]!r}")
+    return int(size, 16)
+
+class PlainBody(object):
+    """
+    The counterpart of ChunkedDecoder for a body delimited by Content-Length
+    or by the server closing the connection: body_chunks sets 'done' once
+    the whole body has been read.
+    """
+
+    def __init__(self):
+        self.done = False
+        self.trailers = ()
+        self.unused = b""
+
+def body_chunks(reader, length=None, body=None):
+    """
+    Yield the body from 'reader': exactly 'length' bytes, or until EOF.
+    Raises ConnectionError if the server closes before 'length' bytes.
+    Sets body.done (a PlainBody) when the body is complete.
+    """
+    remaining = length
+    while remaining is None or remaining > 0:
+        chunk = reader.recv(65536 if remaining is None else min(65536, remaining))
+        if not chunk:
+            if remaining is not None:
+                raise ConnectionError(f"server closed {remaining} bytes short of the body")
+            break
+        if remaining is not None:
+            remaining -= len(chunk)
+        yield chunk
+    if body is not None:
+        body.done = True
+
+def chunked_body_chunks(reader, decoder):
+    """
+    Yield the decoded body of a chunked response from 'reader'. Anything
+    read past its end goes back into the reader's buffer.
+    """
+    while not decoder.done:
+        data = reader.recv(65536)
+        if not data:
+            raise ConnectionError("server closed inside a chunked body")
+        out = decoder.feed(data)
+        if out:
+            yield out
+    if decoder.unused:
+        reader.buf[:0] = decoder.unused
+
+def response_body(reader, content_length, is_chunked):
+    """
+    Returns (chunks, decoder): the decoded body of a response as an
+    iterator, and its ChunkedDecoder (for the trailers) or PlainBody.
+    Either one's 'done' tells whether the whole body came in.
+    """
+    if is_chunked:
+        decoder = ChunkedDecoder()
+        return chunked_body_chunks(reader, decoder), decoder
+    decoder = PlainBody()
+    return body_chunks(reader, content_length, decoder), decoder
+
+def run_stages(stages, data, final=False):
+    """
+    Push 'data' through the pipeline stages (objects with feed/flush).
+    With final=True every stage is flushed, in order.
+    """
+    for stage in stages:
+        data = stage.feed(data) if data else b""
+        if final:
+            data += stage.flush()
+    return data
+
+def send_body(chunks, sock_out, chunked=True, stages=(), decoder=None):
+    """
+    Send 'chunks' to 'sock_out' through 'stages', chunk-encoded if 'chunked'.
+    The trailers of a chunked source ('decoder') are passed on at the end.
+    Records the time spent in the stages and the body bytes in and out.
+    If the server cuts the body short, the ConnectionError from 'chunks'
+    goes on to the caller, which closes the client connection: the last
+    chunk is never sent, so the client can tell the body is incomplete.
+    """
+    spent = 0.0
+    read = sent = 0
+    for chunk in chunks:
+        read += len(chunk)
+        t = time.perf_counter()
+        out = run_stages(stages, chunk)
+        spent += time.perf_counter() - t
+        if out:
+            sent += len(out)
+            sock_out.sendall(encode_chunk(out) if chunked else out)
+    t = time.perf_counter()
+    out = run_stages(stages, b"", final=True)
+    spent += time.perf_counter() - t
+    sent += len(out)
+    if chunked:
+        end = last_chunk(decoder.trailers if decoder is not None else ())
+        sock_out.sendall((encode_chunk(out) if out else b"") + end)
+    elif out:
+        sock_out.sendall(out)
+    record_body(stages, spent, read, sent)
+
+def record_forwarded(moved, length):
+    """
+    record_body for a body sent with forward_raw; raises ConnectionError
+    (the client connection is then closed) if it came up short of 'length'.
+    """
+    record_body((), 0.0, moved, moved)
+    if moved != length:
+        raise ConnectionError(f"server closed {length - moved} bytes short of the body")
+
+def record_body(stages, spent, read, sent):
+    if stages:
+        METRICS.observe("rewrite", spent)
+    METRICS.count("upstream_body_bytes", read)
+    METRICS.count("client_body_bytes", sent)
+    note_access(sent=sent, read=read)
+
+# Content-codings we can undo to rewrite a text body, by their name in
+# Content-Encoding ("" is no coding at all)
+CONTENT_CODINGS = {b"": b"", b"identity": b"", b"gzip": b"gzip", b"x-gzip": b"gzip",
+                   b"deflate": b"deflate"}
+
+# Sent along with a body we gzip ourselves
+GZIP_HEADERS = (b"Content-Encoding: gzip", b"Vary: Accept-Encoding")
+
+# Cached text bodies smaller than this are not worth keeping gzipped
+GZIP_MIN_BYTES = 256
+
+def content_coding(resp_header_dict):
+    """
+    The coding of a response body as a key of CONTENT_CODINGS' values,
+    or None if it is one we cannot decode (or several stacked).
+    """
+    return CONTENT_CODINGS.get(resp_header_dict.get(b"content-encoding", b"").strip().lower())
+
+def accepted_codings(req_header_dict):
+    """
+    The content-codings named in the client's Accept-Encoding with q > 0.
+    """
+    codings = set()
+    for item in req_header_dict.get(b"accept-encoding", b"").lower().split(b","):
+        coding, _, params = item.partition(b";")
+        coding = coding.strip()
+        q = params.strip()
+        if q.startswith(b"q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            codings.add(coding)
+    return codings
+
+def client_accepts_gzip(req_header_dict):
+    codings = accepted_codings(req_header_dict)
+    return bool(codings & {b"gzip", b"x-gzip", b"*"})
+
+def upstream_accept_encoding(request_fields):
+    """
+    The Accept-Encoding line to send upstream: the client's, cut down to
+    the codings we can decode, so a text body always reaches the rewriter.
+    None when nothing is left (the server then sends identity).
+    """
+    codings = accepted_codings(header_dict(request_fields))
+    if b"*" in codings:
+        codings |= {b"gzip", b"deflate"}
+    keep = [c for c in (b"gzip", b"deflate") if c in codings or (c == b"gzip" and b"x-gzip" in codings)]
+    return b"Accept-Encoding: " + b", ".join(keep) if keep else None
+
+class Decompressor(object):
+    """
+    Pipeline stage undoing a gzip or deflate content-coding as the body
+    flows through. "deflate" is zlib-wrapped by the spec, but some servers
+    send a raw deflate stream, and some label one coding as the other; the
+    first two bytes tell which. They are held back until both are in, and
+    a body shorter than that is passed on as it is.
+    """
+
+    def __init__(self, coding):
+        self.coding = coding
+        self.obj = None
+        self.gzip = False
+        self.head = b""
+
+    def start(self, head):
+        self.gzip = head[:2] == b"\x1f\x8b"
+        zlib_wrapped = (head[0] & 0x0f) == 8 and ((head[0] << 8) | head[1]) % 31 == 0
+        if self.gzip:
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return zlib.decompressobj(zlib.MAX_WBITS if zlib_wrapped else -zlib.MAX_WBITS)
+
+    def feed(self, data):
+        if self.obj is None:
+            self.head += data
+            if len(self.head) < 2:
+                return b""
+            data, self.head = self.head, b""
+            self.obj = self.start(data)
+        try:
+            out = self.obj.decompress(data)
+            # a gzip body may be several members one after the other
+            while self.obj.eof and self.obj.unused_data and self.gzip:
+                rest = self.obj.unused_data
+                self.obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                out += self.obj.decompress(rest)
+        except zlib.error as e:
+            raise ConnectionError(f"bad {self.coding.decode()} body: {e}")
+        return out
+
+    def flush(self):
+        if self.obj is None:
+            # too short to be compressed at all
+            head, self.head = self.head, b""
+            return head
+        try:
+            return self.obj.flush()
+        except zlib.error as e:
+            raise ConnectionError(f"bad {self.coding.decode()} body: {e}")
+
+class Compressor(object):
+    """
+    Pipeline stage gzipping the body for the client.
+    """
+
+    def __init__(self, level=None):
+        self.obj = zlib.compressobj(COMPRESS_LEVEL if level is None else level,
+                                    zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def feed(self, data):
+        return self.obj.compress(data)
+
+    def flush(self):
+        return self.obj.flush(zlib.Z_FINISH)
+
+def transcoding(resp_header_dict, req_header_dict, response_fields):
+    """
+    For a body we rewrite: returns (coding, compress, fields, extra), the
+    content-coding to undo on the way in, whether to gzip the result for
+    the client, the response fields to send (without a Content-Encoding
+    we undid) and the extra header lines for our own coding.
+    """
+    coding = content_coding(resp_header_dict)
+    compress = client_accepts_gzip(req_header_dict)
+    if coding:
+        response_fields = [f for f in response_fields if f[0] != b"content-encoding"]
+    return coding, compress, response_fields, GZIP_HEADERS if compress else ()
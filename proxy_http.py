@@ -0,0 +1,428 @@
+import socket
+import re
+import time
+import os
+import select
+import errno
+try:
+    import fcntl
+except ImportError:    # not on Windows
+    fcntl = None
+
+# ***************** HTTP *****************
+# Reading, parsing and relaying HTTP/1.x heads and raw bytes on plain
+# sockets; shared by both engines, the tunnels and the tools.
+
+BUFSIZE = 4096
+
+# Raw bodies (images, binaries) are moved socket to socket with splice()
+# on Linux; bodies smaller than SPLICE_MIN_BYTES are not worth the pipe.
+# Without splice they are copied through a buffer that starts at BUFSIZE
+# and doubles up to FORWARD_MAX_BUFSIZE while reads come back full.
+SPLICE = hasattr(os, "splice")
+SPLICE_MIN_BYTES = 64 * 1024
+SPLICE_PIPE_SIZE = 1024 * 1024
+FORWARD_MAX_BUFSIZE = 1024 * 1024
+
+# A request or response head may be no bigger than this
+MAX_HEADER_BYTES = 64 * 1024
+
+# A blank line (CRLF or bare LF) ends a header block
+HEADER_END = re.compile(rb"\n\r?\n")
+
+class SocketReader(object):
+    """
+    Buffered reader on top of a socket. Reads large blocks and hands out
+    lines and header blocks from the buffer; whatever is left over after
+    the headers is returned first by recv(), so the body readers
+    (body_chunks, forward_raw) can take a SocketReader
+    wherever they take a socket.
+    """
+
+    def __init__(self, sock, bufsize=65536):
+        self.sock = sock
+        self.bufsize = bufsize
+        self.buf = bytearray()
+        self.deadline = None    # time.monotonic() by which a fill must be done
+
+    def fill(self):
+        if self.deadline is not None:
+            left = self.deadline - time.monotonic()
+            if left <= 0:
+                raise socket.timeout("deadline passed")
+            self.sock.settimeout(left)
+        chunk = self.sock.recv(self.bufsize)
+        if chunk:
+            self.buf += chunk
+        return len(chunk)
+
+    def recv(self, n):
+        if self.buf:
+            data = bytes(self.buf[:n])
+            del self.buf[:n]
+            return data
+        return self.sock.recv(n)
+
+    def read_line(self):
+        """
+        Read one line (until b'\n') or return None if EOF.
+        """
+        start = 0
+        while True:
+            pos = self.buf.find(b'\n', start)
+            if pos != -1:
+                line = bytes(self.buf[:pos + 1])
+                del self.buf[:pos + 1]
+                return line
+            start = len(self.buf)
+            if start > MAX_HEADER_BYTES:
+                raise HeaderTooLarge("line too long")
+            if not self.fill():
+                if not self.buf:
+                    return None
+                line = bytes(self.buf)
+                self.buf.clear()
+                return line
+
+    def read_header_block(self):
+        """
+        Read up to and including the blank line ending a header block.
+        Leading empty lines are skipped. Returns b"" on EOF.
+        """
+        while True:
+            while self.buf[:1] in (b"\r", b"\n"):
+                del self.buf[:1]
+            if self.buf:
+                break
+            if not self.fill():
+                return b""
+
+        start = 0
+        while True:
+            m = HEADER_END.search(self.buf, start)
+            if m:
+                if m.end() > MAX_HEADER_BYTES:
+                    raise HeaderTooLarge("header block too large")
+                block = bytes(self.buf[:m.end()])
+                del self.buf[:m.end()]
+                return block
+            start = max(0, len(self.buf) - 2)
+            if start > MAX_HEADER_BYTES:
+                raise HeaderTooLarge("header block too large")
+            if not self.fill():
+                block = bytes(self.buf)
+                self.buf.clear()
+                return block
+
+class HeaderTooLarge(ConnectionError):
+    """
+    A header block (or line) went over MAX_HEADER_BYTES.
+    """
+
+def read_http_headers(reader):
+    """
+    Reads an HTTP header block from 'reader' (a SocketReader), stopping at
+    the first blank line.
+    Returns (start_line, fields) as parsed by parse_http_head, or
+    (None, []) if the socket closes before any headers are read.
+    """
+    block = reader.read_header_block()
+    if not block:
+        return None, []
+    return parse_http_head(block)
+
+def read_line(reader):
+    """
+    Read one line (until '\n') from the reader or return None if EOF.
+    """
+    return reader.read_line()
+
+def parse_http_head(block):
+    """
+    Parse a raw header block without decoding it.
+    Returns (start_line, fields): start_line is the decoded first line and
+    fields is a list of (lowercase name, value, raw line) where name and
+    value are bytes and raw line is a memoryview into 'block'.
+    """
+    view = memoryview(block)
+    fields = []
+    start_line = None
+    pos = 0
+    end_of_block = len(block)
+    while pos < end_of_block:
+        nl = block.find(b"\n", pos)
+        if nl == -1:
+            nl = end_of_block
+        end = nl
+        if end > pos and block[end - 1] == 13:  # '\r'
+            end -= 1
+        if end == pos:
+            break
+        if start_line is None:
+            start_line = str(view[pos:end], 'latin-1')
+        else:
+            colon = block.find(b":", pos, end)
+            if colon != -1:
+                name = bytes(view[pos:colon]).strip().lower()
+                value = bytes(view[colon + 1:end]).strip()
+                fields.append((name, value, view[pos:end]))
+        pos = nl + 1
+    return start_line, fields
+
+def header_dict(fields):
+    """
+    Turn parsed header fields into a dict {lowercase name: value} (bytes).
+    """
+    return {name: value for name, value, _ in fields}
+
+def forward_raw(sock_in, sock_out, length=None):
+    """
+    Forward raw bytes from sock_in to sock_out.
+    If length is specified, read exactly that many bytes.
+    Otherwise, read until EOF from sock_in.
+    Bytes already buffered in a SocketReader go first; the rest is moved
+    socket to socket with splice() where we have it, else copied through
+    a buffer that grows while the data keeps coming in full reads.
+    Returns the number of bytes forwarded.
+    """
+    sent = 0
+    if isinstance(sock_in, SocketReader):
+        if sock_in.buf:
+            data = sock_in.recv(len(sock_in.buf) if length is None else length)
+            sock_out.sendall(data)
+            sent = len(data)
+            if length is not None:
+                length -= len(data)
+        sock_in = sock_in.sock
+    if length == 0:
+        return sent
+    if SPLICE and (length is None or length >= SPLICE_MIN_BYTES):
+        try:
+            return sent + splice_forward(sock_in, sock_out, length)
+        except SpliceUnsupported:
+            pass
+    return sent + copy_forward(sock_in, sock_out, length)
+
+def copy_forward(sock_in, sock_out, length=None):
+    size = BUFSIZE
+    buf = bytearray(FORWARD_MAX_BUFSIZE if length is None else min(length, FORWARD_MAX_BUFSIZE))
+    view = memoryview(buf)
+    remaining = length
+    sent = 0
+    while remaining is None or remaining > 0:
+        want = min(size, len(buf)) if remaining is None else min(size, remaining)
+        n = sock_in.recv_into(view[:want])
+        if not n:
+            break
+        sock_out.sendall(view[:n])
+        sent += n
+        if remaining is not None:
+            remaining -= n
+        if n == size and size < FORWARD_MAX_BUFSIZE:
+            size *= 2
+    return sent
+
+class SpliceUnsupported(Exception):
+    """
+    splice() refused the file descriptors before any byte was moved.
+    """
+
+def socket_ready(sock, write=False, timeout=0.0):
+    """
+    Whether 'sock' is readable (or writable) within 'timeout' seconds,
+    None to wait for ever. poll() where there is one: select() cannot take
+    descriptors above FD_SETSIZE, and a busy proxy has those.
+    """
+    if hasattr(select, "poll"):
+        poller = select.poll()
+        poller.register(sock, select.POLLOUT if write else select.POLLIN)
+        return bool(poller.poll(None if timeout is None else timeout * 1000))
+    ready = select.select([], [sock], [], timeout) if write else select.select([sock], [], [], timeout)
+    return bool(ready[1] or ready[0])
+
+def wait_ready(sock, write=False):
+    """
+    Wait until a non-blocking socket (one with a timeout) is readable or
+    writable, raising socket.timeout after its timeout.
+    """
+    if not socket_ready(sock, write, sock.gettimeout()):
+        raise socket.timeout("timed out")
+
+def splice_forward(sock_in, sock_out, length=None):
+    """
+    Move bytes from sock_in to sock_out through a pipe with splice(), so
+    the body never gets copied into Python. Returns the number moved.
+    """
+    rfd, wfd = os.pipe()
+    try:
+        try:
+            fcntl.fcntl(wfd, fcntl.F_SETPIPE_SZ, SPLICE_PIPE_SIZE)
+        except (OSError, AttributeError):
+            pass
+        src, dst = sock_in.fileno(), sock_out.fileno()
+        remaining = length
+        moved = 0
+        while remaining is None or remaining > 0:
+            want = SPLICE_PIPE_SIZE if remaining is None else min(SPLICE_PIPE_SIZE, remaining)
+            try:
+                n = os.splice(src, wfd, want, flags=os.SPLICE_F_MOVE | os.SPLICE_F_MORE)
+            except BlockingIOError:
+                wait_ready(sock_in)
+                continue
+            except OSError as e:
+                if not moved and e.errno == errno.EINVAL:
+                    raise SpliceUnsupported(e)
+                raise
+            if not n:
+                break
+            moved += n
+            if remaining is not None:
+                remaining -= n
+            while n:
+                try:
+                    n -= os.splice(rfd, dst, n, flags=os.SPLICE_F_MOVE | os.SPLICE_F_MORE)
+                except BlockingIOError:
+                    wait_ready(sock_out, write=True)
+        return moved
+    finally:
+        os.close(rfd)
+        os.close(wfd)
+
+def connection_alive(sock):
+    """
+    Health check for an idle pooled socket: it is alive if there is
+    nothing to read yet. EOF or unexpected data both mean it is not.
+    """
+    # a poll rather than a MSG_DONTWAIT peek: with a socket timeout set,
+    # recv() first waits for the socket to become readable
+    try:
+        return not socket_ready(sock)
+    except (OSError, ValueError):
+        return False
+
+def parse_request_line(line):
+    parts = line.split()
+    if len(parts) != 3:
+        return None, None, None
+    return parts[0], parts[1], parts[2]
+
+RESPONSE_SKIP_HEADERS = {b"transfer-encoding", b"connection", b"content-length", b"keep-alive"}
+
+def client_wants_keep_alive(http_version, req_header_dict):
+    """
+    HTTP/1.1 connections stay open unless the client says close,
+    HTTP/1.0 ones only if the client asks for keep-alive.
+    """
+    connection = (req_header_dict.get(b"connection", b"") + b"," +
+                  req_header_dict.get(b"proxy-connection", b"")).lower()
+    if http_version.upper() == "HTTP/1.0":
+        return b"keep-alive" in connection
+    return b"close" not in connection
+
+def upstream_keep_alive(resp_status_line, resp_header_dict):
+    """
+    Whether the server lets us send another request on this connection.
+    """
+    connection = resp_header_dict.get(b"connection", b"").lower()
+    if resp_status_line.upper().startswith("HTTP/1.0"):
+        return b"keep-alive" in connection
+    return b"close" not in connection
+
+def request_content_length(req_header_dict):
+    try:
+        return int(req_header_dict.get(b"content-length", b"0"))
+    except ValueError:
+        return 0
+
+def response_status(resp_status_line):
+    parts = resp_status_line.split(None, 2)
+    try:
+        return int(parts[1])
+    except (IndexError, ValueError):
+        return 0
+
+def client_framing(status, content_length, is_chunked, rewrite, http_version):
+    """
+    Decide how a response body is framed towards the client.
+    Returns (mode, can_keep_alive) where mode is one of
+      "empty"       no body (1xx, 204, 304)
+      "length"      forwarded as is, with Content-Length
+      "chunked"     chunk-encoded by us (rewritten, chunked by the server,
+                    or no length given)
+      "close"       ends when we close the connection (HTTP/1.0 clients)
+    """
+    if status < 200 or status in (204, 304):
+        return "empty", True
+    if content_length is not None and not rewrite and not is_chunked:
+        return "length", True
+    if http_version.upper() == "HTTP/1.0":
+        return "close", False
+    return "chunked", True
+
+def build_response_head(resp_status_line, response_fields, content_length=None,
+                        is_chunked=False, keep_alive=False, extra=()):
+    """
+    Reconstruct response headers, with our own Connection and framing headers.
+    Returns the encoded head, including the blank line ending it.
+    """
+    out_resp_headers = [resp_status_line.encode('latin-1')]
+    for name, _, raw in response_fields:
+        if name not in RESPONSE_SKIP_HEADERS:
+            out_resp_headers.append(raw)
+
+    out_resp_headers.extend(extra)
+    out_resp_headers.append(b"Connection: keep-alive" if keep_alive else b"Connection: close")
+    if is_chunked:
+        out_resp_headers.append(b"Transfer-Encoding: chunked")
+    elif content_length is not None:
+        out_resp_headers.append(b"Content-Length: %d" % content_length)
+
+    return b"\r\n".join(out_resp_headers) + b"\r\n\r\n"
+
+def extract_host_port_path(url_or_path, req_header_dict):
+    default_port = 80
+    if url_or_path.lower().startswith("http://"):
+        tmp = url_or_path[7:]
+        slash_pos = tmp.find('/')
+        if slash_pos == -1:
+            host_part = tmp
+            path_part = "/"
+        else:
+            host_part = tmp[:slash_pos]
+            path_part = tmp[slash_pos:]
+        if ':' in host_part:
+            host, port_str = host_part.split(':', 1)
+            try:
+                port = int(port_str)
+            except:
+                port = default_port
+        else:
+            host = host_part
+            port = default_port
+        return host, port, path_part
+    else:
+        host_header = req_header_dict.get(b"host", b"").decode('latin-1')
+        host = host_header
+        port = default_port
+        if ':' in host_header:
+            h, p_str = host_header.split(':', 1)
+            host = h
+            try:
+                port = int(p_str)
+            except:
+                port = default_port
+        path_part = url_or_path
+        if not path_part.startswith("/"):
+            path_part = "/" + path_part
+        return host, port, path_part
+
+def error_response(code, message):
+    body = f"<html><body><h2>{code} {message}</h2></body></html>"
+    resp = (
+        f"HTTP/1.1 {code} {message}\r\n"
+        "Content-Type: text/html\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n\r\n"
+        f"{body}"
+    )
+    return resp.encode('utf-8')
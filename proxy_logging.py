@@ -0,0 +1,399 @@
+import threading
+import sys
+import json
+import collections
+import time
+import os
+import zlib
+import struct
+import itertools
+import queue
+import random
+import contextvars
+import atexit
+
+from proxy_http import parse_request_line, response_status
+
+# ***************** LOGGING *****************
+# A log call on the request path compares a level and, if the line is
+# wanted, queues its message and arguments unformatted; a writer thread
+# formats whatever has piled up and writes it with one call. The access
+# log record of the request being served is in a context variable, so
+# each thread and each asyncio task sees its own.
+
+# Logging (-l debug|info|warning|error, --log-file <path>, default stdout).
+# Lines are written in batches of up to LOG_BATCH by a background thread;
+# with more than LOG_QUEUE_MAX waiting, new ones are dropped and counted.
+# --access-log <path> adds one JSON line per request, of which only the
+# share ACCESS_LOG_SAMPLE (--access-sample) is kept for successful ones;
+# errors are always logged.
+LOG_LEVEL = "info"
+LOG_BATCH = 512
+LOG_QUEUE_MAX = 100000
+ACCESS_LOG_SAMPLE = 1.0
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LOG_LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LEVEL_NAMES = {level: name.upper() for name, level in LOG_LEVELS.items()}
+
+class LogWriter(object):
+    """
+    Background thread writing queued items to 'stream', 'format' turns an
+    item into a line (bytes for a binary stream). Items over max_queued are
+    dropped and counted.
+    """
+
+    def __init__(self, stream, format, max_queued=LOG_QUEUE_MAX, binary=False):
+        self.stream = stream
+        self.format = format
+        self.binary = binary
+        self.max_queued = max_queued
+        self.queue = queue.SimpleQueue()
+        self.dropped = 0
+        self.thread = None
+
+    def start(self):
+        # also called in a forked worker, which has a copy of the queue but
+        # not the thread
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, item):
+        if self.queue.qsize() >= self.max_queued:
+            self.dropped += 1
+            return
+        self.queue.put(item)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < LOG_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            flushed = []
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    flushed.append(item)
+                    continue
+                try:
+                    lines.append(self.format(item))
+                except (TypeError, ValueError) as e:
+                    if not self.binary:
+                        lines.append(f"(unprintable log line {item!r}: {e})\n")
+            try:
+                self.stream.write((b"" if self.binary else "").join(lines))
+                self.stream.flush()
+            except (OSError, ValueError):
+                pass
+            for done in flushed:
+                done.set()
+
+    def flush(self, timeout=2.0):
+        """
+        Wait until what was queued so far is written.
+        """
+        if self.thread is None or not self.thread.is_alive():
+            return
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait(timeout)
+
+def format_timestamp(ts):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts)) + ".%03d" % (ts % 1 * 1000)
+
+def format_log_line(item):
+    ts, level, message, args = item
+    if args:
+        # bytes (raw requests) are shown as text
+        message = message % tuple(a.decode('latin-1') if isinstance(a, bytes) else a for a in args)
+    return f"{format_timestamp(ts)} {LEVEL_NAMES[level]:<7} {message}\n"
+
+class Logger(object):
+    """
+    Leveled log with printf-style arguments, formatted only if the line is
+    written. Until start() it prints straight to stdout.
+    """
+
+    def __init__(self, level=LOG_LEVELS[LOG_LEVEL]):
+        self.level = level
+        self.writer = None
+
+    def start(self, stream):
+        self.writer = LogWriter(stream, format_log_line)
+        self.writer.start()
+
+    def log(self, level, message, *args):
+        if level < self.level:
+            return
+        item = (time.time(), level, message, args)
+        if self.writer is None:
+            sys.stdout.write(format_log_line(item))
+        else:
+            self.writer.put(item)
+
+    def debug(self, message, *args):
+        if self.level <= DEBUG:
+            self.log(DEBUG, message, *args)
+
+    def info(self, message, *args):
+        if self.level <= INFO:
+            self.log(INFO, message, *args)
+
+    def warning(self, message, *args):
+        if self.level <= WARNING:
+            self.log(WARNING, message, *args)
+
+    def error(self, message, *args):
+        self.log(ERROR, message, *args)
+
+LOG = Logger()
+
+# LogWriter of the access log (--access-log), None when there is none
+ACCESS_LOG = None
+
+class AccessRecord(object):
+    """
+    One access log line (and capture file exchange), filled in while the
+    request is answered.
+    """
+
+    def __init__(self, client_addr, connection, request_line, request_fields, started):
+        self.client_addr = client_addr
+        self.connection = connection
+        self.request_line = request_line
+        self.request_fields = request_fields
+        self.started = started
+        self.status = None
+        self.bytes = 0
+        self.cache = None
+        # for the capture file: the upstream response head, when it came
+        # in, and the upstream body (its length, and the start of it we keep)
+        self.upstream_line = None
+        self.upstream_fields = ()
+        self.first_byte = None
+        self.body_length = 0
+        self.body = None
+
+CURRENT_ACCESS = contextvars.ContextVar("access", default=None)
+
+def begin_access(client_addr, connection, request_line, request_fields, started):
+    if ACCESS_LOG is None and CAPTURE_FILE is None:
+        return None
+    record = AccessRecord(client_addr, connection, request_line, request_fields, started)
+    CURRENT_ACCESS.set(record)
+    return record
+
+def note_access(status=None, sent=0, cache=None, read=0):
+    """
+    Add to the access record of the current request (if we keep one):
+    the response status, bytes sent to the client, how the cache was used
+    and upstream body bytes read.
+    """
+    record = CURRENT_ACCESS.get()
+    if record is None:
+        return
+    if status is not None:
+        record.status = status
+    record.bytes += sent
+    record.body_length += read
+    if cache is not None:
+        record.cache = cache
+
+def note_response(response, cache=None):
+    """
+    note_access for a response sent in one piece.
+    """
+    note_access(response_status(str(response[:16], 'latin-1')), len(response), cache)
+
+def end_access(record):
+    if record is None:
+        return
+    CURRENT_ACCESS.set(None)
+    if CAPTURE_FILE is not None:
+        capture_exchange(record)
+    if ACCESS_LOG is None:
+        return
+    status = record.status
+    if status is not None and status < 400 and ACCESS_LOG_SAMPLE < 1 and random.random() >= ACCESS_LOG_SAMPLE:
+        return
+    ACCESS_LOG.put((time.time(), record.client_addr, record.request_line, status, record.bytes,
+                    time.monotonic() - record.started, record.cache))
+
+def format_access_line(item):
+    ts, client_addr, request_line, status, sent, seconds, cache = item
+    method, target, _ = parse_request_line(request_line)
+    client = f"{client_addr[0]}:{client_addr[1]}" if isinstance(client_addr, tuple) else str(client_addr)
+    return json.dumps({"time": format_timestamp(ts), "client": client, "method": method,
+                       "url": target, "status": status, "bytes": sent,
+                       "ms": round(seconds * 1000, 3), "cache": cache}) + "\n"
+
+def start_logging(level, log_path=None, access_path=None):
+    """
+    Start the writer threads. Log files are opened for appending, so
+    worker processes can share them.
+    """
+    global ACCESS_LOG
+    LOG.level = level
+    LOG.start(open(log_path, "a", encoding="utf-8") if log_path else sys.stdout)
+    if access_path:
+        ACCESS_LOG = LogWriter(open(access_path, "a", encoding="utf-8"), format_access_line)
+        ACCESS_LOG.start()
+    atexit.register(flush_logs)
+
+def log_writers():
+    return [w for w in (LOG.writer, ACCESS_LOG, CAPTURE_FILE) if w is not None]
+
+def restart_logging():
+    """
+    In a forked worker: writer threads of our own.
+    """
+    for writer in log_writers():
+        writer.start()
+
+def flush_logs():
+    for writer in log_writers():
+        writer.flush()
+
+def logs_dropped():
+    return sum(writer.dropped for writer in log_writers())
+
+# ***************** CAPTURE *****************
+# With --capture <file> every request goes into a binary capture file: the
+# client's request head, the upstream response head and body, the status
+# sent and the timings. replay_capture.py plays a capture back through the
+# proxy against an origin stub. Bodies that go through the body stages are
+# kept up to CAPTURE_MAX_BODY bytes; for bodies forwarded socket to socket
+# only the length is recorded.
+#
+# Layout: CAPTURE_MAGIC, then per exchange a little-endian u32 length and
+# that many bytes of zlib-compressed payload: CAPTURE_HEADER followed by
+# the request head, the upstream response head and the kept body.
+
+# Capture file (--capture <path>): upstream bodies kept per exchange, and
+# how many exchanges may wait for the writer before new ones are dropped
+CAPTURE_MAX_BODY = 1024 * 1024
+CAPTURE_QUEUE_MAX = 1000
+
+CAPTURE_MAGIC = b"FNPCAP1\n"
+CAPTURE_LENGTH = struct.Struct("<I")
+# started (unix time), connection, time to the upstream head and total
+# (seconds, first byte -1 when there was no upstream response), status,
+# cache use (index into CAPTURE_CACHE), lengths of the request head,
+# upstream head, upstream body and the part of the body kept
+CAPTURE_HEADER = struct.Struct("<dQffHB3xIIQI")
+CAPTURE_CACHE = (None, "miss", "hit", "shared", "revalidated")
+
+# LogWriter of the capture file, None when not capturing
+CAPTURE_FILE = None
+
+# Numbers client connections, so a replay can reuse connections as the
+# clients did
+CONNECTION_IDS = itertools.count(1)
+
+CapturedExchange = collections.namedtuple("CapturedExchange", [
+    "started", "connection", "first_byte", "total", "status", "cache",
+    "request_head", "response_head", "body_length", "body"])
+
+def note_upstream(status_line, fields):
+    """
+    The upstream response head of the current request, for the capture file.
+    """
+    record = CURRENT_ACCESS.get()
+    if record is None or CAPTURE_FILE is None:
+        return
+    record.upstream_line = status_line
+    record.upstream_fields = fields
+    record.first_byte = time.monotonic() - record.started
+
+class UpstreamTap(object):
+    """
+    Pipeline stage (the first one) keeping the upstream body as it came in,
+    up to CAPTURE_MAX_BODY bytes, for the capture file.
+    """
+
+    def __init__(self, record):
+        self.record = record
+        record.body = bytearray()
+
+    def feed(self, data):
+        room = CAPTURE_MAX_BODY - len(self.record.body)
+        if room > 0:
+            self.record.body += data[:room]
+        return data
+
+    def flush(self):
+        return b""
+
+def tap_upstream(stages):
+    record = CURRENT_ACCESS.get()
+    if record is None or CAPTURE_FILE is None:
+        return stages
+    return [UpstreamTap(record)] + list(stages)
+
+def capture_exchange(record):
+    now = time.monotonic()
+    total = now - record.started
+    # connection numbers are per process
+    connection = (os.getpid() << 32) | (record.connection & 0xffffffff)
+    CAPTURE_FILE.put((time.time() - total, connection, record.first_byte, total, record.status,
+                      record.cache, record.request_line, record.request_fields, record.upstream_line,
+                      record.upstream_fields, record.body_length, record.body))
+
+def join_head(start_line, fields):
+    return b"\r\n".join([start_line.encode('latin-1')] + [bytes(raw) for _, _, raw in fields]) + b"\r\n\r\n"
+
+def encode_exchange(item):
+    (started, connection, first_byte, total, status, cache, request_line, request_fields,
+     upstream_line, upstream_fields, body_length, body) = item
+    request_head = join_head(request_line, request_fields)
+    response_head = join_head(upstream_line, upstream_fields) if upstream_line is not None else b""
+    body = bytes(body) if body else b""
+    header = CAPTURE_HEADER.pack(started, connection, -1.0 if first_byte is None else first_byte, total,
+                                 status or 0, CAPTURE_CACHE.index(cache) if cache in CAPTURE_CACHE else 0,
+                                 len(request_head), len(response_head), body_length, len(body))
+    data = zlib.compress(header + request_head + response_head + body, 1)
+    return CAPTURE_LENGTH.pack(len(data)) + data
+
+def read_capture(path):
+    """
+    Yield the CapturedExchanges of a capture file in the order they were
+    written. Stops at a record cut short (the proxy was killed mid-write).
+    """
+    with open(path, "rb") as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        while True:
+            length = f.read(CAPTURE_LENGTH.size)
+            if len(length) < CAPTURE_LENGTH.size:
+                return
+            try:
+                payload = zlib.decompress(f.read(CAPTURE_LENGTH.unpack(length)[0]))
+            except zlib.error:
+                return
+            (started, connection, first_byte, total, status, cache, request_length,
+             response_length, body_length, kept) = CAPTURE_HEADER.unpack_from(payload)
+            pos = CAPTURE_HEADER.size
+            request_head = payload[pos:pos + request_length]
+            pos += request_length
+            response_head = payload[pos:pos + response_length]
+            pos += response_length
+            yield CapturedExchange(started, connection, None if first_byte < 0 else first_byte, total,
+                                   status or None, CAPTURE_CACHE[cache], request_head, response_head,
+                                   body_length, payload[pos:pos + kept])
+
+def start_capture(path):
+    """
+    Open (or append to) a capture file. Worker processes share it.
+    """
+    global CAPTURE_FILE
+    f = open(path, "ab")
+    if f.tell() == 0:
+        f.write(CAPTURE_MAGIC)
+        f.flush()
+    CAPTURE_FILE = LogWriter(f, encode_exchange, CAPTURE_QUEUE_MAX, binary=True)
+    CAPTURE_FILE.start()
@@ -0,0 +1,204 @@
+import socket
+import threading
+import collections
+import bisect
+
+from proxy_http import SocketReader, read_http_headers, parse_request_line, error_response
+from proxy_logging import LOG
+
+# ***************** METRICS *****************
+# Each thread records into its own Recorder (no locks on the request path;
+# the asyncio engine has just the one). A scrape adds them all up and, in
+# the worker mode, the supervisor adds up the workers'. With -m <port> the
+# sums are served in the Prometheus text format at /metrics on localhost.
+
+# Upper bounds (seconds) of the latency histogram buckets
+PHASE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# The phases of a request we time: reading the request head (from its
+# first byte), opening a new upstream connection, sending the request
+# upstream until its response head is in, decoding/rewriting/encoding the
+# body (summed over its chunks) and the whole request.
+PHASES = ("headers", "connect", "first_byte", "rewrite", "total")
+
+class Recorder(object):
+    """
+    Histograms per phase and byte counters of one thread.
+    """
+
+    def __init__(self):
+        self.buckets = {phase: [0] * (len(PHASE_BUCKETS) + 1) for phase in PHASES}
+        self.sums = dict.fromkeys(PHASES, 0.0)
+        self.counters = collections.Counter()
+
+    def observe(self, phase, seconds):
+        self.buckets[phase][bisect.bisect_left(PHASE_BUCKETS, seconds)] += 1
+        self.sums[phase] += seconds
+
+    def snapshot(self):
+        return {"buckets": {phase: list(counts) for phase, counts in self.buckets.items()},
+                "sums": dict(self.sums), "counters": dict(self.counters)}
+
+def merge_metrics(snapshots):
+    """
+    Add up Recorder snapshots (from threads, or from worker processes).
+    """
+    total = Recorder().snapshot()
+    for snapshot in snapshots:
+        for phase, counts in snapshot["buckets"].items():
+            total["buckets"][phase] = [a + b for a, b in zip(total["buckets"][phase], counts)]
+        for phase, seconds in snapshot["sums"].items():
+            total["sums"][phase] += seconds
+        for name, n in snapshot["counters"].items():
+            total["counters"][name] = total["counters"].get(name, 0) + n
+    return total
+
+class Metrics(object):
+    """
+    Hands each thread a Recorder. Threads come and go with connections, so
+    a thread gives its recorder back (release) and the next one reuses it;
+    there are only ever as many as there were threads at the same time.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.recorders = []
+        self.free = []
+
+    def recorder(self):
+        rec = getattr(self.local, "recorder", None)
+        if rec is None:
+            with self.lock:
+                if self.free:
+                    rec = self.free.pop()
+                else:
+                    rec = Recorder()
+                    self.recorders.append(rec)
+            self.local.recorder = rec
+        return rec
+
+    def release(self):
+        rec = getattr(self.local, "recorder", None)
+        if rec is not None:
+            self.local.recorder = None
+            with self.lock:
+                self.free.append(rec)
+
+    def observe(self, phase, seconds):
+        self.recorder().observe(phase, seconds)
+
+    def count(self, name, n=1):
+        self.recorder().counters[name] += n
+
+    def snapshot(self):
+        with self.lock:
+            recorders = list(self.recorders)
+        return merge_metrics(rec.snapshot() for rec in recorders)
+
+METRICS = Metrics()
+
+def render_metrics(stats, metrics):
+    """
+    Prometheus text exposition of the Stats counters and the merged metrics.
+    """
+    lines = []
+    for name in sorted(stats):
+        kind = "gauge" if name in Stats.GAUGES or name == "workers" else "counter"
+        metric = f"proxy_{name}" if kind == "gauge" else f"proxy_{name}_total"
+        lines += [f"# TYPE {metric} {kind}", f"{metric} {stats[name]}"]
+    for name in sorted(metrics["counters"]):
+        metric = f"proxy_{name}_total"
+        lines += [f"# TYPE {metric} counter", f"{metric} {metrics['counters'][name]}"]
+    lines += ["# HELP proxy_phase_seconds Time spent per request phase.",
+              "# TYPE proxy_phase_seconds histogram"]
+    for phase in PHASES:
+        cumulative = 0
+        for bound, n in zip(PHASE_BUCKETS + ("+Inf",), metrics["buckets"][phase]):
+            cumulative += n
+            lines.append(f'proxy_phase_seconds_bucket{{phase="{phase}",le="{bound}"}} {cumulative}')
+        lines.append(f'proxy_phase_seconds_sum{{phase="{phase}"}} {metrics["sums"][phase]:.6f}')
+        lines.append(f'proxy_phase_seconds_count{{phase="{phase}"}} {cumulative}')
+    return ("\n".join(lines) + "\n").encode('utf-8')
+
+def answer_admin(conn, collect):
+    """
+    Answer one request on the admin port: GET /metrics, anything else 404.
+    'collect' returns (stats, metrics) to render.
+    """
+    try:
+        conn.settimeout(2.0)
+        request_line, _ = read_http_headers(SocketReader(conn))
+        method, path, _ = parse_request_line(request_line or "")
+        if method == "GET" and path.split("?", 1)[0] == "/metrics":
+            body = render_metrics(*collect())
+            conn.sendall(b"HTTP/1.1 200 OK\r\n"
+                         b"Content-Type: text/plain; version=0.0.4\r\n"
+                         b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body)
+        else:
+            conn.sendall(error_response(404, "Not Found"))
+    except OSError:
+        pass
+    finally:
+        conn.close()
+
+def admin_socket(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        sock.bind(("127.0.0.1", port))
+        sock.listen(16)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+def start_admin_server(port, collect):
+    """
+    Serve /metrics on 127.0.0.1:port from a thread of its own.
+    """
+    sock = admin_socket(port)
+    LOG.info("[MAIN] Metrics at http://127.0.0.1:%d/metrics", port)
+
+    def serve():
+        while True:
+            conn, _ = sock.accept()
+            answer_admin(conn, collect)
+    t = threading.Thread(target=serve)
+    t.daemon = True
+    t.start()
+
+class Stats(object):
+    """
+    Counters of one process. Names in GAUGES go up and down (and are not
+    carried over from a worker that died), the others only go up.
+    """
+
+    GAUGES = {"active_connections", "active_tunnels"}
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+STATS = Stats()
+
+def aggregate_stats(snapshots, retired=None):
+    """
+    Sum worker snapshots; 'retired' holds the counters of dead workers.
+    """
+    total = collections.Counter(retired or {})
+    for snapshot in snapshots:
+        total.update(snapshot)
+    return dict(total)
+
+def format_stats(stats):
+    return " ".join(f"{name}={stats[name]}" for name in sorted(stats))
@@ -0,0 +1,430 @@
+import socket
+import threading
+import os
+
+import proxy_cache
+from proxy_cache import (CACHE_MAX_ENTRY_BYTES, request_cacheable, request_wants_revalidation,
+                         response_storable, CacheEntry, BodyCapture)
+from proxy_codings import body_chunks, content_coding, upstream_accept_encoding, transcoding
+from proxy_http import (header_dict, parse_request_line, client_wants_keep_alive,
+                        upstream_keep_alive, request_content_length, response_status,
+                        client_framing, build_response_head, extract_host_port_path, error_response)
+from proxy_logging import LOG, note_access, note_response, tap_upstream
+from proxy_rewrite import rewrite_stages
+
+# ***************** REQUESTS *****************
+# What both engines do with a request apart from the I/O: parsing it, the
+# cache and single-flight lookups, the upstream request, planning the
+# response and its body stages, error pages and the local files we serve.
+
+# TROLL_IMAGE_PATH: local file we serve when "Smiley.jpg" is requested
+TROLL_IMAGE_PATH = "trolly.jpg"
+
+# The kernel accept queue of a listening socket, and how long a client
+# waits for its turn (a thread, or an active slot in the asyncio engine)
+# before it gets a 503
+LISTEN_BACKLOG = 1024
+ADMISSION_QUEUE_TIMEOUT = 5.0
+
+# Persistent client connections: how long one may sit idle between
+# requests, and how many requests it may make before we close it.
+CLIENT_IDLE_TIMEOUT = 15.0
+MAX_REQUESTS_PER_CONNECTION = 100
+
+# Slow clients: once a request has started, its head must be complete
+# within HEADER_READ_TIMEOUT seconds; a client that does not take our
+# response (or send its body) for CLIENT_WRITE_TIMEOUT seconds is dropped.
+HEADER_READ_TIMEOUT = 10.0
+CLIENT_WRITE_TIMEOUT = 30.0
+
+# Set by SIGTERM: stop accepting, finish what is in flight, exit. A
+# draining process waits WORKER_DRAIN_TIMEOUT seconds at most for open
+# connections.
+DRAINING = threading.Event()
+WORKER_DRAIN_TIMEOUT = 30.0
+
+def listen_socket(port, reuse_port=False, listen=True):
+    proxy_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    proxy_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        proxy_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    try:
+        proxy_socket.bind(("0.0.0.0", port))
+        if listen:
+            proxy_socket.listen(LISTEN_BACKLOG)
+    except OSError:
+        proxy_socket.close()
+        raise
+    return proxy_socket
+
+class ProxyRequest(object):
+    """
+    One client request and what the pipeline has decided about it. Built
+    by parse_request and filled in by the helpers below, which both
+    engines share; the engines only move the bytes.
+    """
+
+    def __init__(self, method, target, http_version):
+        self.method = method.upper()
+        self.target = target
+        self.http_version = http_version
+        self.fields = []
+        self.headers = {}
+        self.keep_alive = False
+        self.host = self.port = self.path = None
+        self.body_length = 0
+        self.local_image = None
+        self.cacheable = self.use_cache = False
+        self.cache_key = self.flight_key = None
+        self.entry = None           # stale cache entry being revalidated
+        self.validators = None
+        self.flight = None          # the Flight we lead, if any ...
+        self.flights = None         # ... in this SingleFlight
+        self.shared = None          # CacheEntry handed to the followers
+
+def parse_request(request_line, request_fields, client_addr, last=False):
+    """
+    Steps 2-5: parse the request line and headers. Returns (request, error),
+    error being the (code, message) to answer with instead. A CONNECT comes
+    back with only method, target and http_version set.
+    """
+    method, url_or_path, http_version = parse_request_line(request_line)
+    if method is None:
+        LOG.info("[%s] Malformed request line. Connection closed.", client_addr)
+        return None, (400, "Bad Request")
+    request = ProxyRequest(method, url_or_path, http_version)
+    if request.method == "CONNECT":
+        return request, None
+
+    # headers as a dict (lowercase keys), and the destination with any
+    # "http://..." stripped from the path
+    request.fields = request_fields
+    request.headers = header_dict(request_fields)
+    request.keep_alive = (not last) and client_wants_keep_alive(http_version, request.headers)
+    request.host, request.port, request.path = extract_host_port_path(url_or_path, request.headers)
+    LOG.debug("remote_host=%s, remote_port=%s, path=%s", request.host, request.port, request.path)
+
+    # only GET (without a chunked request body)
+    if request.method != "GET" or b"transfer-encoding" in request.headers:
+        LOG.info("[%s] Method %s not supported.", client_addr, method)
+        return request, (501, "Not Implemented")
+    request.body_length = request_content_length(request.headers)
+    if request.path.lower().endswith("smiley.jpg"):
+        request.local_image = TROLL_IMAGE_PATH
+    request.cache_key = (request.host, request.port, request.path)
+    request.flight_key = (request.method,) + request.cache_key
+    request.cacheable = request_cacheable(request.headers, request.body_length)
+    request.use_cache = proxy_cache.RESPONSE_CACHE is not None and request.cacheable
+    return request, None
+
+def cached_response(request, load=True):
+    """
+    Step 6b: the whole response from a fresh cached copy, or None. A stale
+    copy with validators is kept in request.entry to be revalidated. With
+    load=False a copy spilled to disk is not read back.
+    """
+    if not request.use_cache:
+        return None
+    entry = proxy_cache.RESPONSE_CACHE.lookup(request.cache_key, request.headers, load)
+    if entry is None:
+        return None
+    if entry.is_fresh() and not request_wants_revalidation(request.headers):
+        response = entry.response(request.http_version, request.headers, request.keep_alive)
+        note_response(response, "hit")
+        return response
+    request.validators = entry.validators()
+    if request.validators:
+        request.entry = entry
+    return None
+
+def join_flight(request, flights):
+    """
+    Step 6c: join the fetch of an identical GET in 'flights'. Returns the
+    Flight to wait on, or None if this request goes upstream itself (and
+    leads request.flight if it is cacheable).
+    """
+    if not request.cacheable:
+        return None
+    flight, leader = flights.join(request.flight_key)
+    if leader:
+        request.flight = flight
+        request.flights = flights
+        return None
+    return flight
+
+def shared_response(request, shared):
+    """
+    The response for a request that waited on another one's fetch, built
+    from the CacheEntry that fetch left ('shared'), or None if there is
+    nothing it may use.
+    """
+    if shared is None or not shared.matches(request.headers):
+        return None
+    response = shared.response(request.http_version, request.headers, request.keep_alive)
+    note_response(response, "shared")
+    return response
+
+def land_flight(request, storable=True):
+    """
+    Hand request.shared to the requests waiting on our fetch, if we lead
+    one. storable=False: the response cannot be shared, so the followers
+    go upstream on their own, now, and the next ones do not wait.
+    """
+    if request.flight is not None:
+        request.flights.finish(request.flight_key, request.flight, request.shared, storable)
+        request.flight = None
+
+def upstream_request(request):
+    return build_upstream_request(request.method, request.path, request.host,
+                                  request.fields, request.validators)
+
+class ResponsePlan(object):
+    """
+    How an upstream response goes on to the client, made by plan_response:
+      head            bytes to send first (the whole response for a 304
+                      that revalidated our cached copy)
+      mode            the client framing (see client_framing), or
+                      "revalidated"
+      raw             the body is forwarded as it is, with forward_raw
+      has_body        a body follows, sent with send_body through stages
+    """
+
+    def __init__(self, status_line, fields, header_dict):
+        self.status_line = status_line
+        self.fields = fields
+        self.header_dict = header_dict
+        self.status = response_status(status_line)
+        self.head = b""
+        self.mode = "empty"
+        self.content_length = None
+        self.is_chunked = False
+        self.rewrite = False
+        self.capture = None
+        self.stages = []
+
+    @property
+    def raw(self):
+        return self.mode == "length" and self.capture is None
+
+    @property
+    def has_body(self):
+        return self.mode in ("length", "chunked", "close")
+
+def plan_response(request, resp_status_line, response_fields):
+    """
+    Step 10: decide how the response is framed, rewritten and captured for
+    the cache, and build the head sent to the client.
+    """
+    plan = ResponsePlan(resp_status_line, response_fields, header_dict(response_fields))
+    if request.entry is not None and plan.status == 304:
+        # our cached copy is still good
+        request.entry.refresh(response_fields)
+        plan.mode = "revalidated"
+        plan.head = request.entry.response(request.http_version, request.headers, request.keep_alive)
+        note_response(plan.head, "revalidated")
+        request.shared = request.entry
+        return plan
+
+    plan.content_length, plan.is_chunked, rewrite = response_framing(plan.header_dict)
+    plan.mode, can_keep_alive = client_framing(plan.status, plan.content_length, plan.is_chunked,
+                                               rewrite, request.http_version)
+    request.keep_alive = request.keep_alive and can_keep_alive
+
+    # A body we rewrite or whose end is upstream closing the connection
+    # goes out chunked (or, to an HTTP/1.0 client, delimited by closing the
+    # connection). A compressed text body is decoded for the rewrite, and
+    # gzipped again for a client that accepts it.
+    plan.rewrite = rewrite and plan.mode != "empty"
+    coding, compress, extra = b"", False, ()
+    if plan.rewrite:
+        coding, compress, plan.fields, extra = transcoding(plan.header_dict, request.headers,
+                                                           response_fields)
+    plan.head = build_response_head(resp_status_line, plan.fields,
+                                    content_length=plan.content_length if plan.mode == "length" else None,
+                                    is_chunked=plan.mode == "chunked", keep_alive=request.keep_alive,
+                                    extra=extra)
+    note_access(plan.status, len(plan.head), "miss" if request.use_cache else None)
+
+    stages = []
+    cache = proxy_cache.RESPONSE_CACHE
+    max_bytes = cache.max_entry_bytes if request.use_cache else CACHE_MAX_ENTRY_BYTES
+    too_big = not plan.rewrite and plan.content_length is not None and plan.content_length > max_bytes
+    if request.cacheable and response_storable(plan.status, plan.header_dict) and not too_big:
+        plan.capture = BodyCapture(max_bytes)
+        stages.append(plan.capture)
+    else:
+        # nothing to share: do not keep the followers waiting for the body
+        land_flight(request, storable=False)
+    if plan.rewrite:
+        stages = rewrite_stages(coding, compress, plan.capture, plan.content_length)
+    plan.stages = tap_upstream(stages) if plan.has_body and not plan.raw else stages
+    return plan
+
+def finish_response(request, plan, decoder=None):
+    """
+    After the body has been sent: store what was captured in the cache for
+    the followers and later requests, if the server sent all of it
+    ('decoder' from response_body says so). Returns whether the server
+    connection can go back to the pool: the whole response was framed (not
+    ended by the server closing), the server did not say close and nothing
+    was read past its end.
+    """
+    if plan.mode != "revalidated":
+        complete = not plan.has_body or (decoder is not None and decoder.done)
+        request.shared = store_captured(request.cache_key, plan.capture, complete,
+                                        plan.status_line, plan.fields, request.headers)
+    framed = plan.mode in ("empty", "revalidated") or plan.is_chunked or plan.content_length is not None
+    return (upstream_keep_alive(plan.status_line, plan.header_dict) and framed and
+            not (decoder is not None and decoder.unused))
+
+def store_captured(cache_key, capture, complete, resp_status_line, response_fields, req_header_dict):
+    """
+    Put a response whose body was captured on its way to the client into
+    the cache, if the server sent all of it ('complete'), rewritten or not.
+    Returns the CacheEntry (also handed to requests waiting on the same
+    fetch) or None.
+    """
+    if capture is None or capture.data is None or not complete:
+        return None
+    entry = CacheEntry(resp_status_line, response_fields, bytes(capture.data), req_header_dict)
+    if proxy_cache.RESPONSE_CACHE is not None:
+        proxy_cache.RESPONSE_CACHE.store(cache_key, entry)
+    return entry
+
+# Hop-by-hop headers we never pass on as they are
+REQUEST_SKIP_HEADERS = {b"host", b"proxy-connection", b"connection", b"keep-alive",
+                        b"accept-encoding"}
+CONDITIONAL_HEADERS = {b"if-none-match", b"if-modified-since", b"if-match",
+                       b"if-unmodified-since", b"if-range"}
+
+def build_upstream_request(method, path, remote_host, request_fields, validators=None):
+    """
+    Build the request we send to the remote server (keep-alive, the
+    connection goes back to the pool). The client's own header lines are
+    passed on as raw bytes. 'validators' are conditional header lines for
+    revalidating a cache entry; they replace the client's own.
+    """
+    out_headers = [f"{method} {path} HTTP/1.1\r\nHost: {remote_host}\r\nConnection: keep-alive".encode('utf-8')]
+    skip = REQUEST_SKIP_HEADERS if not validators else REQUEST_SKIP_HEADERS | CONDITIONAL_HEADERS
+    for name, _, raw in request_fields:
+        if name not in skip:
+            out_headers.append(raw)
+    accept_encoding = upstream_accept_encoding(request_fields)
+    if accept_encoding:
+        out_headers.append(accept_encoding)
+    if validators:
+        out_headers.extend(validators)
+    return b"\r\n".join(out_headers) + b"\r\n\r\n"
+
+def response_framing(resp_header_dict):
+    """
+    Returns (content_length, is_chunked, rewrite) for a response.
+    rewrite is True when the body is plain text we do replacements in.
+    """
+    content_length = None
+    is_chunked = False
+    content_type = resp_header_dict.get(b"content-type", b"").lower()
+
+    if b"content-length" in resp_header_dict:
+        try:
+            content_length = int(resp_header_dict[b"content-length"])
+        except:
+            content_length = None
+
+    if b"chunked" in resp_header_dict.get(b"transfer-encoding", b"").lower():
+        # Transfer-Encoding wins over any Content-Length
+        is_chunked = True
+        content_length = None
+
+    # -- only replacements if "text" in content_type and a coding we can undo;
+    # a chunked or compressed body is decoded on the way in and encoded again
+    # on the way out
+    rewrite = (content_coding(resp_header_dict) is not None) and (b"text" in content_type)
+    return content_length, is_chunked, rewrite
+
+def http_error_response(code, message):
+    """
+    error_response, noted in the access log of the current request.
+    """
+    resp = error_response(code, message)
+    note_access(code, len(resp))
+    return resp
+
+def send_http_error(sock, code, message):
+    sock.sendall(http_error_response(code, message))
+
+def discard_body(reader, length):
+    """
+    Skip a request body we do not forward.
+    """
+    if length:
+        for _ in body_chunks(reader, length):
+            pass
+
+class LocalFile(object):
+    """
+    A local file kept in memory, so serving it does not touch the disk.
+    It is read again when its mtime or size changes. The copy is ours:
+    an mmap of a file that is rewritten in place could fault under a
+    thread that is sending it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.data = None
+
+    def get(self):
+        """
+        The file's contents; raises FileNotFoundError if it is gone.
+        """
+        st = os.stat(self.path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp != self.stamp:
+            with self.lock:
+                if stamp != self.stamp:
+                    with open(self.path, "rb") as f:
+                        self.data = f.read()
+                    self.stamp = stamp
+        return self.data
+
+LOCAL_FILES = {}
+
+def local_file(path):
+    f = LOCAL_FILES.get(path)
+    if f is None:
+        f = LOCAL_FILES.setdefault(path, LocalFile(path))
+    return f
+
+def local_image_response(http_version, filepath, keep_alive=False):
+    """
+    Returns (head, body) for the local troll image, or a 404 if it is missing.
+    """
+    connection = "keep-alive" if keep_alive else "close"
+    try:
+        img_data = local_file(filepath).get()
+        resp_headers = (
+            f"{http_version} 200 OK\r\n"
+            "Content-Type: image/jpeg\r\n"
+            f"Content-Length: {len(img_data)}\r\n"
+            f"Connection: {connection}\r\n"
+            "\r\n"
+        ).encode('utf-8')
+        note_access(200, len(resp_headers) + len(img_data))
+        return resp_headers, img_data
+    except FileNotFoundError:
+        body = "<html><body><h2>404 Not Found</h2></body></html>"
+        resp = (
+            f"{http_version} 404 Not Found\r\n"
+            "Content-Type: text/html\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {connection}\r\n\r\n"
+        ).encode('utf-8')
+        note_access(404, len(resp) + len(body))
+        return resp, body.encode('utf-8')
+
+def serve_local_image(client_sock, http_version, filepath, keep_alive=False):
+    head, body = local_image_response(http_version, filepath, keep_alive)
+    client_sock.sendall(head)
+    client_sock.sendall(body)
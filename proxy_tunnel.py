@@ -0,0 +1,323 @@
+import socket
+import asyncio
+import time
+import os
+import errno
+import selectors
+try:
+    import fcntl
+except ImportError:    # not on Windows
+    fcntl = None
+
+import proxy_http
+import proxy_upstream
+from proxy_http import SPLICE_PIPE_SIZE, SpliceUnsupported
+from proxy_logging import LOG, note_access
+from proxy_metrics import METRICS, STATS
+from proxy_pipeline import CLIENT_WRITE_TIMEOUT, send_http_error
+
+# ***************** CONNECT TUNNELS *****************
+# "CONNECT host:port" opens a plain TCP connection to host:port and, after
+# a 200, relays bytes both ways until both sides are done or nothing has
+# moved for TUNNEL_IDLE_TIMEOUT seconds. The threaded engine relays both
+# directions from the connection's own thread with a selector (through
+# splice() pipes where there is splice); the asyncio engine with one pump
+# per direction on the loop.
+
+# CONNECT tunnels (--connect-ports, --tunnel-timeout): the ports clients
+# may tunnel to, and how long a tunnel may sit without a byte moving either
+# way before we close it. TUNNEL_BUFSIZE is the relay's read size.
+CONNECT_PORTS = {443}
+TUNNEL_IDLE_TIMEOUT = 300.0
+TUNNEL_BUFSIZE = 64 * 1024
+
+def connect_target(authority):
+    """
+    (host, port) of a CONNECT request target "host:port", or None.
+    """
+    host, sep, port = authority.rpartition(":")
+    if not sep or not host or not (port.isascii() and port.isdigit()):
+        return None
+    return host.strip("[]"), int(port)
+
+def connect_refused(authority, client_addr):
+    """
+    The error (code, message) a CONNECT to 'authority' gets before we try
+    to connect, or None if it may go ahead.
+    """
+    target = connect_target(authority)
+    if target is None:
+        LOG.info("[%s] Malformed CONNECT target %s.", client_addr, authority)
+        return 400, "Bad Request"
+    if target[1] not in CONNECT_PORTS:
+        LOG.info("[%s] CONNECT to port %d refused.", client_addr, target[1])
+        return 403, "Forbidden"
+    return None
+
+def connect_established(http_version):
+    head = b"%s 200 Connection Established\r\n\r\n" % http_version.encode("latin-1")
+    note_access(200, len(head))
+    return head
+
+def record_tunnel(client_addr, authority, up, down, seconds, reason):
+    """
+    Account for a finished tunnel: 'up' bytes went client to server,
+    'down' bytes server to client.
+    """
+    METRICS.count("tunnel_up_bytes", up)
+    METRICS.count("tunnel_down_bytes", down)
+    note_access(sent=down, read=up)
+    LOG.info("[%s] Tunnel to %s %s after %.1fs, %d bytes up, %d down.",
+             client_addr, authority, reason, seconds, up, down)
+
+class TunnelDirection(object):
+    """
+    One direction of a tunnel: what is read from non-blocking socket 'src'
+    is written to 'dst'. Nothing more is read while a read is still waiting
+    to be written, so a peer that does not take its data stops the other
+    side's reads in this direction only.
+    """
+
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        self.pending = memoryview(b"")   # read, not written yet
+        self.eof = False                 # src has shut down its side
+        self.done = False                # ...and dst has been told so
+        self.moved = 0
+
+    def wants_read(self):
+        return not self.eof and not self.pending
+
+    def wants_write(self):
+        return bool(self.pending)
+
+    def read(self):
+        try:
+            data = self.src.recv(TUNNEL_BUFSIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        if data:
+            self.moved += len(data)
+            self.pending = memoryview(data)
+        else:
+            self.eof = True
+        self.write()
+
+    def write(self):
+        if self.pending:
+            try:
+                self.pending = self.pending[self.dst.send(self.pending):]
+            except (BlockingIOError, InterruptedError):
+                return
+        self.finish()
+
+    def finish(self):
+        if self.eof and not self.wants_write() and not self.done:
+            self.done = True
+            try:
+                self.dst.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    def close(self):
+        pass
+
+class SpliceDirection(TunnelDirection):
+    """
+    TunnelDirection moving the bytes through a pipe with splice(), so they
+    never get copied into Python. Raises SpliceUnsupported from the first
+    read if splice() does not take these sockets.
+    """
+
+    def __init__(self, src, dst):
+        super().__init__(src, dst)
+        self.rfd, self.wfd = os.pipe()
+        try:
+            fcntl.fcntl(self.wfd, fcntl.F_SETPIPE_SZ, SPLICE_PIPE_SIZE)
+        except (OSError, AttributeError):
+            pass
+        self.in_pipe = 0
+
+    def wants_read(self):
+        return not self.eof and not self.in_pipe
+
+    def wants_write(self):
+        return bool(self.in_pipe)
+
+    def read(self):
+        try:
+            n = os.splice(self.src.fileno(), self.wfd, SPLICE_PIPE_SIZE,
+                          flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            if not self.moved and e.errno == errno.EINVAL:
+                raise SpliceUnsupported(e)
+            raise
+        if n:
+            self.moved += n
+            self.in_pipe += n
+        else:
+            self.eof = True
+        self.write()
+
+    def write(self):
+        if self.in_pipe:
+            try:
+                self.in_pipe -= os.splice(self.rfd, self.dst.fileno(), self.in_pipe,
+                                          flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            except (BlockingIOError, InterruptedError):
+                return
+        self.finish()
+
+    def close(self):
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+def tunnel_direction(src, dst):
+    if proxy_http.SPLICE and fcntl is not None:
+        try:
+            return SpliceDirection(src, dst)
+        except OSError:     # out of descriptors for the pipe
+            pass
+    return TunnelDirection(src, dst)
+
+def relay_tunnel(a, b, idle_timeout):
+    """
+    Relay between sockets a and b, both directions from this one thread,
+    until both have been shut down, a socket fails or nothing has moved
+    for idle_timeout seconds. Returns (bytes a to b, bytes b to a, how it
+    ended).
+    """
+    directions = [tunnel_direction(a, b), tunnel_direction(b, a)]
+    selector = selectors.DefaultSelector()
+    registered = {}
+    reason = "closed"
+    try:
+        a.setblocking(False)
+        b.setblocking(False)
+        last_moved = time.monotonic()
+        while not all(d.done for d in directions):
+            for sock in (a, b):
+                events = 0
+                for d in directions:
+                    if d.src is sock and d.wants_read():
+                        events |= selectors.EVENT_READ
+                    if d.dst is sock and d.wants_write():
+                        events |= selectors.EVENT_WRITE
+                if events != registered.get(sock, 0):
+                    if not events:
+                        selector.unregister(sock)
+                    elif registered.get(sock):
+                        selector.modify(sock, events)
+                    else:
+                        selector.register(sock, events)
+                    registered[sock] = events
+            remaining = last_moved + idle_timeout - time.monotonic()
+            if remaining <= 0:
+                reason = "timed out"
+                break
+            ready = selector.select(remaining)
+            for key, mask in ready:
+                for i, d in enumerate(directions):
+                    if mask & selectors.EVENT_READ and d.src is key.fileobj and d.wants_read():
+                        try:
+                            d.read()
+                        except SpliceUnsupported:
+                            d.close()
+                            d = directions[i] = TunnelDirection(d.src, d.dst)
+                            d.read()
+                    if mask & selectors.EVENT_WRITE and d.dst is key.fileobj and d.wants_write():
+                        d.write()
+            if ready:
+                last_moved = time.monotonic()
+    except OSError as e:
+        reason = "failed (%s)" % e
+    finally:
+        selector.close()
+        for d in directions:
+            d.close()
+    return directions[0].moved, directions[1].moved, reason
+
+def handle_connect(client_conn, client_reader, client_addr, authority, http_version):
+    """
+    Answer a CONNECT: connect to the target and relay bytes both ways until
+    the tunnel is done. The client connection is closed afterwards.
+    """
+    refused = connect_refused(authority, client_addr)
+    if refused is not None:
+        send_http_error(client_conn, *refused)
+        return
+    host, port = connect_target(authority)
+    try:
+        server_conn = proxy_upstream.UPSTREAM_CONNECTOR.connect(host, port,
+                                                                proxy_upstream.UPSTREAM_CONNECT_TIMEOUT)
+    except socket.timeout:
+        send_http_error(client_conn, 504, "Gateway Timeout")
+        LOG.warning("[%s] Timed out connecting to %s.", client_addr, authority)
+        return
+    except OSError as e:
+        send_http_error(client_conn, 502, "Bad Gateway")
+        LOG.warning("[%s] Could not connect to %s - %s", client_addr, authority, e)
+        return
+    STATS.incr("tunnels")
+    STATS.incr("active_tunnels")
+    started = time.monotonic()
+    try:
+        server_conn.settimeout(CLIENT_WRITE_TIMEOUT)
+        server_conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client_conn.sendall(connect_established(http_version))
+        # whatever the client sent after the CONNECT head is already ours
+        early = bytes(client_reader.buf)
+        client_reader.buf.clear()
+        server_conn.sendall(early)
+        up, down, reason = relay_tunnel(client_conn, server_conn, TUNNEL_IDLE_TIMEOUT)
+        record_tunnel(client_addr, authority, up + len(early), down, time.monotonic() - started, reason)
+    finally:
+        server_conn.close()
+        STATS.incr("active_tunnels", -1)
+
+async def relay_tunnel_async(reader_a, writer_a, reader_b, writer_b, idle_timeout):
+    """
+    Async version of relay_tunnel, between two stream pairs: one pump per
+    direction, the streams' buffer limits for backpressure, and this
+    coroutine as the watchdog ending both when nothing has moved for
+    idle_timeout seconds.
+    """
+    moved = [0, 0]
+    last_moved = [time.monotonic()]
+
+    async def pump(reader, writer, i):
+        while True:
+            data = await reader.read(TUNNEL_BUFSIZE)
+            if not data:
+                break
+            moved[i] += len(data)
+            last_moved[0] = time.monotonic()
+            writer.write(data)
+            await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+
+    pumps = {asyncio.ensure_future(pump(reader_a, writer_b, 0)),
+             asyncio.ensure_future(pump(reader_b, writer_a, 1))}
+    pending = pumps
+    reason = "closed"
+    try:
+        while pending:
+            remaining = last_moved[0] + idle_timeout - time.monotonic()
+            if remaining <= 0:
+                reason = "timed out"
+                break
+            done, pending = await asyncio.wait(pending, timeout=remaining,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            failed = [t.exception() for t in done if t.exception() is not None]
+            if failed:
+                reason = "failed (%s)" % failed[0]
+                break
+    finally:
+        for t in pumps:
+            t.cancel()
+        await asyncio.gather(*pumps, return_exceptions=True)
+    return moved[0], moved[1], reason
@@ -0,0 +1,360 @@
+import socket
+import threading
+import asyncio
+import collections
+import time
+import os
+import errno
+import itertools
+import selectors
+
+from proxy_http import SocketReader, connection_alive
+from proxy_metrics import METRICS
+
+# ***************** UPSTREAM *****************
+# Connecting to servers: the DNS cache, Happy Eyeballs races over the
+# addresses of a name, and the pool of kept-alive server connections of
+# the threaded engine.
+
+# Slow servers: connecting, and each read (headers or body) after that,
+# end with a 504 (or a dropped connection mid-body) when they take longer.
+UPSTREAM_CONNECT_TIMEOUT = 5.0
+UPSTREAM_READ_TIMEOUT = 30.0
+
+# Upstream names and addresses: getaddrinfo() results are kept for
+# DNS_CACHE_TTL seconds (--dns-ttl), for DNS_CACHE_MAX names at most. A
+# name that does not resolve, or a host:port that refused connections on
+# all of its addresses, fails straight away for NEGATIVE_CACHE_TTL seconds
+# (--negative-ttl); timeouts are never remembered. The addresses of a
+# dual-stack host are raced Happy Eyeballs style, the next one
+# HAPPY_EYEBALLS_DELAY seconds after the previous one unless that one is
+# connected by then.
+DNS_CACHE_TTL = 60.0
+DNS_CACHE_MAX = 10000
+NEGATIVE_CACHE_TTL = 5.0
+HAPPY_EYEBALLS_DELAY = 0.25
+
+# Upstream connection pool: open connections per (host, port), how long an
+# idle one is kept and how long a request waits for a free one.
+UPSTREAM_MAX_PER_HOST = 16
+UPSTREAM_IDLE_TIMEOUT = 30.0
+UPSTREAM_CHECKOUT_TIMEOUT = 10.0
+
+def interleave_families(infos):
+    """
+    getaddrinfo() results reordered to alternate between address families,
+    keeping the order within each (RFC 8305, section 4): with a broken IPv6
+    path only the first attempt is lost, not one per IPv6 address.
+    """
+    by_family = collections.OrderedDict()
+    for info in infos:
+        by_family.setdefault(info[0], []).append(info)
+    return [info for group in itertools.zip_longest(*by_family.values()) for info in group if info is not None]
+
+class DnsCache(object):
+    """
+    getaddrinfo() results by (host, port), kept for 'ttl' seconds (the
+    resolver does not tell us the record's own TTL). A name that did not
+    resolve is remembered for 'negative_ttl' seconds and fails straight
+    away meanwhile. At most max_entries names, the oldest go first.
+    """
+
+    def __init__(self, ttl=DNS_CACHE_TTL, negative_ttl=NEGATIVE_CACHE_TTL, max_entries=DNS_CACHE_MAX):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()    # (host, port) -> (expires, infos or error)
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, host, port):
+        """
+        The cached addresses of host:port, None if there are none; raises
+        the cached error for a name that did not resolve.
+        """
+        with self.lock:
+            cached = self.entries.get((host, port))
+            if cached is None or cached[0] <= time.monotonic():
+                self.misses += 1
+                return None
+            self.hits += 1
+        if isinstance(cached[1], Exception):
+            raise type(cached[1])(*cached[1].args)
+        return cached[1]
+
+    def store(self, host, port, result):
+        ttl = self.negative_ttl if isinstance(result, Exception) else self.ttl
+        if ttl <= 0:
+            return
+        with self.lock:
+            self.entries.pop((host, port), None)
+            self.entries[(host, port)] = (time.monotonic() + ttl, result)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def resolve(self, host, port):
+        infos = self.lookup(host, port)
+        if infos is None:
+            try:
+                infos = interleave_families(socket.getaddrinfo(host, port, type=socket.SOCK_STREAM))
+            except socket.gaierror as e:
+                self.store(host, port, e)
+                raise
+            self.store(host, port, infos)
+        return infos
+
+    async def resolve_async(self, host, port):
+        infos = self.lookup(host, port)
+        if infos is None:
+            loop = asyncio.get_running_loop()
+            try:
+                infos = interleave_families(await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM))
+            except socket.gaierror as e:
+                self.store(host, port, e)
+                raise
+            self.store(host, port, infos)
+        return infos
+
+def attempt_socket(info):
+    family, sock_type, proto, _, _ = info
+    sock = socket.socket(family, sock_type, proto)
+    sock.setblocking(False)
+    return sock
+
+class UpstreamConnector(object):
+    """
+    Opens connections to origin servers: the name through a DnsCache, then
+    Happy Eyeballs (RFC 8305) over its addresses, starting the next attempt
+    every attempt_delay seconds (or as soon as one fails) while the earlier
+    ones go on, and keeping the first to connect. A host:port that refused
+    the connection on every address fails straight away for negative_ttl
+    seconds. A timeout or any other error is not remembered, it may well
+    be gone by the next request. (Names that do not resolve are
+    remembered by the DnsCache.)
+    """
+
+    def __init__(self, dns=None, negative_ttl=NEGATIVE_CACHE_TTL, attempt_delay=HAPPY_EYEBALLS_DELAY):
+        self.dns = dns if dns is not None else DnsCache()
+        self.negative_ttl = negative_ttl
+        self.attempt_delay = attempt_delay
+        self.lock = threading.Lock()
+        self.down = {}      # (host, port) -> (until, error)
+
+    def check_down(self, host, port):
+        with self.lock:
+            down = self.down.get((host, port))
+            if down is not None and down[0] <= time.monotonic():
+                del self.down[(host, port)]
+                down = None
+        if down is not None:
+            raise type(down[1])(*down[1].args)
+
+    def mark_down(self, host, port, error):
+        if self.negative_ttl > 0:
+            with self.lock:
+                self.down[(host, port)] = (time.monotonic() + self.negative_ttl, error)
+
+    def connect(self, host, port, timeout):
+        """
+        A connected (non-blocking) socket to host:port. Raises
+        socket.timeout after 'timeout' seconds, or the last connect error.
+        """
+        self.check_down(host, port)
+        infos = self.dns.resolve(host, port)
+        deadline = time.monotonic() + timeout
+        selector = selectors.DefaultSelector()
+        waiting = list(infos)
+        attempts = []
+        error = None
+        refused = 0
+        next_attempt = 0.0
+        try:
+            while waiting or attempts:
+                now = time.monotonic()
+                if now >= deadline:
+                    raise socket.timeout(f"timed out connecting to {host}:{port}")
+                if waiting and (now >= next_attempt or not attempts):
+                    info = waiting.pop(0)
+                    sock = attempt_socket(info)
+                    err = sock.connect_ex(info[4])
+                    if not err:
+                        return sock
+                    if err not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                        sock.close()
+                        error = OSError(err, os.strerror(err))
+                        refused += err == errno.ECONNREFUSED
+                        continue
+                    selector.register(sock, selectors.EVENT_WRITE)
+                    attempts.append(sock)
+                    next_attempt = now + self.attempt_delay
+                wait = deadline - now
+                if waiting:
+                    wait = min(wait, next_attempt - now)
+                for key, _ in selector.select(max(wait, 0.0)):
+                    sock = key.fileobj
+                    selector.unregister(sock)
+                    attempts.remove(sock)
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if not err:
+                        return sock
+                    sock.close()
+                    error = OSError(err, os.strerror(err))
+                    refused += err == errno.ECONNREFUSED
+                    next_attempt = 0.0
+            if refused == len(infos):
+                self.mark_down(host, port, error)
+            raise error
+        finally:
+            selector.close()
+            for sock in attempts:
+                sock.close()
+
+    async def connect_async(self, host, port, timeout):
+        """
+        Async version of connect; raises asyncio.TimeoutError.
+        """
+        self.check_down(host, port)
+        return await asyncio.wait_for(self.race_async(host, port), timeout)
+
+    async def race_async(self, host, port):
+        loop = asyncio.get_running_loop()
+        infos = await self.dns.resolve_async(host, port)
+
+        async def attempt(info):
+            sock = attempt_socket(info)
+            try:
+                await loop.sock_connect(sock, info[4])
+            except BaseException:
+                sock.close()
+                raise
+            return sock
+
+        waiting = list(infos)
+        attempts = set()
+        error = None
+        refused = 0
+        try:
+            while waiting or attempts:
+                if waiting:
+                    attempts.add(asyncio.ensure_future(attempt(waiting.pop(0))))
+                done, attempts = await asyncio.wait(attempts, timeout=self.attempt_delay if waiting else None,
+                                                    return_when=asyncio.FIRST_COMPLETED)
+                connected = [t.result() for t in done if t.exception() is None]
+                for t in done:
+                    if t.exception() is not None:
+                        error = t.exception()
+                        refused += isinstance(error, ConnectionRefusedError)
+                if connected:
+                    for sock in connected[1:]:
+                        sock.close()
+                    return connected[0]
+            if refused == len(infos):
+                self.mark_down(host, port, error)
+            raise error
+        finally:
+            for t in attempts:
+                t.cancel()
+            if attempts:
+                await asyncio.wait(attempts)
+
+UPSTREAM_CONNECTOR = UpstreamConnector()
+
+class UpstreamPool(object):
+    """
+    Keep-alive connections to origin servers, keyed by (host, port).
+    At most max_per_host connections per key are open at once (idle or in
+    use); checkout waits for one to come back when the limit is reached.
+    Idle connections are closed after idle_timeout seconds and checked
+    with connection_alive before they are handed out again.
+    """
+
+    def __init__(self, max_per_host=UPSTREAM_MAX_PER_HOST, idle_timeout=UPSTREAM_IDLE_TIMEOUT,
+                 checkout_timeout=UPSTREAM_CHECKOUT_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.lock = threading.Condition()
+        self.idle = {}      # (host, port) -> [(SocketReader, last used)]
+        self.open = {}      # (host, port) -> connections open, idle or in use
+        self.last_sweep = 0.0
+
+    def connect(self, host, port):
+        started = time.monotonic()
+        server_socket = UPSTREAM_CONNECTOR.connect(host, port, UPSTREAM_CONNECT_TIMEOUT)
+        server_socket.settimeout(UPSTREAM_READ_TIMEOUT)
+        server_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        METRICS.observe("connect", time.monotonic() - started)
+        return server_socket
+
+    def checkout(self, host, port):
+        """
+        Returns (SocketReader, reused) for a connection to host:port.
+        """
+        key = (host, port)
+        deadline = time.monotonic() + self.checkout_timeout
+        with self.lock:
+            self.sweep()
+            while True:
+                idle = self.idle.get(key)
+                while idle:
+                    reader, _ = idle.pop()
+                    if connection_alive(reader.sock):
+                        return reader, True
+                    self.drop(key, reader)
+                if self.open.get(key, 0) < self.max_per_host:
+                    self.open[key] = self.open.get(key, 0) + 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout(f"no free connection to {host}:{port}")
+                self.lock.wait(remaining)
+
+        try:
+            return SocketReader(self.connect(host, port)), False
+        except OSError:
+            with self.lock:
+                self.drop(key, None)
+            raise
+
+    def release(self, host, port, reader, reusable):
+        """
+        Give a connection back after a response; it is kept only if
+        'reusable' and nothing unread is left in its buffer.
+        """
+        key = (host, port)
+        with self.lock:
+            if reusable and not reader.buf:
+                self.idle.setdefault(key, []).append((reader, time.monotonic()))
+                self.lock.notify()
+            else:
+                self.drop(key, reader)
+
+    def drop(self, key, reader):
+        # called with the lock held
+        if reader is not None:
+            reader.sock.close()
+        self.open[key] -= 1
+        if self.open[key] <= 0:
+            del self.open[key]
+        self.lock.notify()
+
+    def sweep(self):
+        # called with the lock held, closes idle connections at most once a second
+        now = time.monotonic()
+        if now - self.last_sweep < 1.0:
+            return
+        self.last_sweep = now
+        for key in list(self.idle):
+            fresh = []
+            for reader, last_used in self.idle[key]:
+                if now - last_used > self.idle_timeout:
+                    self.drop(key, reader)
+                else:
+                    fresh.append((reader, last_used))
+            if fresh:
+                self.idle[key] = fresh
+            else:
+                del self.idle[key]
+
+UPSTREAM_POOL = UpstreamPool()
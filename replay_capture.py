@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+Replays a capture file (fake_news_proxy.py --capture) through the proxy,
+offline.
+
+An origin stub answers every upstream request with the response captured
+for it, after the time the real origin took (scaled by --origin-latency).
+Requests are sent on the same connections and at the same offsets as
+captured; -s 10 plays them ten times as fast, -s 0 as fast as the proxy
+answers. The report compares replayed latencies with the captured ones
+and is written as JSON, like bench_proxy.py's.
+
+    python3 replay_capture.py -i capture.bin -s 1 -o replay.json
+    python3 replay_capture.py -i capture.bin -s 0 --proxy-args=-a
+
+Upstream bodies kept in the capture are served as they were; longer ones
+are padded by repeating what was kept, and ones that were forwarded
+without being kept (images and the like) are served as zero bytes of the
+captured length. Requests are routed to the stub by rewriting their URL
+to http://127.0.0.1:<stub port>/<host>:<port><path>, so replies do not
+depend on DNS or the network.
+"""
+import asyncio
+import multiprocessing
+import getopt
+import shlex
+import sys
+import os
+import json
+import time
+import platform
+
+from proxy_async import read_http_headers_async
+from proxy_codings import encode_chunk, last_chunk
+from proxy_http import (parse_http_head, parse_request_line, header_dict, extract_host_port_path,
+                        response_status)
+from proxy_logging import read_capture, join_head
+from bench_proxy import (start_proxy, stop_proxy, free_port, wait_listening, process_tree,
+                         cpu_seconds, rss_kb, read_response, percentile, git_revision)
+
+# Defaults for the command line
+SPEED = 1.0
+ORIGIN_LATENCY = 1.0
+
+# Chunk size for captured responses that came chunked
+STUB_CHUNK_BYTES = 16 * 1024
+
+# Response headers the stub sets itself
+STUB_SKIP_HEADERS = {b"content-length", b"transfer-encoding", b"connection", b"keep-alive"}
+
+# ***************** ORIGIN STUB *****************
+
+def stub_target(stub_port, host, port, path):
+    return f"http://127.0.0.1:{stub_port}/{host}:{port}{path}"
+
+def stub_path(host, port, path):
+    return f"/{host}:{port}{path}"
+
+class StubResponse(object):
+    """
+    A captured upstream response, served by the stub.
+    """
+
+    def __init__(self, exchange):
+        status_line, fields = parse_http_head(exchange.response_head)
+        headers = header_dict(fields)
+        self.status_line = status_line
+        self.fields = [f for f in fields if f[0] not in STUB_SKIP_HEADERS]
+        self.chunked = b"chunked" in headers.get(b"transfer-encoding", b"").lower()
+        self.delimited = self.chunked or b"content-length" in headers
+        self.status = response_status(status_line)
+        self.body_length = exchange.body_length
+        self.kept = exchange.body
+        self.delay = exchange.first_byte or 0.0
+
+    def body(self):
+        if self.status in (204, 304) or 100 <= self.status < 200:
+            return b""
+        if len(self.kept) >= self.body_length:
+            return self.kept[:self.body_length]
+        if not self.kept:
+            return bytes(self.body_length)
+        return (self.kept * (self.body_length // len(self.kept) + 1))[:self.body_length]
+
+    def encode(self):
+        """
+        Returns (bytes to send, whether to close the connection after).
+        """
+        body = self.body()
+        extra = []
+        if self.status in (204, 304) or 100 <= self.status < 200:
+            pass
+        elif self.chunked:
+            extra.append(b"Transfer-Encoding: chunked")
+            body = b"".join(encode_chunk(body[i:i + STUB_CHUNK_BYTES])
+                            for i in range(0, len(body), STUB_CHUNK_BYTES)) + last_chunk()
+        elif self.delimited:
+            extra.append(b"Content-Length: %d" % len(body))
+        else:
+            extra.append(b"Connection: close")
+        head = b"\r\n".join([self.status_line.encode('latin-1')] + [bytes(f[2]) for f in self.fields] + extra)
+        return head + b"\r\n\r\n" + body, not self.delimited
+
+class OriginStub(object):
+    """
+    Answers each path with its captured responses in the order captured;
+    once they run out, the last one again.
+    """
+
+    def __init__(self, responses, latency):
+        self.responses = responses      # stub path -> [StubResponse]
+        self.served = {}
+        self.latency = latency
+
+    def next_response(self, path):
+        responses = self.responses.get(path)
+        if not responses:
+            return None
+        n = self.served.get(path, 0)
+        self.served[path] = n + 1
+        return responses[min(n, len(responses) - 1)]
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line, fields = await read_http_headers_async(reader)
+                if request_line is None:
+                    break
+                length = int(header_dict(fields).get(b"content-length", b"0") or 0)
+                if length:
+                    await reader.readexactly(length)
+                _, path, _ = parse_request_line(request_line)
+                response = self.next_response(path)
+                if response is None:
+                    writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+                    await writer.drain()
+                    continue
+                if self.latency and response.delay:
+                    await asyncio.sleep(response.delay * self.latency)
+                data, close = response.encode()
+                writer.write(data)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, port):
+        server = await asyncio.start_server(self.handle, "127.0.0.1", port, backlog=1024)
+        async with server:
+            await server.serve_forever()
+
+def run_stub(capture_path, stub_port, latency):
+    responses = {}
+    for exchange in read_capture(capture_path):
+        if not exchange.response_head:
+            continue
+        target = replay_target(exchange)
+        if target is None:
+            continue
+        host, port, path = target
+        responses.setdefault(stub_path(host, port, path), []).append(StubResponse(exchange))
+    asyncio.run(OriginStub(responses, latency).serve(stub_port))
+
+def start_stub(capture_path, latency):
+    port = free_port()
+    proc = multiprocessing.Process(target=run_stub, args=(capture_path, port, latency))
+    proc.daemon = True
+    proc.start()
+    wait_listening(port)
+    return proc, port
+
+# ***************** REPLAY *****************
+
+def replay_target(exchange):
+    """
+    (host, port, path) the captured request went to, or None.
+    """
+    request_line, fields = parse_http_head(exchange.request_head)
+    method, url_or_path, _ = parse_request_line(request_line or "")
+    if method is None:
+        return None
+    return extract_host_port_path(url_or_path, header_dict(fields))
+
+def replay_request(exchange, stub_port):
+    """
+    The captured request head with its URL pointing at the stub, and a
+    zero-filled body if it had one.
+    """
+    request_line, fields = parse_http_head(exchange.request_head)
+    method, url_or_path, version = parse_request_line(request_line)
+    host, port, path = extract_host_port_path(url_or_path, header_dict(fields))
+    head = join_head(f"{method} {stub_target(stub_port, host, port, path)} {version}", fields)
+    try:
+        length = int(header_dict(fields).get(b"content-length", b"0") or 0)
+    except ValueError:
+        length = 0
+    return head + bytes(length)
+
+async def replay_connection(exchanges, proxy_port, stub_port, start, first, speed, results):
+    """
+    Send one captured connection's requests in order, each no earlier than
+    its captured offset (divided by 'speed') from 'start'.
+    """
+    loop = asyncio.get_running_loop()
+    reader = writer = None
+    for exchange in exchanges:
+        if speed:
+            delay = start + (exchange.started - first) / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        request = replay_request(exchange, stub_port)
+        started = loop.time()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection("127.0.0.1", proxy_port, limit=1024 * 1024)
+            writer.write(request)
+            status, size, keep_alive = await read_response(reader)
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError) as e:
+            results.append({"error": repr(e), "captured_ms": exchange.total * 1000})
+            if writer is not None:
+                writer.close()
+            writer = None
+            continue
+        # how far behind the captured schedule the request went out
+        late = max(0.0, started - start - (exchange.started - first) / speed) if speed else 0.0
+        results.append({"status": status, "captured_status": exchange.status, "bytes": size,
+                        "ms": (loop.time() - started) * 1000, "captured_ms": exchange.total * 1000,
+                        "late_ms": late * 1000})
+        if not keep_alive:
+            writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+async def replay(exchanges, proxy_port, stub_port, speed):
+    connections = {}
+    for exchange in exchanges:
+        connections.setdefault(exchange.connection, []).append(exchange)
+    loop = asyncio.get_running_loop()
+    start = loop.time() + 0.1
+    results = []
+    await asyncio.gather(*(replay_connection(conn, proxy_port, stub_port, start, exchanges[0].started,
+                                             speed, results)
+                           for conn in connections.values()))
+    return results, loop.time() - start
+
+def summarize(results, elapsed):
+    ok = [r for r in results if "error" not in r]
+    replayed = sorted(r["ms"] for r in ok)
+    captured = sorted(r["captured_ms"] for r in results)
+
+    def ms(value):
+        return None if value is None else round(value, 3)
+
+    return {
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "status_mismatches": sum(1 for r in ok if r["status"] != r["captured_status"]),
+        "seconds": round(elapsed, 3),
+        "rps": round(len(ok) / elapsed, 1) if elapsed > 0 else None,
+        "bytes": sum(r["bytes"] for r in ok),
+        "p50_ms": ms(percentile(replayed, 50)),
+        "p90_ms": ms(percentile(replayed, 90)),
+        "p99_ms": ms(percentile(replayed, 99)),
+        "max_ms": ms(replayed[-1] if replayed else None),
+        "captured_p50_ms": ms(percentile(captured, 50)),
+        "captured_p99_ms": ms(percentile(captured, 99)),
+        "late_p99_ms": ms(percentile(sorted(r["late_ms"] for r in ok), 99)),
+    }
+
+def main(argv=()):
+    inputInfo = ('replay_capture.py -i <CAPTURE FILE> -s <SPEED, 1 = as captured, 0 = as fast as possible>'
+                 ' -o <RESULT FILE>\n'
+                 '  --proxy-args="<ARGS FOR fake_news_proxy.py>" --port=<USE A RUNNING PROXY>'
+                 ' --origin-latency=<FACTOR, 0 = none>\n')
+    capture_path = None
+    speed = SPEED
+    latency = ORIGIN_LATENCY
+    out_path = None
+    proxy_args = []
+    external_port = None
+    try:
+        opts, args = getopt.getopt(argv, "i:s:o:", ["proxy-args=", "port=", "origin-latency="])
+        for opt, arg in opts:
+            if opt == "-i":
+                capture_path = arg
+            elif opt == "-s":
+                speed = float(arg)
+            elif opt == "-o":
+                out_path = arg
+            elif opt == "--proxy-args":
+                proxy_args = shlex.split(arg)
+            elif opt == "--port":
+                external_port = int(arg)
+            elif opt == "--origin-latency":
+                latency = float(arg)
+        if capture_path is None or speed < 0 or latency < 0:
+            raise ValueError()
+    except (getopt.GetoptError, ValueError):
+        print(inputInfo)
+        sys.exit(2)
+
+    try:
+        exchanges = sorted(read_capture(capture_path), key=lambda x: x.started)
+    except (OSError, ValueError) as e:
+        print(f"Could not read {capture_path}: {e}")
+        sys.exit(2)
+    exchanges = [x for x in exchanges if replay_target(x) is not None]
+    if not exchanges:
+        print(f"No requests to replay in {capture_path}.")
+        sys.exit(1)
+    print(f"Replaying {len(exchanges)} requests over "
+          f"{len({x.connection for x in exchanges})} connections at speed {speed or 'max'}.")
+
+    stub, stub_port = start_stub(capture_path, latency)
+    proxy = None
+    try:
+        if external_port is None:
+            proxy, proxy_port = start_proxy(proxy_args)
+        else:
+            proxy_port = external_port
+        pids = process_tree(proxy.pid) if proxy else []
+        cpu_before = cpu_seconds(pids) if pids else None
+        results, elapsed = asyncio.run(replay(exchanges, proxy_port, stub_port, speed))
+        pids = process_tree(proxy.pid) if proxy else []
+        cpu_after = cpu_seconds(pids) if pids else None
+        rss = rss_kb(pids) if pids else None
+    finally:
+        if proxy is not None:
+            stop_proxy(proxy)
+        stub.terminate()
+
+    summary = summarize(results, elapsed)
+    summary["cpu_seconds"] = (None if cpu_before is None or cpu_after is None
+                              else round(cpu_after - cpu_before, 2))
+    summary["rss_kb"] = rss
+    for name, value in summary.items():
+        print(f"{name:<18} {value}")
+
+    report = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "capture": capture_path,
+        "speed": speed,
+        "origin_latency": latency,
+        "proxy_args": proxy_args,
+        "summary": summary,
+    }
+    if out_path is None:
+        out_path = time.strftime("replay-%Y%m%d-%H%M%S.json")
+    with open(out_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {out_path}")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
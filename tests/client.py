@@ -0,0 +1,59 @@
+import socket
+import time
+
+def send_get(proxy, url, extra=b"", http_version=b"HTTP/1.1"):
+    sock = socket.create_connection(("127.0.0.1", proxy.port), 10)
+    sock.sendall(b"GET %s %s\r\nConnection: close\r\n%s\r\n" % (url.encode(), http_version, extra))
+    return sock
+
+def read_response(sock, raw=False):
+    """
+    Read a whole response (the proxy closes the connection after it).
+    Returns (head, body, first_body_at): the body is dechunked unless
+    'raw', and first_body_at is when the first body bytes came in
+    (time.monotonic()).
+    """
+    data = b""
+    first_body_at = None
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+        if first_body_at is None and b"\r\n\r\n" in data and not data.endswith(b"\r\n\r\n"):
+            first_body_at = time.monotonic()
+    sock.close()
+    head, _, body = data.partition(b"\r\n\r\n")
+    if not raw and b"transfer-encoding: chunked" in head.lower():
+        body = dechunk(body)
+    return head.decode("latin-1"), body, first_body_at
+
+def dechunk(data):
+    """
+    The body of a chunk-encoded response; raises ValueError if it does not
+    end with the last chunk.
+    """
+    body = b""
+    while True:
+        line, sep, data = data.partition(b"\r\n")
+        if not sep:
+            raise ValueError("truncated chunked body")
+        size = int(line.split(b";")[0], 16)
+        if size == 0:
+            return body
+        if len(data) < size + 2:
+            raise ValueError("truncated chunked body")
+        body += data[:size]
+        data = data[size + 2:]
+
+def get(proxy, url, extra=b""):
+    return read_response(send_get(proxy, url, extra))
+
+def metric(proxy, name):
+    sock = socket.create_connection(("127.0.0.1", proxy.metrics_port), 5)
+    sock.sendall(b"GET /metrics HTTP/1.1\r\n\r\n")
+    _, body, _ = read_response(sock)
+    for line in body.decode().splitlines():
+        if line.startswith(name + " "):
+            return float(line.split()[1])
+    return None
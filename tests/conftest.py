@@ -0,0 +1,105 @@
+import collections
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class OriginHandler(BaseHTTPRequestHandler):
+    """
+    Looks up the path in the server's routes, a route is a function taking
+    the handler. Counts the requests per path.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.hits[self.path] += 1
+        route = self.server.routes.get(self.path)
+        if route is None:
+            self.send_error(404)
+        else:
+            route(self)
+
+    def log_message(self, format, *args):
+        pass
+
+class Origin(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), OriginHandler)
+        self.routes = {}
+        self.hits = collections.Counter()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.port}{path}"
+
+class Proxy(object):
+    def __init__(self, engine, args):
+        self.port = free_port()
+        self.metrics_port = free_port()
+        command = [sys.executable, "fake_news_proxy.py", "-p", str(self.port),
+                   "-m", str(self.metrics_port), "-l", "error"] + list(args)
+        if engine == "asyncio":
+            command.append("-a")
+        self.process = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), 0.5).close()
+                break
+            except OSError:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"proxy did not start: {command}")
+                time.sleep(0.05)
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+@pytest.fixture
+def origin():
+    server = Origin()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture(params=["threaded", "asyncio"])
+def start_proxy(request):
+    """
+    Returns a function starting the proxy with extra command line
+    arguments, once per engine. The proxies are stopped after the test.
+    """
+    proxies = []
+
+    def start(*args):
+        proxy = Proxy(request.param, args)
+        proxies.append(proxy)
+        return proxy
+
+    yield start
+    for proxy in proxies:
+        proxy.stop()
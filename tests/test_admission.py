@@ -0,0 +1,45 @@
+import threading
+import time
+
+import fake_news_proxy
+from client import get, metric
+
+def slow_route(delay):
+    def route(handler):
+        time.sleep(delay)
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/plain")
+        handler.send_header("Content-Length", "2")
+        handler.end_headers()
+        handler.wfile.write(b"ok")
+    return route
+
+def test_admission_turns_away_beyond_the_queue():
+    admission = fake_news_proxy.Admission(1, 1, 0.1)
+    assert admission.enter() and admission.wait()
+    assert admission.enter()
+    assert not admission.enter()
+    # the queued one gives up after the timeout and frees its place
+    assert not admission.wait()
+    assert admission.enter()
+    admission.leave(False)
+    admission.leave()
+    assert admission.admitted == 0
+    assert admission.enter() and admission.wait()
+
+def test_request_beyond_the_limit_gets_503(origin, start_proxy):
+    origin.routes["/slow"] = slow_route(1.5)
+    origin.routes["/fast"] = slow_route(0.0)
+    proxy = start_proxy("--max-connections", "1", "--queue-timeout", "0.3")
+    results = {}
+    holder = threading.Thread(target=lambda: results.update(slow=get(proxy, origin.url("/slow"))))
+    holder.start()
+    time.sleep(0.3)
+    started = time.monotonic()
+    head, _, _ = get(proxy, origin.url("/fast"))
+    assert head.startswith("HTTP/1.1 503")
+    assert time.monotonic() - started < 1.0
+    holder.join()
+    assert results["slow"][0].startswith("HTTP/1.1 200")
+    assert get(proxy, origin.url("/fast"))[1] == b"ok"
+    assert metric(proxy, "proxy_shed_total") == 1
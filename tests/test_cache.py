@@ -0,0 +1,74 @@
+import os
+
+import proxy_cache
+from proxy_http import parse_http_head
+from client import get
+
+def entry(body, vary=b""):
+    head = (b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nCache-Control: max-age=60\r\n"
+            b"ETag: \"v1\"\r\n" + (b"Vary: " + vary + b"\r\n" if vary else b"") + b"\r\n")
+    status_line, fields = parse_http_head(head)
+    return proxy_cache.CacheEntry(status_line, fields, body, {b"accept-language": b"sv"})
+
+def spilling_cache(tmp_path):
+    # room for one entry in memory
+    return proxy_cache.ResponseCache(max_bytes=2000, max_entry_bytes=2000, spill_dir=str(tmp_path))
+
+def test_spill_round_trip(tmp_path):
+    cache = spilling_cache(tmp_path)
+    first = entry(b"<p>first</p>" * 100, vary=b"Accept-Language")
+    cache.store("a", first)
+    cache.store("b", entry(b"<p>second</p>" * 100))
+    assert not os.listdir(tmp_path)     # written by write_spills, not under the lock
+    cache.write_spills()
+    assert len(os.listdir(tmp_path)) == 1
+    back = cache.lookup("a", {b"accept-language": b"sv"})
+    assert back is not None and back is not first
+    for name in ("status_line", "fields", "body", "gzip_body", "vary", "stored_at", "expires_at",
+                 "must_revalidate", "size"):
+        assert getattr(back, name) == getattr(first, name), name
+    assert back.is_fresh()
+    # "b" went to disk in its place
+    assert cache.on_disk("b")
+    assert cache.lookup("a", {b"accept-language": b"en"}) is None
+
+def test_damaged_spill_file_is_a_miss(tmp_path):
+    cache = spilling_cache(tmp_path)
+    cache.store("a", entry(b"x" * 1000))
+    cache.store("b", entry(b"y" * 1000))
+    cache.write_spills()
+    name, = os.listdir(tmp_path)
+    with open(os.path.join(tmp_path, name), "r+b") as f:
+        f.write(b"garbage")
+    assert cache.lookup("a", {}) is None
+    assert not os.listdir(tmp_path)
+
+def test_spill_files_of_earlier_runs_are_removed(tmp_path):
+    stale = tmp_path / ("%d-1.cache" % os.getpid())
+    stale.write_bytes(b"from an earlier run")
+    cache = spilling_cache(tmp_path)
+    assert not stale.exists()
+    cache.store("a", entry(b"x" * 1000))
+    cache.store("b", entry(b"y" * 1000))
+    cache.write_spills()
+    assert cache.lookup("a", {}).body == b"x" * 1000
+
+def test_proxy_serves_spilled_entries(origin, start_proxy, tmp_path):
+    body = b"x" * 300000
+    def route(handler):
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/octet-stream")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.send_header("Cache-Control", "max-age=60")
+        handler.end_headers()
+        handler.wfile.write(body)
+    paths = ["/file%d.bin" % i for i in range(8)]
+    for path in paths:
+        origin.routes[path] = route
+    proxy = start_proxy("-c", "1", "-d", str(tmp_path))
+    for _ in range(2):
+        for path in paths:
+            head, got, _ = get(proxy, origin.url(path))
+            assert head.startswith("HTTP/1.1 200") and got == body
+    assert all(origin.hits[path] == 1 for path in paths)
+    assert os.listdir(tmp_path)
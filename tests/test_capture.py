@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+import proxy_logging
+from proxy_http import parse_http_head
+from proxy_logging import encode_exchange, read_capture
+from client import get
+
+REQUEST_HEAD = b"GET http://example.com/a.html HTTP/1.1\r\nHost: example.com\r\n\r\n"
+RESPONSE_HEAD = b"HTTP/1.1 200 OK\r\nContent-Length: 11\r\n\r\n"
+
+def exchange(status=200, cache="miss", response=True, body=b"Smiley here"):
+    request_line, request_fields = parse_http_head(REQUEST_HEAD)
+    upstream_line, upstream_fields = parse_http_head(RESPONSE_HEAD) if response else (None, ())
+    return (1700000000.5, 7, 0.25 if response else None, 0.5, status, cache, request_line,
+            request_fields, upstream_line, upstream_fields, len(body), body)
+
+def write_capture(path, items, tail=b""):
+    with open(path, "wb") as f:
+        f.write(proxy_logging.CAPTURE_MAGIC)
+        for item in items:
+            f.write(encode_exchange(item))
+        f.write(tail)
+
+def test_round_trip(tmp_path):
+    path = tmp_path / "capture.bin"
+    write_capture(path, [exchange(), exchange(status=None, cache=None, response=False, body=b"")])
+    first, second = read_capture(path)
+    assert first.started == 1700000000.5 and first.connection == 7
+    assert first.first_byte == 0.25 and first.total == 0.5
+    assert first.status == 200 and first.cache == "miss"
+    assert first.request_head == REQUEST_HEAD
+    assert first.response_head == RESPONSE_HEAD
+    assert first.body_length == 11 and first.body == b"Smiley here"
+    assert second.first_byte is None and second.status is None and second.cache is None
+    assert second.response_head == b"" and second.body == b""
+
+def test_record_cut_short_ends_the_capture(tmp_path):
+    path = tmp_path / "capture.bin"
+    whole = encode_exchange(exchange())
+    write_capture(path, [exchange()], whole[:len(whole) // 2])
+    assert len(list(read_capture(path))) == 1
+
+def test_not_a_capture_file(tmp_path):
+    path = tmp_path / "capture.bin"
+    path.write_bytes(b"GIF89a")
+    with pytest.raises(ValueError):
+        list(read_capture(path))
+
+def test_proxy_writes_a_capture(origin, start_proxy, tmp_path):
+    body = b"<p>Smiley</p>" * 50
+    def route(handler):
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/html")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+    origin.routes["/page.html"] = route
+    path = tmp_path / "capture.bin"
+    proxy = start_proxy("--capture", str(path))
+    get(proxy, origin.url("/page.html"))
+    get(proxy, origin.url("/missing"))
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline and len(list(read_capture(path))) < 2:
+        time.sleep(0.05)
+    page, missing = read_capture(path)
+    assert page.request_head.startswith(b"GET " + origin.url("/page.html").encode())
+    assert page.response_head.startswith(b"HTTP/1.1 200")
+    assert page.status == 200
+    assert page.body_length == len(body) and page.body == body
+    assert page.first_byte is not None and page.first_byte <= page.total
+    assert missing.status == 404
@@ -0,0 +1,83 @@
+import pytest
+
+import proxy_codings
+from proxy_codings import ChunkedDecoder, encode_chunk, last_chunk
+
+BODY = b"Smiley in Stockholm, " * 300
+
+def encode(body, size, trailers=()):
+    out = b"".join(encode_chunk(body[i:i + size]) for i in range(0, len(body), size))
+    return out + last_chunk(trailers)
+
+def decode(pieces):
+    decoder = ChunkedDecoder()
+    body = b"".join(decoder.feed(piece) for piece in pieces)
+    return body, decoder
+
+def test_encode_chunk():
+    assert encode_chunk(b"hello") == b"5\r\nhello\r\n"
+    assert encode_chunk(b"x" * 255) == b"ff\r\n" + b"x" * 255 + b"\r\n"
+
+def test_last_chunk_drops_trailers_a_rewrite_makes_wrong():
+    assert last_chunk() == b"0\r\n\r\n"
+    assert last_chunk([b"Content-MD5: abc", b"Content-Length: 3"]) == b"0\r\n\r\n"
+    assert last_chunk([b"X-Checked: yes", b"digest: sha=1"]) == b"0\r\nX-Checked: yes\r\n\r\n"
+
+def test_round_trip_in_one_piece():
+    body, decoder = decode([encode(BODY, 1000)])
+    assert body == BODY
+    assert decoder.done and decoder.unused == b""
+
+def test_feed_byte_by_byte():
+    data = encode(BODY, 77, [b"X-Checked: yes"])
+    body, decoder = decode(data[i:i + 1] for i in range(len(data)))
+    assert body == BODY
+    assert decoder.done
+    assert decoder.trailers == [b"X-Checked: yes"]
+
+def test_not_done_before_the_trailers_end():
+    body, decoder = decode([b"5\r\nhello\r\n0\r\nX-A: 1\r\n"])
+    assert body == b"hello"
+    assert not decoder.done
+    assert decoder.feed(b"\r\n") == b""
+    assert decoder.done
+
+def test_chunk_extensions_are_ignored():
+    body, decoder = decode([b"5;name=value\r\nhello\r\n6 ; a=\"b;c\"\r\n world\r\n0;end\r\n\r\n"])
+    assert body == b"hello world"
+    assert decoder.done
+
+def test_bare_lf_and_upper_case_hex():
+    body, decoder = decode([b"A\nabcdefghij\n0\n\n"])
+    assert body == b"abcdefghij"
+    assert decoder.done
+
+def test_bytes_after_the_last_chunk_are_unused():
+    body, decoder = decode([b"5\r\nhello\r\n0\r\n\r\nHTTP/1.1 200", b" OK\r\n"])
+    assert body == b"hello"
+    assert decoder.unused == b"HTTP/1.1 200 OK\r\n"
+
+@pytest.mark.parametrize("line", [b"xyz", b"", b"-5", b"+5", b"0x5", b"5_0", b"1" * 17, b"\xd9\xa3"])
+def test_bad_chunk_size(line):
+    with pytest.raises(ConnectionError):
+        decode([line + b"\r\nhello\r\n0\r\n\r\n"])
+
+def test_chunk_data_must_end_with_crlf():
+    with pytest.raises(ConnectionError):
+        decode([b"5\r\nhelloXX\r\n0\r\n\r\n"])
+
+def test_oversize_line():
+    decoder = ChunkedDecoder()
+    decoder.feed(b"5;" + b"x" * (ChunkedDecoder.MAX_LINE - 10))
+    with pytest.raises(ConnectionError):
+        decoder.feed(b"x" * 20)
+
+def test_oversize_trailer():
+    decoder = ChunkedDecoder()
+    decoder.feed(b"0\r\nX-Long: ")
+    with pytest.raises(ConnectionError):
+        decoder.feed(b"x" * (ChunkedDecoder.MAX_LINE + 1))
+
+def test_parse_chunk_size():
+    assert proxy_codings.parse_chunk_size(b"1f; ext\r") == 31
+    assert proxy_codings.parse_chunk_size(b"0000000a") == 10
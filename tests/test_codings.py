@@ -0,0 +1,37 @@
+import gzip
+import zlib
+
+import pytest
+
+import proxy_codings
+
+TEXT = b"<p>Smiley in Stockholm</p>\n" * 500
+
+def raw_deflate(data):
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def decode(coding, body, step):
+    decompressor = proxy_codings.Decompressor(coding)
+    out = b"".join(decompressor.feed(body[i:i + step]) for i in range(0, len(body), step))
+    return out + decompressor.flush()
+
+@pytest.mark.parametrize("step", [1, 2, 3, 65536])
+@pytest.mark.parametrize("coding, body", [
+    (b"gzip", gzip.compress(TEXT)),
+    (b"gzip", gzip.compress(TEXT[:1000]) + gzip.compress(TEXT[1000:])),
+    (b"deflate", zlib.compress(TEXT)),
+    (b"deflate", raw_deflate(TEXT)),
+    (b"deflate", gzip.compress(TEXT)),
+])
+def test_decodes_in_any_pieces(coding, body, step):
+    assert decode(coding, body, step) == TEXT
+
+@pytest.mark.parametrize("coding", [b"gzip", b"deflate"])
+def test_too_short_body_passes_through(coding):
+    assert decode(coding, b"x", 1) == b"x"
+    assert decode(coding, b"", 1) == b""
+
+def test_bad_body_is_an_error():
+    with pytest.raises(ConnectionError):
+        decode(b"gzip", b"\x1f\x8b" + b"\xff" * 20, 1)
@@ -0,0 +1,139 @@
+import asyncio
+import socket
+import time
+
+import pytest
+
+import proxy_upstream
+
+def connector():
+    return proxy_upstream.UpstreamConnector(negative_ttl=60.0, attempt_delay=0.05)
+
+def closed_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def stalled_listener():
+    # a listener whose accept queue is full: connects to it hang
+    listener = socket.socket()
+    listener.bind(("127.0.0.2", 0))
+    listener.listen(0)
+    queued = []
+    for _ in range(8):
+        s = socket.socket()
+        s.setblocking(False)
+        s.connect_ex(listener.getsockname())
+        queued.append(s)
+    return listener, queued
+
+def connect(upstream, engine, host, port, timeout):
+    if engine == "asyncio":
+        async def run():
+            try:
+                return await upstream.connect_async(host, port, timeout)
+            except asyncio.TimeoutError:
+                raise socket.timeout()
+        return asyncio.run(run())
+    return upstream.connect(host, port, timeout)
+
+@pytest.fixture(params=["threaded", "asyncio"])
+def engine(request):
+    return request.param
+
+def test_refused_host_is_remembered(engine):
+    upstream = connector()
+    port = closed_port()
+    with pytest.raises(ConnectionRefusedError):
+        connect(upstream, engine, "127.0.0.1", port, 1.0)
+    listener = socket.create_server(("127.0.0.1", port))
+    try:
+        with pytest.raises(ConnectionRefusedError):
+            connect(upstream, engine, "127.0.0.1", port, 1.0)
+    finally:
+        listener.close()
+
+def test_timeout_is_not_remembered(engine):
+    upstream = connector()
+    listener, queued = stalled_listener()
+    host, port = listener.getsockname()
+    try:
+        with pytest.raises(socket.timeout):
+            connect(upstream, engine, host, port, 0.3)
+        for s in queued:
+            s.close()
+        while True:
+            listener.setblocking(False)
+            try:
+                listener.accept()[0].close()
+            except BlockingIOError:
+                break
+        connect(upstream, engine, host, port, 2.0).close()
+    finally:
+        listener.close()
+
+def info(address):
+    return (socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", address)
+
+@pytest.fixture
+def resolver(monkeypatch):
+    """
+    Fake getaddrinfo: names map to address lists in 'names'; counts calls.
+    """
+    class Resolver(object):
+        names = {}
+        calls = 0
+    def getaddrinfo(host, port, *args, **kwargs):
+        Resolver.calls += 1
+        if host not in Resolver.names:
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return [info(address) for address in Resolver.names[host]]
+    monkeypatch.setattr(socket, "getaddrinfo", getaddrinfo)
+    return Resolver
+
+def test_dns_entry_expires(resolver):
+    resolver.names["origin.test"] = [("127.0.0.1", 80)]
+    dns = proxy_upstream.DnsCache(ttl=0.2)
+    assert dns.resolve("origin.test", 80) == [info(("127.0.0.1", 80))]
+    resolver.names["origin.test"] = [("127.0.0.9", 80)]
+    assert dns.resolve("origin.test", 80) == [info(("127.0.0.1", 80))]
+    assert resolver.calls == 1
+    time.sleep(0.3)
+    assert asyncio.run(dns.resolve_async("origin.test", 80)) == [info(("127.0.0.9", 80))]
+    assert resolver.calls == 2
+    assert (dns.hits, dns.misses) == (1, 2)
+
+def test_unresolvable_name_is_remembered(resolver):
+    dns = proxy_upstream.DnsCache(negative_ttl=0.2)
+    for _ in range(2):
+        with pytest.raises(socket.gaierror):
+            dns.resolve("nowhere.test", 80)
+    assert resolver.calls == 1
+    resolver.names["nowhere.test"] = [("127.0.0.1", 80)]
+    time.sleep(0.3)
+    assert dns.resolve("nowhere.test", 80) == [info(("127.0.0.1", 80))]
+
+def test_dns_cache_keeps_max_entries(resolver):
+    dns = proxy_upstream.DnsCache(max_entries=2)
+    for name in ("a.test", "b.test", "c.test"):
+        resolver.names[name] = [("127.0.0.1", 80)]
+        dns.resolve(name, 80)
+    assert list(dns.entries) == [("b.test", 80), ("c.test", 80)]
+
+def test_fail_over_to_the_next_address(resolver, engine):
+    listener = socket.create_server(("127.0.0.1", 0))
+    stalled, queued = stalled_listener()
+    try:
+        # refused, then no answer, then the one that works
+        resolver.names["origin.test"] = [("127.0.0.3", closed_port()), stalled.getsockname(),
+                                         listener.getsockname()]
+        upstream = connector()
+        started = time.monotonic()
+        sock = connect(upstream, engine, "origin.test", 80, 5.0)
+        assert sock.getpeername() == listener.getsockname()
+        assert time.monotonic() - started < 1.0
+        sock.close()
+        assert not upstream.down
+    finally:
+        for s in [listener, stalled] + queued:
+            s.close()
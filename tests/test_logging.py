@@ -0,0 +1,80 @@
+import io
+import json
+import time
+
+import proxy_logging
+from proxy_logging import LogWriter, Logger
+from client import get
+
+def test_log_writer_writes_in_order():
+    stream = io.StringIO()
+    writer = LogWriter(stream, lambda item: f"line {item}\n")
+    writer.start()
+    for i in range(100):
+        writer.put(i)
+    writer.flush()
+    assert stream.getvalue() == "".join(f"line {i}\n" for i in range(100))
+    assert writer.dropped == 0
+
+def test_log_writer_keeps_going_after_a_bad_item():
+    stream = io.StringIO()
+    writer = LogWriter(stream, lambda item: "%d\n" % item)
+    writer.start()
+    for item in (1, "two", 3):
+        writer.put(item)
+    writer.flush()
+    assert stream.getvalue().splitlines() == ["1", "(unprintable log line 'two': %d format: a real number is required, not str)", "3"]
+
+def test_binary_log_writer_skips_a_bad_item():
+    stream = io.BytesIO()
+    writer = LogWriter(stream, lambda item: b"%d\n" % item, binary=True)
+    writer.start()
+    for item in (1, "two", 3):
+        writer.put(item)
+    writer.flush()
+    assert stream.getvalue() == b"1\n3\n"
+
+def test_log_writer_drops_beyond_its_queue():
+    stream = io.StringIO()
+    writer = LogWriter(stream, lambda item: f"{item}\n", max_queued=3)
+    for i in range(5):
+        writer.put(i)
+    assert writer.dropped == 2
+    writer.start()
+    for i in range(3):
+        writer.put(i)
+    writer.flush()
+    assert stream.getvalue() == "0\n1\n2\n"
+
+def test_logger_levels_and_format():
+    stream = io.StringIO()
+    log = Logger(proxy_logging.INFO)
+    log.start(stream)
+    log.debug("not %s", "written")
+    log.info("[%s] got %d bytes", b"client", 5)
+    log.error("done")
+    log.writer.flush()
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 2
+    assert lines[0].endswith(" INFO    [client] got 5 bytes")
+    assert lines[1].endswith(" ERROR   done")
+    time.strptime(lines[0][:19], "%Y-%m-%d %H:%M:%S")
+
+def test_access_log(origin, start_proxy, tmp_path):
+    def route(handler):
+        handler.send_response(200)
+        handler.send_header("Content-Length", "2")
+        handler.end_headers()
+        handler.wfile.write(b"ok")
+    origin.routes["/"] = route
+    path = tmp_path / "access.log"
+    proxy = start_proxy("--access-log", str(path))
+    get(proxy, origin.url("/"))
+    get(proxy, origin.url("/missing"))
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline and len(path.read_text().splitlines()) < 2:
+        time.sleep(0.05)
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [(r["method"], r["url"]) for r in records] == [("GET", origin.url("/")), ("GET", origin.url("/missing"))]
+    assert records[0]["status"] == 200 and records[0]["bytes"] > 0
+    assert records[1]["status"] == 404
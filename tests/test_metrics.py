@@ -0,0 +1,78 @@
+import re
+import socket
+
+import proxy_metrics
+from client import get, read_response
+
+SAMPLE = re.compile(r'([a-z_]+)(\{[a-z_]+="[^"]*"(,[a-z_]+="[^"]*")*\})? (-?[0-9.e+-]+)')
+
+def admin_get(proxy, path):
+    sock = socket.create_connection(("127.0.0.1", proxy.metrics_port), 5)
+    sock.sendall(b"GET %s HTTP/1.1\r\n\r\n" % path.encode())
+    return read_response(sock)
+
+def parse(text):
+    """
+    Check the exposition format line by line; returns {name: kind} from the
+    TYPE lines and the samples as (name, labels, value).
+    """
+    kinds = {}
+    samples = []
+    for line in text.splitlines():
+        if line.startswith("# TYPE "):
+            _, _, name, kind = line.split(" ")
+            assert kind in ("counter", "gauge", "histogram")
+            kinds[name] = kind
+        elif line.startswith("# HELP "):
+            continue
+        else:
+            m = SAMPLE.fullmatch(line)
+            assert m, line
+            name = m.group(1)
+            family = re.sub(r"_(bucket|sum|count)$", "", name)
+            assert name in kinds or kinds.get(family) == "histogram", line
+            samples.append((name, m.group(2) or "", float(m.group(4))))
+    return kinds, samples
+
+def test_render_metrics():
+    recorder = proxy_metrics.Recorder()
+    recorder.observe("total", 0.003)
+    recorder.observe("total", 100.0)
+    recorder.counters["cache_hits"] += 2
+    metrics = proxy_metrics.merge_metrics([recorder.snapshot()])
+    text = proxy_metrics.render_metrics({"requests": 5, "active_connections": 1}, metrics).decode()
+    kinds, samples = parse(text)
+    assert kinds["proxy_requests_total"] == "counter"
+    assert kinds["proxy_active_connections"] == "gauge"
+    assert kinds["proxy_cache_hits_total"] == "counter"
+    values = {name + labels: value for name, labels, value in samples}
+    assert values["proxy_requests_total"] == 5
+    assert values["proxy_cache_hits_total"] == 2
+    assert values['proxy_phase_seconds_bucket{phase="total",le="0.0025"}'] == 0
+    assert values['proxy_phase_seconds_bucket{phase="total",le="0.005"}'] == 1
+    assert values['proxy_phase_seconds_bucket{phase="total",le="+Inf"}'] == 2
+    assert values['proxy_phase_seconds_count{phase="total"}'] == 2
+    assert abs(values['proxy_phase_seconds_sum{phase="total"}'] - 100.003) < 1e-6
+
+def test_metrics_endpoint(origin, start_proxy):
+    proxy = start_proxy()
+    for _ in range(3):
+        get(proxy, origin.url("/"))
+    head, body, _ = admin_get(proxy, "/metrics")
+    assert head.startswith("HTTP/1.1 200")
+    assert "text/plain; version=0.0.4" in head
+    kinds, samples = parse(body.decode())
+    assert kinds["proxy_phase_seconds"] == "histogram"
+    values = {name + labels: value for name, labels, value in samples}
+    assert values["proxy_requests_total"] >= 3
+    for phase in proxy_metrics.PHASES:
+        buckets = [value for name, labels, value in samples
+                   if name == "proxy_phase_seconds_bucket" and f'phase="{phase}"' in labels]
+        assert len(buckets) == len(proxy_metrics.PHASE_BUCKETS) + 1
+        assert buckets == sorted(buckets)
+        assert buckets[-1] == values[f'proxy_phase_seconds_count{{phase="{phase}"}}']
+    assert values['proxy_phase_seconds_count{phase="total"}'] >= 3
+
+def test_other_admin_paths_are_not_found(start_proxy):
+    head, _, _ = admin_get(start_proxy(), "/")
+    assert head.startswith("HTTP/1.1 404")
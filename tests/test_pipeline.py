@@ -0,0 +1,115 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from client import dechunk, get, metric, read_response, send_get
+
+def html_route(body, headers=()):
+    def route(handler):
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/html")
+        handler.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(body)
+    return route
+
+def test_rewrites_text(origin, start_proxy):
+    origin.routes["/page.html"] = html_route(b"<p>Smiley in Stockholm</p>")
+    proxy = start_proxy()
+    head, body, _ = get(proxy, origin.url("/page.html"))
+    assert head.startswith("HTTP/1.1 200")
+    assert body == b"<p>Trolly in Link\xc3\xb6ping</p>"
+
+def test_tunnel_counts_in_total(origin, start_proxy):
+    origin.routes["/page.html"] = html_route(b"hello")
+    proxy = start_proxy("--connect-ports", str(origin.port))
+    sock = socket.create_connection(("127.0.0.1", proxy.port), 10)
+    sock.sendall(b"CONNECT 127.0.0.1:%d HTTP/1.1\r\n\r\n"
+                 b"GET /page.html HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n" % origin.port)
+    head, body, _ = read_response(sock)
+    assert head.startswith("HTTP/1.1 200 Connection Established")
+    assert body.endswith(b"hello")
+    deadline = time.monotonic() + 5
+    while metric(proxy, 'proxy_phase_seconds_count{phase="total"}') != 1:
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+def short_route(body, content_type, headers=()):
+    # declares more than it sends, then closes
+    def route(handler):
+        handler.send_response(200)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(body) + 1000))
+        for name, value in headers:
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(body)
+        handler.close_connection = True
+    return route
+
+def test_truncated_rewritten_body_stays_truncated(origin, start_proxy):
+    origin.routes["/short.html"] = short_route(b"<p>Smiley</p>" * 1000, "text/html")
+    proxy = start_proxy()
+    head, body, _ = read_response(send_get(proxy, origin.url("/short.html")), raw=True)
+    assert "transfer-encoding: chunked" in head.lower()
+    with pytest.raises(ValueError):
+        dechunk(body)
+
+def test_truncated_raw_body_stays_truncated(origin, start_proxy):
+    origin.routes["/short.bin"] = short_route(b"x" * 100000, "application/octet-stream")
+    proxy = start_proxy()
+    head, body, _ = read_response(send_get(proxy, origin.url("/short.bin")))
+    assert "content-length: 101000" in head.lower()
+    assert len(body) == 100000
+
+def test_truncated_body_is_not_cached(origin, start_proxy):
+    body = b"<p>Smiley</p>" * 1000
+    headers = [("Cache-Control", "max-age=60"), ("ETag", '"v1"')]
+    short, whole = short_route(body, "text/html", headers), html_route(body, headers)
+    origin.routes["/short.html"] = lambda handler: (short if origin.hits["/short.html"] == 1 else whole)(handler)
+    proxy = start_proxy("-c", "16")
+    head, _, _ = read_response(send_get(proxy, origin.url("/short.html")), raw=True)
+    head, second, _ = get(proxy, origin.url("/short.html"))
+    assert origin.hits["/short.html"] == 2
+    assert "age:" not in head.lower()
+    assert second == body.replace(b"Smiley", b"Trolly")
+
+def test_bytes_past_the_body_are_not_taken_for_the_next_response(start_proxy):
+    # an origin that sends 5 bytes more than its Content-Length, all at once
+    listener = socket.create_server(("127.0.0.1", 0))
+    port = listener.getsockname()[1]
+    served = []
+
+    def serve():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            with conn:
+                data = b""
+                while True:
+                    while b"\r\n\r\n" not in data:
+                        chunk = conn.recv(65536)
+                        if not chunk:
+                            break
+                        data += chunk
+                    if b"\r\n\r\n" not in data:
+                        break
+                    _, _, data = data.partition(b"\r\n\r\n")
+                    served.append(conn)
+                    conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\n"
+                                 b"Content-Length: 5\r\n\r\nhelloXXXXX")
+
+    threading.Thread(target=serve, daemon=True).start()
+    proxy = start_proxy()
+    try:
+        for _ in range(3):
+            head, body, _ = get(proxy, "http://127.0.0.1:%d/x" % port)
+            assert head.startswith("HTTP/1.1 200") and body == b"hello"
+    finally:
+        listener.close()
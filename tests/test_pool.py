@@ -0,0 +1,97 @@
+import socket
+import time
+
+import pytest
+
+import proxy_upstream
+
+class Server(object):
+    # a listener that accepts only when asked to
+    def __init__(self):
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.accepted = []
+
+    def address(self):
+        return self.listener.getsockname()
+
+    def accept(self):
+        conn, _ = self.listener.accept()
+        self.accepted.append(conn)
+        return conn
+
+    def close(self):
+        for conn in self.accepted:
+            conn.close()
+        self.listener.close()
+
+@pytest.fixture
+def server():
+    server = Server()
+    yield server
+    server.close()
+
+def pool(**kwargs):
+    kwargs.setdefault("checkout_timeout", 0.2)
+    return proxy_upstream.UpstreamPool(**kwargs)
+
+def test_released_connection_is_reused(server):
+    upstream = pool()
+    host, port = server.address()
+    reader, reused = upstream.checkout(host, port)
+    assert not reused
+    upstream.release(host, port, reader, True)
+    again, reused = upstream.checkout(host, port)
+    assert reused and again is reader
+    assert upstream.open == {(host, port): 1}
+
+def test_unreusable_connection_is_closed(server):
+    upstream = pool()
+    host, port = server.address()
+    reader, _ = upstream.checkout(host, port)
+    upstream.release(host, port, reader, False)
+    assert reader.sock.fileno() == -1
+    assert upstream.open == {}
+    _, reused = upstream.checkout(host, port)
+    assert not reused
+
+def test_connection_with_unread_bytes_is_closed(server):
+    upstream = pool()
+    host, port = server.address()
+    reader, _ = upstream.checkout(host, port)
+    reader.buf += b"HTTP/1.1 200 OK\r\n"
+    upstream.release(host, port, reader, True)
+    assert reader.sock.fileno() == -1
+    assert upstream.open == {}
+
+def test_connection_closed_by_the_server_is_not_handed_out(server):
+    upstream = pool()
+    host, port = server.address()
+    reader, _ = upstream.checkout(host, port)
+    upstream.release(host, port, reader, True)
+    server.accept().close()
+    time.sleep(0.1)
+    again, reused = upstream.checkout(host, port)
+    assert not reused and again is not reader
+    assert upstream.open == {(host, port): 1}
+
+def test_idle_connection_is_evicted(server):
+    upstream = pool(idle_timeout=0.1)
+    host, port = server.address()
+    reader, _ = upstream.checkout(host, port)
+    upstream.release(host, port, reader, True)
+    time.sleep(0.2)
+    upstream.last_sweep = 0.0
+    _, reused = upstream.checkout(host, port)
+    assert not reused
+    assert reader.sock.fileno() == -1
+    assert upstream.open == {(host, port): 1}
+
+def test_checkout_waits_for_a_free_connection(server):
+    upstream = pool(max_per_host=1)
+    host, port = server.address()
+    reader, _ = upstream.checkout(host, port)
+    with pytest.raises(socket.timeout):
+        upstream.checkout(host, port)
+    upstream.release(host, port, reader, True)
+    again, reused = upstream.checkout(host, port)
+    assert reused and again is reader
@@ -0,0 +1,121 @@
+import json
+import time
+
+import pytest
+
+import proxy_rewrite
+from client import read_response, send_get
+
+def trickle_route(pieces, delay, chunked):
+    # a large page sent in pieces, 'delay' seconds apart
+    def route(handler):
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/html")
+        if chunked:
+            handler.send_header("Transfer-Encoding", "chunked")
+        else:
+            handler.send_header("Content-Length", str(sum(map(len, pieces))))
+        handler.end_headers()
+        for piece in pieces:
+            handler.wfile.write(b"%x\r\n%s\r\n" % (len(piece), piece) if chunked else piece)
+            time.sleep(delay)
+        if chunked:
+            handler.wfile.write(b"0\r\n\r\n")
+    return route
+
+def check_streams(origin, proxy, chunked):
+    pieces = [b"<p>Smiley</p>" * 2000] * 5
+    origin.routes["/large.html"] = trickle_route(pieces, 0.3, chunked)
+    started = time.monotonic()
+    head, body, first_body_at = read_response(send_get(proxy, origin.url("/large.html")))
+    finished = time.monotonic()
+    assert body == b"".join(pieces).replace(b"Smiley", b"Trolly")
+    assert first_body_at - started < 0.6
+    assert finished - started > 1.2
+
+def test_large_page_streams_with_length(origin, start_proxy):
+    check_streams(origin, start_proxy(), chunked=False)
+
+def test_large_page_streams_chunked(origin, start_proxy):
+    check_streams(origin, start_proxy(), chunked=True)
+
+def test_small_page_memo_gives_same_body(origin, start_proxy):
+    body = b"<p>Smiley in Stockholm</p>" * 100
+    def route(handler):
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/html")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+    origin.routes["/small.html"] = route
+    proxy = start_proxy()
+    expected = body.replace(b"Smiley", b"Trolly").replace(b"Stockholm", "Linköping".encode())
+    for _ in range(2):
+        _, out, _ = read_response(send_get(proxy, origin.url("/small.html")))
+        assert out == expected
+
+def rewrite(rules, *pieces):
+    rewriter = proxy_rewrite.StreamRewriter(proxy_rewrite.RuleSet(rules))
+    return b"".join(rewriter.feed(piece) for piece in pieces) + rewriter.flush()
+
+def literal(match, replace):
+    return {"type": "literal", "match": match, "replace": replace}
+
+@pytest.mark.parametrize("text", [
+    "{",
+    "[]",
+    '{"rules": []}',
+    '{"rules": [{"type": "literal", "match": "", "replace": "x"}]}',
+    '{"rules": [{"type": "regex", "match": "a", "replace": "b"}]}',
+    '{"rules": [{"type": "literal", "match": "a"}]}',
+    '{"rules": [{"type": "literal", "match": 1, "replace": "b"}]}',
+    '{"rules": [{"type": "literal", "match": "a", "replace": null}]}',
+    '{"rules": ["a"]}',
+])
+def test_bad_rules_file_is_refused(tmp_path, text):
+    path = tmp_path / "rules.json"
+    path.write_text(text)
+    with pytest.raises((ValueError, KeyError, TypeError)):
+        proxy_rewrite.load_rules(str(path))
+
+def test_rules_file_is_loaded(tmp_path):
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps({"rules": [literal("a", "b")]}))
+    rules = proxy_rewrite.load_rules(str(path))
+    assert rules.patterns == [b"a"]
+    assert rules.version != proxy_rewrite.RULES.version
+
+def test_missing_rules_file_gives_default_rules(tmp_path):
+    rules = proxy_rewrite.load_rules(str(tmp_path / "missing.json"))
+    assert rules.version == proxy_rewrite.RULES.version
+
+def test_empty_replacement_deletes_the_match():
+    assert rewrite([literal("Smiley", "")], b"a Smiley b") == b"a  b"
+
+def test_overlapping_matches_are_leftmost_longest():
+    rules = [literal("bc", "1"), literal("abcd", "2"), literal("ab", "3"), literal("cde", "4")]
+    # "abcd" and "ab" start at the same place: the longer wins;
+    # "bc" and "cde" overlap it and are dropped
+    assert rewrite(rules, b"xabcdex") == b"x2ex"
+    # without "abcd" the leftmost match is "ab", then "cde" is free
+    assert rewrite(rules[:1] + rules[2:], b"xabcdex") == b"x34x"
+
+def test_protected_span_keeps_literals_inside():
+    special = proxy_rewrite.SPECIAL_IMG.encode()
+    body = b"Stockholm " + special + b" Stockholm"
+    out = rewrite(proxy_rewrite.DEFAULT_RULES, body)
+    assert out == "Linköping ".encode() + special + " Linköping".encode()
+
+def test_match_split_over_chunks_is_found():
+    body = b"<p>Smiley in Stockholm, Smiley</p>" * 3
+    expected = body.replace(b"Smiley", b"Trolly").replace(b"Stockholm", "Linköping".encode())
+    rules = proxy_rewrite.DEFAULT_RULES
+    assert rewrite(rules, *(body[i:i + 1] for i in range(len(body)))) == expected
+    for cut in range(len(body)):
+        assert rewrite(rules, body[:cut], body[cut:]) == expected
+
+def test_feed_holds_back_only_a_possible_match():
+    rewriter = proxy_rewrite.StreamRewriter(proxy_rewrite.RuleSet([literal("Smiley", "Trolly")]))
+    assert rewriter.feed(b"hello Smi") == b"hell"
+    assert rewriter.feed(b"ley!") == b"o Trolly"
+    assert rewriter.flush() == b"!"
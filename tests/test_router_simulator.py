@@ -0,0 +1,316 @@
+import getopt
+import heapq
+import io
+import os
+import random
+import subprocess
+import sys
+from array import array
+
+import pytest
+
+LAB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "labb 4")
+sys.path.insert(0, LAB)
+
+import GuiTextArea, Output, RouterNode, RouterPacket, Topology
+import RouterSimulator as simulator_module
+
+# RouterSimulator.py imports what it uses when run as a script; do the same
+for module in (getopt, heapq, random, sys, GuiTextArea, Output, RouterNode, RouterPacket, Topology):
+    setattr(simulator_module, module.__name__, module)
+RouterSimulator = simulator_module.RouterSimulator
+Event = simulator_module.Event
+
+@pytest.fixture
+def simulator(monkeypatch):
+    """
+    Returns a function making a headless RouterSimulator with the given
+    class settings (restored after the test).
+    """
+    def make(**settings):
+        settings.setdefault("OUTPUT", "null")
+        settings.setdefault("TRACE", 0)
+        for name, value in settings.items():
+            monkeypatch.setattr(RouterSimulator, name, value)
+        return RouterSimulator()
+    return make
+
+def event(evtime, evtype=RouterSimulator.LINK_CHANGE, eventity=0):
+    e = Event()
+    e.evtime = evtime
+    e.evtype = evtype
+    e.eventity = eventity
+    return e
+
+def drain(sim):
+    return [heapq.heappop(sim.evlist)[2] for _ in range(len(sim.evlist))]
+
+def test_events_come_out_in_time_order(simulator):
+    sim = simulator(NUM_NODES=3, LINKCHANGES=False)
+    sim.evlist = []
+    times = [random.Random(1).uniform(0, 100) for _ in range(200)]
+    events = [event(t) for t in times]
+    for e in events:
+        sim.insertevent(e)
+    assert [e.evtime for e in drain(sim)] == sorted(times)
+
+def test_events_at_the_same_time_come_out_last_inserted_first(simulator):
+    # the order of the linked list the heap replaced
+    sim = simulator(NUM_NODES=3, LINKCHANGES=False)
+    sim.evlist = []
+    first, second, third, earlier = event(5.0), event(5.0), event(5.0), event(1.0)
+    for e in (first, second, third, earlier):
+        sim.insertevent(e)
+    assert [id(e) for e in drain(sim)] == [id(earlier), id(third), id(second), id(first)]
+
+def test_arrivals_at_a_node_keep_their_order(simulator):
+    sim = simulator(NUM_NODES=5, LINKCHANGES=False)
+    arrivals = {}
+    for evtime, _, e in sorted(sim.evlist, key=lambda item: -item[1]):
+        arrivals.setdefault(e.eventity, []).append(evtime)
+    for dest, times in arrivals.items():
+        assert times == sorted(times)
+        assert sim.lastArrival[dest] == times[-1]
+
+def distances(sim):
+    return [list(node.distanceVector) for node in sim.nodes]
+
+@pytest.mark.parametrize("nodes, poison, expected", [
+    (3, True, [[0, 51, 1], [51, 0, 50], [1, 50, 0]]),
+    (3, False, [[0, 51, 1], [51, 0, 50], [1, 50, 0]]),
+    (4, True, [[0, 4, 3, 1], [4, 0, 1, 3], [3, 1, 0, 2], [1, 3, 2, 0]]),
+])
+def test_run_with_link_changes(simulator, nodes, poison, expected):
+    sim = simulator(NUM_NODES=nodes, LINKCHANGES=True, POISONREVERSE=poison)
+    sim.runSimulation()
+    assert not sim.evlist
+    assert distances(sim) == expected
+
+def run_script(*args, cwd=LAB):
+    return subprocess.run([sys.executable, os.path.join(LAB, "RouterSimulator.py")] + list(args),
+                          cwd=cwd, capture_output=True, text=True, timeout=60)
+
+def test_stream_output_writes_whole_lines():
+    stream = io.StringIO()
+    out = Output.StreamOutput(stream, "[router 1] ")
+    out.print("cost:")
+    out.print(" 1")
+    assert stream.getvalue() == ""
+    out.println(" 2")
+    out.print("a\nb\nc")
+    assert stream.getvalue() == "[router 1] cost: 1 2\n[router 1] a\n[router 1] b\n"
+    out.println()
+    assert stream.getvalue().endswith("[router 1] c\n")
+
+def test_null_output():
+    out = Output.NullOutput()
+    out.print("x")
+    out.println("y")
+    out.println()
+
+def test_headless_stdout_run():
+    result = run_script("-n", "3", "-t", "3", "-o", "stdout")
+    assert result.returncode == 0
+    lines = result.stdout.splitlines()
+    assert all(line.startswith(("[sim] ", "[router ")) for line in lines)
+    assert "[sim] Simulator terminated at t=" in result.stdout
+    assert "[router 2] Current state for router 2" in result.stdout
+    assert "tkinter" not in result.stderr
+
+def test_headless_file_run(tmp_path):
+    path = tmp_path / "sim.log"
+    result = run_script("-n", "4", "-t", "2", "-o", "file", "-f", str(path))
+    assert result.returncode == 0 and result.stdout == ""
+    assert "[sim] Simulator terminated at t=" in path.read_text()
+
+def test_null_run_does_not_load_tkinter():
+    script = ("import sys, runpy; sys.argv = ['RouterSimulator.py', '-o', 'null', '-n', '5'];"
+              "sys.path.insert(0, '.');"
+              "runpy.run_path('RouterSimulator.py', run_name='__main__');"
+              "assert 'tkinter' not in sys.modules")
+    result = subprocess.run([sys.executable, "-c", script], cwd=LAB, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+
+def test_unknown_output_is_refused():
+    result = run_script("-o", "printer")
+    assert result.returncode == 2
+    assert "RouterSimulator.py -c" in result.stdout
+
+def write_topology(tmp_path, text):
+    path = tmp_path / "topology.txt"
+    path.write_text(text)
+    return str(path)
+
+def test_load_topology_file(tmp_path):
+    path = write_topology(tmp_path, "# a small net\n"
+                                    "0 1 4\n"
+                                    "1 2        # cost 1\n"
+                                    "2: 3=7 0\n"
+                                    "\n"
+                                    "nodes 6\n")
+    topology = Topology.Topology.load(path)
+    assert topology.numNodes == 6
+    assert topology.links == [{1: 4, 2: 1}, {0: 4, 2: 1}, {1: 1, 3: 7, 0: 1}, {2: 7}, {}, {}]
+    assert topology.numLinks() == 4
+    assert topology.maxDistance() == 5 * 7
+
+@pytest.mark.parametrize("text, error", [
+    ("0 1\n0 x\n", "topology.txt:2: cannot read '0 x'"),
+    ("0 1 2 3\n", "topology.txt:1: cannot read '0 1 2 3'"),
+    ("0: 1=x\n", "topology.txt:1: cannot read '0: 1=x'"),
+    ("nodes many\n", "topology.txt:1: cannot read 'nodes many'"),
+    ("0 -1\n", "negative node id in link 0--1"),
+    ("1 1\n", "link from node 1 to itself"),
+    ("0 1 0\n", "link 0-1 has cost 0"),
+])
+def test_bad_topology_file(tmp_path, text, error):
+    path = write_topology(tmp_path, text)
+    with pytest.raises(ValueError) as e:
+        Topology.Topology.load(path)
+    assert error in str(e.value)
+
+@pytest.mark.parametrize("spec", ["ring:1", "er:10:0", "er:10:1.5", "er:10:x", "geo:10:0", "ba:5:5", "ba:5:0"])
+def test_bad_generator_spec(spec):
+    with pytest.raises(ValueError):
+        Topology.Topology.fromSpec(spec, random.Random(1))
+
+def test_missing_topology_file(tmp_path):
+    with pytest.raises(OSError):
+        Topology.Topology.fromSpec(str(tmp_path / "missing.txt"), random.Random(1))
+
+def degrees(topology):
+    return [len(links) for links in topology.links]
+
+def test_generators():
+    rng = random.Random(1)
+    ring = Topology.Topology.fromSpec("ring:10", rng)
+    assert degrees(ring) == [2] * 10
+    grid = Topology.Topology.fromSpec("grid:9", rng)
+    assert grid.numLinks() == 12 and degrees(grid)[4] == 4
+    complete = Topology.Topology.fromSpec("er:20:1", rng)
+    assert complete.numLinks() == 20 * 19 // 2
+    scale_free = Topology.Topology.fromSpec("ba:50:2", rng)
+    assert scale_free.numLinks() == (50 - 2) * 2
+    geo = Topology.Topology.fromSpec("geo:200:0.1", rng)
+    for topology in (ring, grid, complete, scale_free, geo):
+        for u, links in enumerate(topology.links):
+            for v, cost in links.items():
+                assert topology.links[v][u] == cost
+                assert 1 <= cost <= Topology.Topology.MAXCOST
+
+def test_generators_depend_only_on_the_seed():
+    specs = ["er:300:0.02", "geo:300:0.1", "ba:300:3"]
+    first = [Topology.Topology.fromSpec(spec, random.Random(7)).links for spec in specs]
+    again = [Topology.Topology.fromSpec(spec, random.Random(7)).links for spec in specs]
+    assert first == again
+
+def shortest_paths(links, source):
+    dist = {source: 0}
+    queue = [(0, source)]
+    while queue:
+        d, u = heapq.heappop(queue)
+        if d > dist[u]:
+            continue
+        for v, cost in links[u].items():
+            if d + cost < dist.get(v, float("inf")):
+                dist[v] = d + cost
+                heapq.heappush(queue, (d + cost, v))
+    return dist
+
+@pytest.mark.parametrize("spec", ["er:40:0.1", "grid:30", "ba:40:2"])
+def test_run_on_a_topology_finds_shortest_paths(simulator, spec):
+    sim = simulator(TOPOLOGY=spec, SEED=3)
+    sim.runSimulation()
+    for node in sim.nodes:
+        dist = shortest_paths(sim.links, node.myID)
+        assert list(node.distanceVector) == [dist.get(i, sim.INFINITY) for i in range(sim.NUM_NODES)]
+
+def test_bad_topology_stops_the_simulator(tmp_path):
+    result = run_script("-o", "null", "-g", write_topology(tmp_path, "0 x\n"))
+    assert result.returncode == 1
+    assert "Bad topology" in result.stderr and "cannot read '0 x'" in result.stderr
+
+def test_packet_copies_a_list_and_shares_an_array():
+    costs = [0, 4, 1]
+    packet = RouterPacket.RouterPacket(0, 1, costs)
+    costs[1] = 99
+    assert list(packet.mincost) == [0, 4, 1]
+    vector = array('i', [0, 4, 1])
+    shared = RouterPacket.RouterPacket(0, 1, vector)
+    clone = shared.clone()
+    assert shared.mincost is vector and clone.mincost is vector
+    assert (clone.sourceid, clone.destid) == (0, 1)
+    with pytest.raises(AttributeError):
+        packet.extra = 1
+
+def sent_packets(sim, node):
+    # the packets 'node' gives the simulator when it propagates
+    sent = []
+    sim.toLayer2 = sent.append
+    sim.nodes[node].propagate()
+    del sim.toLayer2
+    return sent
+
+def test_propagate_poisons_routes_through_the_receiver(simulator):
+    sim = simulator(NUM_NODES=5, LINKCHANGES=False, POISONREVERSE=True)
+    sim.runSimulation()
+    node = sim.nodes[0]
+    packets = {p.destid: p for p in sent_packets(sim, 0)}
+    assert sorted(packets) == node.neighbors
+    for neighbor, packet in packets.items():
+        for dst in range(sim.NUM_NODES):
+            poisoned = node.nextHops[dst] == neighbor
+            expected = sim.INFINITY if poisoned else node.distanceVector[dst]
+            assert packet.mincost[dst] == expected
+        # the vector is a copy: later changes do not reach packets in flight
+        assert packet.mincost is not node.distanceVector
+
+def test_unpoisoned_packets_share_one_vector(simulator):
+    sim = simulator(NUM_NODES=5, LINKCHANGES=False, POISONREVERSE=False)
+    sim.runSimulation()
+    packets = sent_packets(sim, 0)
+    assert len(packets) == len(sim.nodes[0].neighbors) > 1
+    assert all(p.mincost is packets[0].mincost for p in packets)
+    assert list(packets[0].mincost) == list(sim.nodes[0].distanceVector)
+
+def test_packet_to_a_node_not_linked_is_dropped(simulator):
+    sim = simulator(NUM_NODES=4, LINKCHANGES=False)
+    queued = len(sim.evlist)
+    sim.toLayer2(RouterPacket.RouterPacket(1, 3, [0] * 4))
+    sim.toLayer2(RouterPacket.RouterPacket(1, 1, [0] * 4))
+    sim.toLayer2(RouterPacket.RouterPacket(1, 7, [0] * 4))
+    assert len(sim.evlist) == queued
+    sim.toLayer2(RouterPacket.RouterPacket(1, 2, [0] * 4))
+    assert len(sim.evlist) == queued + 1
+
+def test_event_has_no_per_instance_dict():
+    with pytest.raises(AttributeError):
+        Event().prev = None
+
+def routes(sim):
+    return [(list(node.distanceVector), list(node.nextHops)) for node in sim.nodes]
+
+@pytest.mark.parametrize("settings", [
+    dict(NUM_NODES=3, LINKCHANGES=True),
+    dict(NUM_NODES=5, LINKCHANGES=True, POISONREVERSE=False),
+    dict(TOPOLOGY="er:60:0.08", SEED=5),
+    dict(TOPOLOGY="ba:60:1", SEED=5),
+])
+def test_numpy_backend_gives_the_same_routes(simulator, settings):
+    pytest.importorskip("numpy")
+    plain = simulator(VECTORIZE=False, **settings)
+    plain.runSimulation()
+    vectorized = simulator(VECTORIZE=True, **settings)
+    assert all(node.ncostMatrix is not None for node in vectorized.nodes)
+    vectorized.runSimulation()
+    assert routes(vectorized) == routes(plain)
+    assert vectorized.clocktime == plain.clocktime
+
+def test_vectorize_without_numpy_is_refused(monkeypatch):
+    monkeypatch.setattr(RouterNode, "numpy", None)
+    # main() sets these on the class, have them put back
+    monkeypatch.setattr(RouterSimulator, "OUTPUT", RouterSimulator.OUTPUT)
+    monkeypatch.setattr(RouterSimulator, "VECTORIZE", RouterSimulator.VECTORIZE)
+    with pytest.raises(SystemExit) as e:
+        RouterSimulator.main(["-o", "null", "-v", "true"])
+    assert "NumPy is not installed" in str(e.value)
@@ -0,0 +1,62 @@
+import threading
+import time
+
+from client import get
+
+def slow_route(head_delay, body_delay, headers=()):
+    # not storable unless 'headers' make it so
+    body = b"<p>Smiley</p>" * 100
+    def route(handler):
+        time.sleep(head_delay)
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/html")
+        handler.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(body[:10])
+        time.sleep(body_delay)
+        handler.wfile.write(body[10:])
+    return route
+
+def burst(proxy, url, n=5):
+    """
+    n concurrent GETs of 'url'. Returns their latencies, the first
+    request's first.
+    """
+    latencies = [None] * n
+
+    def fetch(i):
+        started = time.monotonic()
+        head, body, _ = get(proxy, url)
+        assert head.startswith("HTTP/1.1 200") and body.startswith(b"<p>Trolly</p>")
+        latencies[i] = time.monotonic() - started
+
+    threads = [threading.Thread(target=fetch, args=(i,)) for i in range(n)]
+    for i, thread in enumerate(threads):
+        thread.start()
+        if i == 0:
+            time.sleep(0.1)     # make it the leader
+    for thread in threads:
+        thread.join()
+    return latencies
+
+def test_followers_of_unstorable_response_do_not_wait_for_its_body(origin, start_proxy):
+    origin.routes["/dynamic.html"] = slow_route(0.0, 1.0)
+    proxy = start_proxy()
+    leader, *followers = burst(proxy, origin.url("/dynamic.html"))
+    assert origin.hits["/dynamic.html"] == 5
+    assert max(followers) < leader + 0.5
+
+def test_unstorable_response_is_not_coalesced_again(origin, start_proxy):
+    origin.routes["/dynamic.html"] = slow_route(1.0, 0.0)
+    proxy = start_proxy()
+    get(proxy, origin.url("/dynamic.html"))
+    leader, *followers = burst(proxy, origin.url("/dynamic.html"))
+    assert max(followers) < leader + 0.5
+
+def test_storable_response_is_shared(origin, start_proxy):
+    origin.routes["/static.html"] = slow_route(0.5, 0.0, [("Cache-Control", "max-age=60")])
+    proxy = start_proxy()
+    burst(proxy, origin.url("/static.html"))
+    assert origin.hits["/static.html"] == 1
@@ -0,0 +1,128 @@
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+import proxy_http
+import proxy_tunnel
+from client import read_response
+
+@pytest.mark.parametrize("authority, target", [
+    ("example.com:443", ("example.com", 443)),
+    ("[::1]:8443", ("::1", 8443)),
+    ("example.com", None),
+    (":443", None),
+    ("example.com:", None),
+    ("example.com:4x3", None),
+    ("a:\u00b2", None),
+    ("a:\u0663", None),
+])
+def test_connect_target(authority, target):
+    assert proxy_tunnel.connect_target(authority) == target
+
+def test_malformed_connect_gets_400(start_proxy):
+    proxy = start_proxy()
+    sock = socket.create_connection(("127.0.0.1", proxy.port), 10)
+    sock.sendall("CONNECT a:\u00b2 HTTP/1.1\r\n\r\n".encode("utf-8"))
+    head, _, _ = read_response(sock)
+    assert head.startswith("HTTP/1.1 400")
+
+def echo_server():
+    """
+    A listener answering each connection with what it receives, upper-cased,
+    and closing once the client has half-closed.
+    """
+    listener = socket.create_server(("127.0.0.1", 0))
+    def serve(conn):
+        with conn:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                conn.sendall(data.upper())
+            conn.sendall(b"BYE")
+    def accept():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
+    threading.Thread(target=accept, daemon=True).start()
+    return listener
+
+def read_until_eof(sock):
+    data = b""
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return data
+        data += chunk
+
+@pytest.mark.parametrize("splice", [False, True])
+def test_relay_tunnel(monkeypatch, splice):
+    if splice and not hasattr(os, "splice"):
+        pytest.skip("no splice()")
+    monkeypatch.setattr(proxy_http, "SPLICE", splice)
+    client, proxy_side = socket.socketpair()
+    client.settimeout(10)
+    upstream = echo_server()
+    server = socket.create_connection(upstream.getsockname())
+    results = []
+    relay = threading.Thread(target=lambda: results.append(proxy_tunnel.relay_tunnel(proxy_side, server, 5.0)))
+    relay.start()
+    payload = b"smiley " * 100000
+    sender = threading.Thread(target=lambda: (client.sendall(payload), client.shutdown(socket.SHUT_WR)))
+    sender.start()
+    received = read_until_eof(client)
+    sender.join()
+    relay.join(5)
+    assert received == payload.upper() + b"BYE"
+    assert results == [(len(payload), len(payload) + 3, "closed")]
+    for sock in (client, proxy_side, server, upstream):
+        sock.close()
+
+def test_relay_tunnel_idle_timeout():
+    client, proxy_side = socket.socketpair()
+    server, origin_side = socket.socketpair()
+    started = time.monotonic()
+    up, down, reason = proxy_tunnel.relay_tunnel(proxy_side, server, 0.3)
+    assert (up, down, reason) == (0, 0, "timed out")
+    assert 0.3 <= time.monotonic() - started < 2.0
+    for sock in (client, proxy_side, server, origin_side):
+        sock.close()
+
+def open_tunnel(proxy, port):
+    sock = socket.create_connection(("127.0.0.1", proxy.port), 10)
+    sock.sendall(b"CONNECT 127.0.0.1:%d HTTP/1.1\r\nHost: 127.0.0.1:%d\r\n\r\n" % (port, port))
+    head = b""
+    while not head.endswith(b"\r\n\r\n"):
+        byte = sock.recv(1)
+        if not byte:
+            break
+        head += byte
+    return sock, head.decode("latin-1")
+
+def test_tunnel_through_the_proxy(start_proxy):
+    upstream = echo_server()
+    port = upstream.getsockname()[1]
+    proxy = start_proxy("--connect-ports", str(port))
+    sock, head = open_tunnel(proxy, port)
+    assert head.startswith("HTTP/1.1 200")
+    sock.sendall(b"hello ")
+    assert sock.recv(100) == b"HELLO "
+    sock.sendall(b"again")
+    sock.shutdown(socket.SHUT_WR)
+    assert read_until_eof(sock) == b"AGAINBYE"
+    sock.close()
+    upstream.close()
+
+def test_tunnel_to_a_port_not_allowed(start_proxy):
+    upstream = echo_server()
+    port = upstream.getsockname()[1]
+    sock, head = open_tunnel(start_proxy(), port)
+    assert head.startswith("HTTP/1.1 403")
+    sock.close()
+    upstream.close()
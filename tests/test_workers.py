@@ -0,0 +1,49 @@
+import os
+import signal
+import time
+
+from client import get, metric
+
+def worker_pids(proxy):
+    with open(f"/proc/{proxy.process.pid}/task/{proxy.process.pid}/children") as f:
+        return [int(pid) for pid in f.read().split()]
+
+def wait_for(check, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not check():
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
+
+def page_route(handler):
+    handler.send_response(200)
+    handler.send_header("Content-Type", "text/html")
+    handler.send_header("Content-Length", "13")
+    handler.end_headers()
+    handler.wfile.write(b"<p>Smiley</p>")
+
+def test_workers_serve_and_are_restarted(origin, start_proxy):
+    origin.routes["/page.html"] = page_route
+    proxy = start_proxy("-w", "2")
+    wait_for(lambda: len(worker_pids(proxy)) == 2)
+    for _ in range(10):
+        assert get(proxy, origin.url("/page.html"))[1] == b"<p>Trolly</p>"
+    # the workers' counters reach the supervisor's /metrics
+    wait_for(lambda: metric(proxy, "proxy_requests_total") == 10)
+    assert metric(proxy, "proxy_workers") == 2
+
+    killed = worker_pids(proxy)[0]
+    os.kill(killed, signal.SIGKILL)
+    wait_for(lambda: len(worker_pids(proxy)) == 2 and killed not in worker_pids(proxy))
+    assert metric(proxy, "proxy_worker_restarts_total") == 1
+    # what the dead worker had counted is kept
+    assert metric(proxy, "proxy_requests_total") >= 10
+    assert get(proxy, origin.url("/page.html"))[1] == b"<p>Trolly</p>"
+
+def test_supervisor_stops_its_workers(origin, start_proxy):
+    proxy = start_proxy("-w", "2")
+    wait_for(lambda: len(worker_pids(proxy)) == 2)
+    workers = worker_pids(proxy)
+    proxy.process.terminate()
+    assert proxy.process.wait(15) == 0
+    for pid in workers:
+        assert not os.path.exists(f"/proc/{pid}")